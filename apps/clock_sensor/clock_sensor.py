@@ -8,11 +8,65 @@
 
 
 import xtime
-import re
+import xconfig
+import sys
+import struct
+import gc
+
+
+# config params of each component are declared in its SCHEMA, so they can be
+# validated before anything reads them
+# each is (suffix, type, default, base, min, max), with the same default the
+# component reads it with
+
+_INT = xconfig.XConfig.INT
+_BOOL = xconfig.XConfig.BOOL
+
+
+# infinities, to tell values that aren't finite numbers by; see Template
+
+_INF = float("inf")
+_NINF = float("-inf")
+
+
+# declare the params of one or more schemas, under a component's prefix
+
+def declare(xc, xcprefix, *schemas):
+
+  xc.declare([ (xcprefix + x[0],) + tuple(x[1:]) for schema in schemas for x in schema ])
+
+
+# something that tells this board apart from others: its unique id, or MAC
+
+def _node_id():
+
+  try:
+    return bytes(__import__("machine").unique_id())
+  except:
+    pass
+
+  try:
+    return __import__("uuid").getnode().to_bytes(6, "big")
+  except:
+    return b""
+
+
+# 4 random bytes, different on every boot, or as good as we can get
+
+def _nonce(xt):
+
+  try:
+    return __import__("os").urandom(4)
+  except:
+    pass
+
+  return struct.pack("<I", xt.time_ns() & 0xffffffff)
 
 
 class Periodic(object):
 
+  SCHEMA = [ ("_INTERVAL", _INT, 1, 10, 0, 86400) ]
+
   _cnt = 0
 
   def __init__(self, xc, tick_period, xcprefix):
@@ -58,6 +112,10 @@ class Sensor(Periodic):
 
     self._listeners = set()
 
+    # set by _get() when what it returns stands in for a failed reading
+
+    self._failed = False
+
   def _fire(self, now):
 
     rv = self._get()
@@ -65,21 +123,26 @@ class Sensor(Periodic):
     if rv == None:
       return False
 
-    for listener in self._listeners:
-      listener(now, list(rv) + [ 0.0 ] * (3 - len(rv)))
+    for listener, failures in self._listeners:
+      if failures or not self._failed:
+        listener(now, list(rv) + [ 0.0 ] * (3 - len(rv)))
 
     return True
 
 
   # fn(now, htp)
+  # failures: if False, fn isn't called with the zeros that stand in for
+  #           failed readings
 
-  def add_listener(self, fn):
+  def add_listener(self, fn, failures=True):
 
-    self._listeners.add(fn)
+    self._listeners.add((fn, failures))
 
 
 class I2CDevice(object):
 
+  SCHEMA = [ ("_I2C_ADDR", _INT, 0x00, 16, 0x00, 0x7f) ]
+
   def __init__(self, xm, xt, xc, mname, xcprefix):
 
     self._i2cdev = None
@@ -227,37 +290,99 @@ class I2CSensor(Sensor):
 
 class RemoteSensor(Sensor):
 
-  _req_ptn = re.compile("^\s*([0-9]+)\s+([0-9]+\.[0-9]+)\s+([0-9]+\.[0-9]+)\s+([0-9]+\.[0-9]+)\s*$")
+  SCHEMA = Sensor.SCHEMA + [ ("_PORT", _INT, 0, 10, 0, 0xffff),
+                             ("_BLOCKSIZE", _INT, 512, 10, 16, 0xffff),
+                             ("_CONNECT_TIMEOUT", _INT, 5000, 10, 0, 600000),
+                             ("_RESPONSE_TIMEOUT", _INT, 10000, 10, 0, 600000),
+                             ("_TIMEOUT", _INT, 30000, 10, 0, 600000),
+                             ("_BACKOFF_MAX", _INT, 300, 10, 0, 86400),
+                             ("_TLS", _BOOL, False, 10, None, None),
+                             ("_REMOTE_SENSOR", _INT, 1, 10, 1, 2) ]
 
-  def __init__(self, xt, xc, tick_period, xcprefix):
+  def __init__(self, xt, xc, tick_period, xcprefix, discovery=None, pool=None):
 
     Sensor.__init__(self, xc, tick_period, xcprefix)
 
     self._webclt = None
+    self._discovery = None
+    self._pool = pool
+    self._pending = False
+    self._result = None
+    self._backoff = None
+    self._node = xc.get_str(xcprefix + "_NODE", "")
+    self._path = xc.get_str(xcprefix + "_PATH", "/")
+    self._addr = None
+
+    # which of the peer's sensors we read: where its values start in the
+    # peer's binary record, after magic, version, channels and timestamp
+
+    self._first = 4 + (xc.get_int(xcprefix + "_REMOTE_SENSOR", 10, 1) - 1) * 3
 
     host = xc.get_str(xcprefix + "_HOST", "")
     port = xc.get_int(xcprefix + "_PORT", 10, 0)
-    path = xc.get_str(xcprefix + "_PATH", "/")
+    bsize = xc.get_int(xcprefix + "_BLOCKSIZE", 10, 512)
+    ctout = xc.get_int(xcprefix + "_CONNECT_TIMEOUT", 10, 5000)
+    rtout = xc.get_int(xcprefix + "_RESPONSE_TIMEOUT", 10, 10000)
+    ttout = xc.get_int(xcprefix + "_TIMEOUT", 10, 30000)
+    bmax = xc.get_int(xcprefix + "_BACKOFF_MAX", 10, 300)
+    tls = True if xc.get_bool(xcprefix + "_TLS", False) else None
+
+    if len(self._path) == 0:
+      return
 
-    if len(host) > 0 and port > 0 and port < 0xffff and len(path) > 0:
+    m = __import__("webclient")
 
-      m = __import__("webclient")
+    # failed requests are retried no sooner than every interval, backing off
+    # from there up to bmax secs
 
-      self._webclt = m.HTTPRequest()
-      self._webclt.set(host, path, port)
+    self._backoff = m.Backoff(xt, base=max(xc.get_int(xcprefix + "_INTERVAL", 10, 1), 1) * 1000, max_delay=bmax * 1000)
 
+    # a node name is resolved through discovery, every time we fire, so a node
+    # that moves is followed
 
-  def _get(self):
+    if len(self._node) > 0 and discovery != None:
+      self._discovery = discovery
+      self._webclt = m.HTTPRequest(blocksize=bsize, xt=xt, connect_timeout=ctout, response_timeout=rtout, total_timeout=ttout, tls=tls)
+    elif len(host) > 0 and port > 0 and port < 0xffff:
+      self._webclt = m.HTTPRequest(blocksize=bsize, xt=xt, connect_timeout=ctout, response_timeout=rtout, total_timeout=ttout, tls=tls)
+      self._webclt.set(host, self._path, port)
+      self._webclt.resolve()
 
-    if self._webclt == None:
-      return None
+    # the peer's binary record, rather than whatever its text template says
+
+    if self._webclt != None:
+      self._webclt.set_accept(WS.TYPE_BIN)
+
+
+  def _resolve(self):
+
+    addr = self._discovery.resolve(self._node)
+
+    if addr == None:
+      return False
 
-    rv = self._webclt.request()
+    # discovery hands out addresses, so resolving one never waits on dns
+
+    if addr != self._addr:
+      self._addr = addr
+      self._webclt.set(addr[0], self._path, addr[1])
+      self._webclt.resolve()
+
+    return True
+
+
+  # turn the return value of request() into a reading
+  #   return htp, or None if not done yet
+
+  def _parse(self, rv):
 
     # error
 
     if rv[0] != 0:
+      self._pending = False
+      self._backoff.failure()
       self._webclt.reset()
+      self._failed = True
       return 0.0, 0.0, 0.0
 
     # success, but not done yet
@@ -267,24 +392,74 @@ class RemoteSensor(Sensor):
 
     # success and done; get response
 
-    rv = self._webclt.get_response()
-    self._webclt.reset()
+    self._pending = False
+    self._backoff.success()
+
+    rv = self._webclt.get_response(raw=True)
+
+    # anything other than a 200 OK binary record we understand is an error
+
+    if rv[0][0] != 200 or len(rv[2]) != WS.BIN_LEN:
+      self._webclt.reset()
+      self._failed = True
+      return 0.0, 0.0, 0.0
 
-    # anything other than 200 OK is an error
+    rv = struct.unpack(WS.BIN_FMT, rv[2])
+    self._webclt.reset()
 
-    if rv[0][0] != 200:
+    if rv[0] != WS.BIN_MAGIC or rv[1] != WS.BIN_VERSION or rv[2] != WS.BIN_CHANNELS:
+      self._failed = True
       return 0.0, 0.0, 0.0
 
-    # parse result
+    self._failed = False
 
-    rv = RemoteSensor._req_ptn.match(rv[2])
+    return rv[self._first], rv[self._first + 1], rv[self._first + 2]
 
-    # invalid result?
 
-    if rv == None:
+  # called by the pool once our request is done
+
+  def _done(self, req, rv):
+
+    self._result = self._parse(rv)
+
+
+  def _get(self):
+
+    if self._webclt == None:
+      return None
+
+    # the pool is still on it
+
+    if self._pool != None and self._pending:
+      return None
+
+    # pool has finished it
+
+    if self._result != None:
+      rv = self._result
+      self._result = None
+      return rv
+
+    # peer has been failing; don't bother until it's time to try again
+
+    if not self._pending and not self._backoff.ready():
+      self._failed = True
       return 0.0, 0.0, 0.0
 
-    return float(rv.group(2)), float(rv.group(3)), float(rv.group(4))
+    # node not found yet; try again next tick
+
+    if not self._pending and self._discovery != None and not self._resolve():
+      return None
+
+    self._pending = True
+
+    # hand it to the pool, or drive it ourselves
+
+    if self._pool != None:
+      self._pool.submit(self._webclt, self._done)
+      return None
+
+    return self._parse(self._webclt.request())
 
 
   def set(self):
@@ -293,13 +468,17 @@ class RemoteSensor(Sensor):
 
 class ModDevice(object):
 
-  def __init__(self, xm, xt, xc, tick_period, xcprefix):
+  # we don't know which it'll be until we've read the module
+
+  SCHEMA = RemoteSensor.SCHEMA + I2CDevice.SCHEMA
+
+  def __init__(self, xm, xt, xc, tick_period, xcprefix, discovery=None, pool=None):
 
     self._device = None
     module = xc.get_str(xcprefix + "_MODULE", "").lower()
 
     if module == "http":
-      self._device = RemoteSensor(xm, xc, tick_period, xcprefix)
+      self._device = RemoteSensor(xt, xc, tick_period, xcprefix, discovery, pool)
     elif module in [ "bme280", "sht30" ]:
       self._device = I2CSensor(xm, xt, xc, tick_period, module, xcprefix)
     elif module in [ "hd44780" ]:
@@ -318,10 +497,10 @@ class ModDevice(object):
       self._device.set(*args, **kwargs)
 
 
-  def add_listener(self, fn):
+  def add_listener(self, fn, failures=True):
 
     if self._device != None and isinstance(self._device, Sensor):
-      self._device.add_listener(fn)
+      self._device.add_listener(fn, failures)
 
 
 class NTP(Periodic):
@@ -347,8 +526,107 @@ class NTP(Periodic):
     return True
 
 
+# drives the requests of every remote sensor over one poller, once per tick
+
+class RemotePool(object):
+
+  def __init__(self):
+
+    self._pool = None
+
+
+  def submit(self, req, fn):
+
+    if self._pool == None:
+      self._pool = __import__("webclient").HTTPPool()
+
+    return self._pool.submit(req, fn)
+
+
+  def serve(self):
+
+    if self._pool != None and len(self._pool) > 0:
+      self._pool.serve(0)
+
+
+  # re-resolve one stale dns entry of the requests we make, if none of them
+  # are in flight; this may block, so only call it with time to spare
+
+  def refresh(self):
+
+    m = sys.modules.get("webclient")
+
+    if m == None or (self._pool != None and len(self._pool) > 0):
+      return 0
+
+    return m.refresh()
+
+
+# announces this node and keeps a table of other nodes, so remote sensors can
+# be given a node name instead of a host
+
+class Discovery(Periodic):
+
+  SCHEMA = Periodic.SCHEMA + [ ("_PORT", _INT, 0, 10, 0, 0xffff),
+                               ("_SERVICE_PORT", _INT, 80, 10, 0, 0xffff),
+                               ("_TTL", _INT, 300, 10, 1, 86400),
+                               ("_MAX_NODES", _INT, 8, 10, 1, 64) ]
+
+  def __init__(self, xt, xc, tick_period, xcprefix):
+
+    Periodic.__init__(self, xc, tick_period, xcprefix)
+
+    self._disc = None
+
+    port = xc.get_int(xcprefix + "_PORT", 10, 0)
+    group = xc.get_str(xcprefix + "_GROUP", "")
+
+    if port > 0 and port < 0xffff:
+
+      m = __import__("discovery")
+
+      self._disc = m.Discovery(xt,
+                               name=xc.get_str(xcprefix + "_NAME", ""),
+                               port=port,
+                               service_port=xc.get_int(xcprefix + "_SERVICE_PORT", 10, 80),
+                               group=group if len(group) > 0 else None,
+                               ttl=xc.get_int(xcprefix + "_TTL", 10, 300),
+                               max_nodes=xc.get_int(xcprefix + "_MAX_NODES", 10, 8))
+      self._disc.start()
+
+
+  def _fire(self, now):
+
+    if self._disc == None:
+      return False
+
+    self._disc.announce()
+
+    return True
+
+
+  # answers queries and learns about nodes every tick; announces every interval
+
+  def tick(self, now):
+
+    if self._disc != None:
+      self._disc.serve(now)
+
+    Periodic.tick(self, now)
+
+
+  def resolve(self, name):
+
+    if self._disc == None:
+      return None
+
+    return self._disc.resolve(name)
+
+
 class LED(object):
 
+  SCHEMA = [ ("_INVERT", _BOOL, False, 10, None, None) ]
+
   def __init__(self, xc, xcprefix):
 
     self._dev = None
@@ -382,72 +660,344 @@ class LED(object):
       self._dev.value(self._inv ^ state)
 
 
+# template compiled once into literal segments and variable slots, and
+# rendered into one of two reusable bytearrays, alternately, so that the
+# previous rendering stays intact while it is being sent
+
+class Template(object):
+
+  # template: template string
+  # names: variable names, e.g. "%TS%"
+  # fmts: format string of each variable
+  # ctype: content type; render() returns (ctype, rendered bytes), as served
+  # in a reqmap
+  # null: what values that aren't finite numbers are rendered as, e.g. "null"
+  # in json, instead of however their format has them
+  # width: expected max width of a formatted variable, for the initial buffer size
+
+  def __init__(self, template, names, fmts, ctype, null=None, width=24):
+
+    self._fmts = [ f.encode() for f in fmts ]
+    self._ctype = ctype
+    self._null = null.encode() if null != None else None
+    self._parts = []
+    self._idx = 0
+
+    size = 0
+
+    while len(template) > 0:
+
+      # find the earliest variable in what's left of the template
+
+      j = -1
+      k = -1
+
+      for i, name in enumerate(names):
+        tmp = template.find(name)
+        if tmp >= 0 and (j < 0 or tmp < j):
+          j = tmp
+          k = i
+
+      if j < 0:
+        j = len(template)
+
+      # literal segment, then variable slot
+
+      if j > 0:
+        self._parts.append(template[:j].encode())
+        size = size + j
+
+      if k < 0:
+        break
+
+      self._parts.append(k)
+      size = size + width
+      template = template[j + len(names[k]):]
+
+    self._bufs = [ bytearray(size), bytearray(size) ]
+
+    # what render() last returned for each buffer; returned again as long as
+    # the length of the rendering doesn't change
+
+    self._contents = [ None, None ]
+
+
+  # render with the given variable values
+  # returns (ctype, memoryview over the rendered bytes)
+
+  def render(self, values):
+
+    self._idx = self._idx ^ 1
+
+    buf = self._bufs[self._idx]
+    n = 0
+
+    for part in self._parts:
+
+      # format straight to bytes
+
+      if isinstance(part, int):
+
+        v = values[part]
+
+        if self._null != None and (v != v or v == _INF or v == _NINF):
+          part = self._null
+        else:
+          part = self._fmts[part] % v
+
+      m = n + len(part)
+
+      # too small? replace rather than extend, as the buffer may still be exported
+
+      if m > len(buf):
+        tmp = bytearray(m * 2)
+        tmp[:n] = buf[:n]
+        buf = tmp
+        self._bufs[self._idx] = buf
+        self._contents[self._idx] = None
+
+      buf[n:m] = part
+      n = m
+
+    content = self._contents[self._idx]
+
+    if content == None or len(content[1]) != n:
+      content = (self._ctype, memoryview(buf)[:n])
+      self._contents[self._idx] = content
+
+    return content
+
+
 class WS():
 
+  # binary record, little-endian:
+  #   <magic "CS":2> <version:1> <channels:1> <secs since epoch:4> <float32 value:4> * channels
+
+  BIN_MAGIC = b"CS"
+  BIN_VERSION = 1
+  BIN_CHANNELS = 6
+  BIN_FMT = "<2sBBI6f"
+  BIN_LEN = struct.calcsize(BIN_FMT)
+
+  TYPE_TEXT = "text/plain; charset=iso-8859-1"
+  TYPE_JSON = "application/json"
+  TYPE_BIN = "application/octet-stream"
+  TYPE_PROM = "text/plain; version=0.0.4"
+
+  JSON_TEMPLATE = '{"ts":%TS%,"s1":{"humi":%S1_HUMI%,"temp":%S1_TEMP%,"pres":%S1_PRES%},"s2":{"humi":%S2_HUMI%,"temp":%S2_TEMP%,"pres":%S2_PRES%}}'
+
+  PROM_TEMPLATE = "# TYPE clock_sensor_humidity_percent gauge\n" \
+                  "clock_sensor_humidity_percent{sensor=\"1\"} %S1_HUMI%\n" \
+                  "clock_sensor_humidity_percent{sensor=\"2\"} %S2_HUMI%\n" \
+                  "# TYPE clock_sensor_temperature_celsius gauge\n" \
+                  "clock_sensor_temperature_celsius{sensor=\"1\"} %S1_TEMP%\n" \
+                  "clock_sensor_temperature_celsius{sensor=\"2\"} %S2_TEMP%\n" \
+                  "# TYPE clock_sensor_pressure_hpa gauge\n" \
+                  "clock_sensor_pressure_hpa{sensor=\"1\"} %S1_PRES%\n" \
+                  "clock_sensor_pressure_hpa{sensor=\"2\"} %S2_PRES%\n" \
+                  "# TYPE clock_sensor_last_change_seconds gauge\n" \
+                  "clock_sensor_last_change_seconds %TS%\n"
+
+  PROM_TEMPLATE_HEAP = "# TYPE clock_sensor_heap_free_bytes gauge\n" \
+                       "clock_sensor_heap_free_bytes %HEAP%\n"
+
+  SCHEMA = [ ("_PORT", _INT, 0, 10, 0, 0xffff),
+             ("_TIMEOUT", _INT, 60, 10, 0, 600000),
+             ("_BACKLOG", _INT, 2, 10, 1, 16),
+             ("_MAX_CLIENTS", _INT, 4, 10, 0, 64),
+             ("_MAX_ACCEPT", _INT, 2, 10, 0, 64),
+             ("_REJECT", _BOOL, False, 10, None, None),
+             ("_RATE_LIMIT", _INT, 0, 10, 0, 10000),
+             ("_RATE_BURST", _INT, 5, 10, 1, 10000),
+             ("_RATE_PEERS", _INT, 8, 10, 1, 256),
+             ("_LOG_SIZE", _INT, 0, 10, 0, 0xffff),
+             ("_PROM_INTERVAL", _INT, 15, 10, 0, 86400),
+             ("_COAP_PORT", _INT, 0, 10, 0, 0xffff),
+             ("_COAP_OBSERVERS", _INT, 4, 10, 0, 64) ]
+
   def __init__(self, xt, xc, xcprefix):
 
     self._websrv = None
-    self._vmap = None
+    self._coapsrv = None
+    self._values = None
+    self._reqmap = None
+    self._variants = None
     self._path = xc.get_str(xcprefix + "_PATH", "/")
-    self._template = xc.get_str(xcprefix + "_TEMPLATE", "")
+    self._template = None
+    self._jtemplate = None
+    self._jpath = xc.get_str(xcprefix + "_JSON_PATH", "")
+    self._bpath = xc.get_str(xcprefix + "_BIN_PATH", "")
+    self._ppath = xc.get_str(xcprefix + "_PROM_PATH", "")
+    self._ptemplate = None
+    self._pstale = True
+    self._pinterval = xc.get_int(xcprefix + "_PROM_INTERVAL", 10, 15) * 1000
+    self._pheap = None
+    self._records = None
+    self._bidx = 0
+    self._dirty = False
+    self._gen = 0
 
     port = xc.get_int(xcprefix + "_PORT", 10, 0)
     tout = xc.get_int(xcprefix + "_TIMEOUT", 10, 60)
+    blog = xc.get_int(xcprefix + "_BACKLOG", 10, 2)
+    maxc = xc.get_int(xcprefix + "_MAX_CLIENTS", 10, 4)
+    maxa = xc.get_int(xcprefix + "_MAX_ACCEPT", 10, 2)
+    rjct = xc.get_bool(xcprefix + "_REJECT", False)
+    rlim = xc.get_int(xcprefix + "_RATE_LIMIT", 10, 0)
+    rbst = xc.get_int(xcprefix + "_RATE_BURST", 10, 5)
+    rpeers = xc.get_int(xcprefix + "_RATE_PEERS", 10, 8)
+    lsize = xc.get_int(xcprefix + "_LOG_SIZE", 10, 0)
+    lpath = xc.get_str(xcprefix + "_LOG_PATH", "")
+    cport = xc.get_int(xcprefix + "_COAP_PORT", 10, 0)
+    cobs = xc.get_int(xcprefix + "_COAP_OBSERVERS", 10, 4)
 
     if port > 0 and port < 0xffff and len(self._path) > 0:
 
-      # init vmap
-
-      self._vmap = [
-        [0, "%TS%", "%16d", False],
-        [0.0, "%S1_HUMI%", "%7.3f", False],
-        [0.0, "%S1_TEMP%", "%7.3f", False],
-        [0.0, "%S1_PRES%", "%8.3f", False],
-        [0.0, "%S2_HUMI%", "%7.3f", False],
-        [0.0, "%S2_TEMP%", "%7.3f", False],
-        [0.0, "%S2_PRES%", "%8.3f", False]
+      # init vmap: name, text format, json format, prometheus format
+      # values are kept apart, in the same order, so that they can be
+      # rendered as they are
+
+      vmap = [
+        ["%TS%", "%16d", "%d", "%d"],
+        ["%S1_HUMI%", "%7.3f", "%.3f", "%.3f"],
+        ["%S1_TEMP%", "%7.3f", "%.3f", "%.3f"],
+        ["%S1_PRES%", "%8.3f", "%.3f", "%.3f"],
+        ["%S2_HUMI%", "%7.3f", "%.3f", "%.3f"],
+        ["%S2_TEMP%", "%7.3f", "%.3f", "%.3f"],
+        ["%S2_PRES%", "%8.3f", "%.3f", "%.3f"],
+        ["%HEAP%", "%d", "%d", "%d"]
       ]
 
-      for vm in self._vmap:
-        vm[3] = self._template.find(vm[1]) >= 0
+      self._values = [ 0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0 ]
+
+      # compile templates
+
+      names = [ vm[0] for vm in vmap ]
+      jtemplate = xc.get_str(xcprefix + "_JSON_TEMPLATE", "")
+
+      if len(jtemplate) == 0:
+        jtemplate = WS.JSON_TEMPLATE
+
+      # free heap is only for prometheus, as it's only kept current there
+
+      self._template = Template(xc.get_str(xcprefix + "_TEMPLATE", "") + "\r\n", names[:7], [ vm[1] for vm in vmap ], WS.TYPE_TEXT)
+      self._jtemplate = Template(jtemplate, names[:7], [ vm[2] for vm in vmap ], WS.TYPE_JSON, "null")
+
+      # prometheus exposition, with free heap where the port can tell us
+
+      if len(self._ppath) > 0:
+
+        ptemplate = WS.PROM_TEMPLATE
+
+        if hasattr(gc, "mem_free"):
+          ptemplate = ptemplate + WS.PROM_TEMPLATE_HEAP
+          self._pheap = 0
+
+        self._ptemplate = Template(ptemplate, names, [ vm[3] for vm in vmap ], WS.TYPE_PROM)
+
+      # init binary records, as served
+      # renders alternate between the two, like the templates' buffers; see
+      # serve() for when a buffer can be reused
+
+      self._records = [ (WS.TYPE_BIN, bytearray(WS.BIN_LEN)), (WS.TYPE_BIN, bytearray(WS.BIN_LEN)) ]
+
+      # init reqmap; json and binary are served on the main path if asked
+      # for in the accept header, or on their own paths
+      # built once; renders only put their contents in it
+
+      self._variants = [ None, None, None ]
+      self._reqmap = { self._path: self._variants }
 
       # init ws
 
       m = __import__("webserver")
-      self._websrv = m.Webserver(xt, port=port, timeout=tout)
+      self._websrv = m.Webserver(xt, port=port, backlog=blog, timeout=tout, max_clients=maxc, max_accept=maxa, reject=rjct, rate_limit=rlim, rate_burst=rbst, rate_peers=rpeers, log_size=lsize, log_path=lpath if len(lpath) > 0 else None)
+
+      # init coap server, which serves the same reqmap
+
+      if cport > 0 and cport < 0xffff:
+        m = __import__("coapserver")
+        self._coapsrv = m.CoAPServer(xt, port=cport, max_observers=cobs)
 
       # start
 
-      self.set(None, None, None)
+      self._render()
       self._websrv.start()
 
+      if self._coapsrv != None:
+        self._coapsrv.start()
+
+
+  # only updates values; rendering is left to serve(), so that readings that
+  # arrive in the same tick are rendered together, once
 
   def set(self, now, htp1, htp2):
 
     if self._websrv == None:
       return
 
-    # update vmap
+    # update values; prometheus exposition is only stale if a reading changed
 
     if now != None:
-      self._vmap[0][0] = (now // 1000) + xtime.EPOCH_OFFSET
+      self._values[0] = (now // 1000) + xtime.EPOCH_OFFSET
 
     for i in range(0, 3):
-      if htp1 != None:
-        self._vmap[i + 1][0] = htp1[i]
-      if htp2 !=  None:
-       self._vmap[i + 4][0] = htp2[i]
+      if htp1 != None and self._values[i + 1] != htp1[i]:
+        self._values[i + 1] = htp1[i]
+        self._pstale = True
+      if htp2 != None and self._values[i + 4] != htp2[i]:
+        self._values[i + 4] = htp2[i]
+        self._pstale = True
+
+    self._dirty = True
+
+
+  def _render(self):
+
+    values = self._values
+
+    # render templates
+
+    text = self._template.render(values)
+    json = self._jtemplate.render(values)
+
+    # generate binary record
+
+    self._bidx = self._bidx ^ 1
+
+    record = self._records[self._bidx]
+    struct.pack_into(WS.BIN_FMT, record[1], 0, WS.BIN_MAGIC, WS.BIN_VERSION, WS.BIN_CHANNELS, values[0] & 0xffffffff, values[1], values[2], values[3], values[4], values[5], values[6])
+
+    # put them in the reqmap
+
+    self._variants[0] = text
+    self._variants[1] = json
+    self._variants[2] = record
+
+    if len(self._jpath) > 0:
+      self._reqmap[self._jpath] = json
 
-    # generate content string
+    if len(self._bpath) > 0:
+      self._reqmap[self._bpath] = record
 
-    content = self._template
+    # prometheus exposition is only re-rendered when a reading changes, or
+    # the free heap is due a refresh, so a scrape costs no more than sending
+    # the cached buffer
 
-    for i in filter(lambda x: x[3], self._vmap):
-      content = content.replace(i[1], i[2] % (i[0],))
+    if self._ptemplate != None and self._pstale:
+      self._pstale = False
+      values[7] = gc.mem_free() if hasattr(gc, "mem_free") else 0
+      self._reqmap[self._ppath] = self._ptemplate.render(values)
 
-    # set new reqmap
+    self._websrv.set(self._reqmap)
 
-    self._websrv.set( { self._path: content + "\r\n" } )
+    self._gen = self._websrv.generation()
+    self._dirty = False
+
+    # this also notifies any coap observers
+
+    if self._coapsrv != None:
+      self._coapsrv.set(self._reqmap)
 
 
   def serve(self, now):
@@ -455,4 +1005,265 @@ class WS():
     if self._websrv == None:
       return
 
+    # free heap changes without any reading changing, so it gets a render of
+    # its own every interval secs; by time rather than by ticks, as the tick
+    # period says nothing about how long a loop actually takes
+
+    if self._pheap != None and self._pinterval > 0 and now != None and (now - self._pheap >= self._pinterval or now < self._pheap):
+      self._pheap = now
+      self._pstale = True
+      self._dirty = True
+
+    # the next render overwrites the buffers that were replaced by the last
+    # one, so wait until no client is still sending from them
+
+    if self._dirty and self._websrv.oldest() >= self._gen:
+      self._render()
+
     self._websrv.serve(now)
+
+    if self._coapsrv != None:
+      self._coapsrv.serve(now)
+
+
+  def flush_log(self, fn, count=0):
+
+    if self._websrv == None:
+      return 0
+
+    return self._websrv.flush_log(fn, count)
+
+
+# flushes webserver access log entries in batches, away from WS.serve()
+
+class WSLog(Periodic):
+
+  SCHEMA = Periodic.SCHEMA + [ ("_BATCH", _INT, 8, 10, 1, 256) ]
+
+  def __init__(self, ws, xc, tick_period, xcprefix):
+
+    Periodic.__init__(self, xc, tick_period, xcprefix)
+
+    self._ws = ws
+    self._batch = xc.get_int(xcprefix + "_BATCH", 10, 8)
+    self._path = xc.get_str(xcprefix + "_FILE", "")
+
+
+  def _fire(self, now):
+
+    # no file given means console
+
+    if len(self._path) == 0:
+      self._ws.flush_log(lambda x: print("[websrv] %s" % (x.rstrip())), self._batch)
+      return True
+
+    f = None
+
+    try:
+      f = open(self._path, "a")
+    except:
+      return False
+
+    self._ws.flush_log(f.write, self._batch)
+    f.close()
+
+    return True
+
+
+# batches readings, and uploads them in a single POST every _BATCH readings or
+# every _INTERVAL secs, whichever comes first
+# a batch keeps its id until the server accepts it, so the server can tell a
+# retried batch from a new one; readings that arrive while a batch is being
+# retried go into the next one, and are dropped if that fills up too
+# a batch is identified by node id, boot nonce and batch id together: the
+# nonce is random on every boot, and batch ids count up from 0 within a boot,
+# so neither a reboot nor another node can repeat one
+# records taken before the clock was set are flagged as such; failed readings
+# are not recorded at all
+#
+# batch, little-endian:
+#   <magic "CU":2> <version:1> <reserved:1> <node id:8> <boot nonce:4> <batch id:4> <count:2>
+#   then count records of:
+#   <secs since epoch:4> <sensor:1> <flags:1> <float32 value:4> * 3
+
+class Uploader(Periodic):
+
+  HDR_MAGIC = b"CU"
+  HDR_VERSION = 2
+  HDR_FMT = "<2sBB8s4sIH"
+  HDR_LEN = struct.calcsize(HDR_FMT)
+  REC_FMT = "<IBB3f"
+  REC_LEN = struct.calcsize(REC_FMT)
+
+  # record flags
+
+  REC_UNSYNCED = 0x01
+
+  # anything earlier than this, 2026-01-01, is a clock that hasn't been set
+
+  TS_MIN = 1767225600
+
+  TYPE = "application/octet-stream"
+
+  SCHEMA = Periodic.SCHEMA + [ ("_PORT", _INT, 80, 10, 0, 0xffff),
+                               ("_TIMEOUT", _INT, 30000, 10, 0, 600000),
+                               ("_BACKOFF_MAX", _INT, 300, 10, 0, 86400),
+                               ("_TLS", _BOOL, False, 10, None, None),
+                               ("_BATCH", _INT, 16, 10, 1, 0xffff) ]
+
+  def __init__(self, xt, xc, tick_period, xcprefix, pool=None):
+
+    Periodic.__init__(self, xc, tick_period, xcprefix)
+
+    self._webclt = None
+    self._backoff = None
+    self._pool = pool
+
+    # two buffers: one being filled, and one with the batch being uploaded
+
+    self._bufs = None
+    self._counts = [ 0, 0 ]
+    self._idx = 0
+    self._body = None
+    self._pending = False
+    self._inflight = False
+    self._dropped = 0
+
+    host = xc.get_str(xcprefix + "_HOST", "")
+    port = xc.get_int(xcprefix + "_PORT", 10, 80)
+    path = xc.get_str(xcprefix + "_PATH", "/")
+    tout = xc.get_int(xcprefix + "_TIMEOUT", 10, 30000)
+    bmax = xc.get_int(xcprefix + "_BACKOFF_MAX", 10, 300)
+    tls = True if xc.get_bool(xcprefix + "_TLS", False) else None
+
+    self._batch = xc.get_int(xcprefix + "_BATCH", 10, 16)
+
+    if len(host) == 0 or port <= 0 or port >= 0xffff or len(path) == 0 or self._batch <= 0 or self._batch > 0xffff:
+      return
+
+    m = __import__("webclient")
+
+    self._webclt = m.HTTPRequest(xt=xt, total_timeout=tout, tls=tls)
+    self._webclt.set(host, path, port, "POST")
+    self._webclt.resolve()
+    self._backoff = m.Backoff(xt, max_delay=bmax * 1000)
+
+    size = Uploader.HDR_LEN + self._batch * Uploader.REC_LEN
+
+    self._bufs = [ bytearray(size), bytearray(size) ]
+
+    self._node = _node_id()
+    self._nonce = _nonce(xt)
+    self._id = 0
+
+
+  # listener: fn(now, htp)
+
+  def add(self, now, sensor, htp):
+
+    if self._webclt == None:
+      return
+
+    n = self._counts[self._idx]
+
+    if n >= self._batch:
+      self._dropped = self._dropped + 1
+      return
+
+    ts = (now // 1000) + xtime.EPOCH_OFFSET
+
+    struct.pack_into(Uploader.REC_FMT, self._bufs[self._idx], Uploader.HDR_LEN + n * Uploader.REC_LEN, ts & 0xffffffff, sensor, Uploader.REC_UNSYNCED if ts < Uploader.TS_MIN else 0, htp[0], htp[1], htp[2])
+
+    self._counts[self._idx] = n + 1
+
+    # full; send it now if we can
+
+    if n + 1 >= self._batch:
+      self._flush()
+
+
+  # freeze the buffer being filled as the next batch, and start filling the other
+
+  def _flush(self):
+
+    n = self._counts[self._idx]
+
+    if self._pending or n == 0:
+      return False
+
+    buf = self._bufs[self._idx]
+
+    struct.pack_into(Uploader.HDR_FMT, buf, 0, Uploader.HDR_MAGIC, Uploader.HDR_VERSION, 0, self._node, self._nonce, self._id, n)
+
+    self._body = memoryview(buf)[:Uploader.HDR_LEN + n * Uploader.REC_LEN]
+    self._pending = True
+
+    self._idx = self._idx ^ 1
+    self._counts[self._idx] = 0
+
+    return True
+
+
+  def _send(self):
+
+    self._inflight = True
+    self._webclt.set_body(self._body, Uploader.TYPE)
+
+    if self._pool != None:
+      self._pool.submit(self._webclt, self._done)
+
+
+  # called with the return value of request(), by the pool or by us
+
+  def _done(self, req, rv):
+
+    # not done yet
+
+    if rv[0] == 0 and rv[1] != 10:
+      return
+
+    self._inflight = False
+
+    ok = rv[0] == 0 and req.get_response()[0][0] // 100 == 2
+
+    req.reset()
+
+    # accepted; only now does the next batch get a new id
+
+    if ok:
+      self._backoff.success()
+      self._pending = False
+      self._body = None
+      self._id = (self._id + 1) & 0xffffffff
+    else:
+      self._backoff.failure()
+
+
+  def _fire(self, now):
+
+    if self._webclt == None:
+      return False
+
+    self._flush()
+
+    return True
+
+
+  # uploads are started and driven every tick; flushed every interval
+
+  def tick(self, now):
+
+    if self._webclt != None:
+
+      if self._inflight and self._pool == None:
+        self._done(self._webclt, self._webclt.request())
+
+      if self._pending and not self._inflight and self._backoff.ready():
+        self._send()
+
+    Periodic.tick(self, now)
+
+
+  def dropped(self):
+
+    return self._dropped
@@ -20,20 +20,54 @@ wifi.connect(verbose=True)
 # initialise stuff
 
 xt = xtime.XTime()
-xc = xconfig.XConfig(path="clock_sensor.conf")
+xc = xconfig.XConfig(path="clock_sensor.conf", module="clock_sensor_conf")
+
+# check config params once, before anything reads them
+
+xc.declare([ ("I2C_BUS", xc.INT, 0, 10, 0, 8),
+             ("I2C_PIN_SDA", xc.INT, 0, 10, 0, 64),
+             ("I2C_PIN_SCL", xc.INT, 0, 10, 0, 64),
+             ("TICK_PERIOD", xc.INT, 1000, 10, 10, 60000) ])
+
+cs.declare(xc, "DISCOVERY", cs.Discovery.SCHEMA)
+cs.declare(xc, "SENSOR1", cs.ModDevice.SCHEMA)
+cs.declare(xc, "SENSOR2", cs.ModDevice.SCHEMA)
+cs.declare(xc, "DISPLAY", cs.ModDevice.SCHEMA)
+cs.declare(xc, "WEBSRV", cs.WS.SCHEMA)
+cs.declare(xc, "WEBSRV_LOG", cs.WSLog.SCHEMA)
+cs.declare(xc, "UPLOAD", cs.Uploader.SCHEMA)
+cs.declare(xc, "NTP", cs.NTP.SCHEMA)
+cs.declare(xc, "LED", cs.LED.SCHEMA)
+
+for e in xc.validate():
+  print("[config] %s" % (e))
+
 xm = xmachine.XMachine(bus=xc.get_int("I2C_BUS"), sda=xc.get_int("I2C_PIN_SDA"), scl=xc.get_int("I2C_PIN_SCL"))
 
 tick_period = xc.get_int("TICK_PERIOD", 10, 1000)
 
+# init node discovery
+
+discovery = cs.Discovery(xt, xc, tick_period, "DISCOVERY")
+
+# init remote sensor request pool
+
+pool = cs.RemotePool()
+
 # init devices
 
-sensor1 = cs.ModDevice(xm, xt, xc, tick_period, "SENSOR1")
-sensor2 = cs.ModDevice(xm, xt, xc, tick_period, "SENSOR2")
+sensor1 = cs.ModDevice(xm, xt, xc, tick_period, "SENSOR1", discovery, pool)
+sensor2 = cs.ModDevice(xm, xt, xc, tick_period, "SENSOR2", discovery, pool)
 display = cs.ModDevice(xm, xt, xc, tick_period, "DISPLAY")
 
 # init webserver
 
 websrv = cs.WS(xt, xc, "WEBSRV")
+wslog = cs.WSLog(websrv, xc, tick_period, "WEBSRV_LOG")
+
+# init reading uploads
+
+uploader = cs.Uploader(xt, xc, tick_period, "UPLOAD", pool)
 
 # init ntp sync
 
@@ -55,6 +89,9 @@ sensor1.add_listener(lambda x, y: websrv.set(x, y, None))
 sensor2.add_listener(lambda x, y: display.set(x, None, y))
 sensor2.add_listener(lambda x, y: websrv.set(x, None, y))
 
+sensor1.add_listener(lambda x, y: uploader.add(x, 1, y), False)
+sensor2.add_listener(lambda x, y: uploader.add(x, 2, y), False)
+
 # start main loop
 
 while True:
@@ -66,6 +103,14 @@ while True:
 
   led.set(True)
 
+  # answer and announce to other nodes
+
+  discovery.tick(t_now)
+
+  # drive pending remote sensor requests
+
+  pool.serve()
+
   # run periodic stuff
 
   display.tick(t_now)
@@ -77,6 +122,14 @@ while True:
 
   websrv.serve(t_now)
 
+  # flush webserver access log
+
+  wslog.tick(t_now)
+
+  # upload batched readings
+
+  uploader.tick(t_now)
+
   # sync time
 
   ntp.tick(t_now)
@@ -85,6 +138,12 @@ while True:
 
   led.set(False)
 
+  # with at least half the tick period to spare, refresh a stale dns entry;
+  # this is the only place a lookup may block
+
+  if xt.tp_diff(xt.tp_now(), t_start) < tick_period // 2:
+    pool.refresh()
+
   # sleep until the end of the tick period
 
   t_diff = xt.tp_diff(xt.tp_now(), t_start)
@@ -0,0 +1,586 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2022 Vino Fernando Crescini <vfcrescini@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# 2026-10-19 coapserver.py
+
+# quick-and-dirty tick-based CoAP server (RFC 7252), with Observe (RFC 7641)
+# serves the same kind of request map as webserver.Webserver
+# no block-wise transfers, so content has to fit in a single datagram
+
+
+import socket
+
+import xpoll
+
+
+_DEFAULT_PORT = 5683
+_DEFAULT_MAX_OBSERVERS = 4
+_DEFAULT_MAX_RECV = 4
+_DEFAULT_CON_INTERVAL = 86400000
+_DEFAULT_REQMAP = {"/" : ""}
+
+_MAX_DATAGRAM = 1152
+
+_ACK_TIMEOUT = 2000
+_MAX_RETRANSMIT = 4
+
+_VERSION = 1
+
+TYPE_CON = 0
+TYPE_NON = 1
+TYPE_ACK = 2
+TYPE_RST = 3
+
+CODE_GET = 0x01
+CODE_CONTENT = 0x45
+CODE_BAD_REQUEST = 0x80
+CODE_BAD_OPTION = 0x82
+CODE_NOT_FOUND = 0x84
+CODE_METHOD_NOT_ALLOWED = 0x85
+CODE_NOT_ACCEPTABLE = 0x86
+CODE_INTERNAL_SERVER_ERROR = 0xa0
+
+OPT_URI_HOST = 3
+OPT_OBSERVE = 6
+OPT_URI_PORT = 7
+OPT_URI_PATH = 11
+OPT_CONTENT_FORMAT = 12
+OPT_URI_QUERY = 15
+OPT_ACCEPT = 17
+
+FORMAT_TEXT = 0
+FORMAT_LINK = 40
+FORMAT_BINARY = 42
+FORMAT_JSON = 50
+
+_FORMATS = {
+  "text/plain" : FORMAT_TEXT,
+  "application/link-format" : FORMAT_LINK,
+  "application/octet-stream" : FORMAT_BINARY,
+  "application/json" : FORMAT_JSON
+}
+
+# critical options we understand, or at least can safely ignore
+
+_KNOWN_CRITICAL = (OPT_URI_HOST, OPT_URI_PORT, OPT_URI_PATH, OPT_URI_QUERY, OPT_ACCEPT)
+
+_WELL_KNOWN_CORE = "/.well-known/core"
+
+
+# encode an unsigned int option value in as few bytes as possible
+
+def _uint(value):
+
+  b = b""
+
+  while value > 0:
+    b = bytes([value & 0xff]) + b
+    value = value >> 8
+
+  return b
+
+
+# encode one option, given the delta from the previous option number
+
+def _option(delta, value):
+
+  hdr = [ 0 ]
+
+  for n, shift in ((delta, 4), (len(value), 0)):
+    if n < 13:
+      hdr[0] = hdr[0] | (n << shift)
+    elif n < 269:
+      hdr[0] = hdr[0] | (13 << shift)
+      hdr.append(n - 13)
+    else:
+      hdr[0] = hdr[0] | (14 << shift)
+      hdr.append((n - 269) >> 8)
+      hdr.append((n - 269) & 0xff)
+
+  return bytes(hdr) + value
+
+
+# build a message
+#   options: [ (number, value bytes), ... ], sorted by number
+
+def encode(mtype, code, mid, token, options, payload=b""):
+
+  parts = [ bytes([(_VERSION << 6) | (mtype << 4) | len(token), code, mid >> 8, mid & 0xff]), token ]
+  last = 0
+
+  for number, value in options:
+    parts.append(_option(number - last, value))
+    last = number
+
+  if len(payload) > 0:
+    parts.append(b"\xff")
+    parts.append(bytes(payload))
+
+  return b"".join(parts)
+
+
+# parse a message
+#   returns (type, code, mid, token, [ (number, value bytes), ... ], payload)
+#   or None if the message is malformed
+
+def decode(msg):
+
+  if len(msg) < 4 or msg[0] >> 6 != _VERSION:
+    return None
+
+  mtype = (msg[0] >> 4) & 0x03
+  tkl = msg[0] & 0x0f
+  code = msg[1]
+  mid = (msg[2] << 8) | msg[3]
+
+  if tkl > 8 or len(msg) < 4 + tkl:
+    return None
+
+  token = bytes(msg[4:4 + tkl])
+  options = []
+  number = 0
+  i = 4 + tkl
+
+  while i < len(msg):
+
+    # a payload marker with no payload is a format error too
+
+    if msg[i] == 0xff:
+      if i + 1 == len(msg):
+        return None
+      return mtype, code, mid, token, options, bytes(msg[i + 1:])
+
+    delta = msg[i] >> 4
+    length = msg[i] & 0x0f
+    i = i + 1
+
+    # extended delta and length
+
+    vals = [ delta, length ]
+
+    for j in range(0, 2):
+      if vals[j] == 13:
+        if i >= len(msg):
+          return None
+        vals[j] = msg[i] + 13
+        i = i + 1
+      elif vals[j] == 14:
+        if i + 1 >= len(msg):
+          return None
+        vals[j] = ((msg[i] << 8) | msg[i + 1]) + 269
+        i = i + 2
+      elif vals[j] == 15:
+        return None
+
+    number = number + vals[0]
+
+    if i + vals[1] > len(msg):
+      return None
+
+    options.append((number, bytes(msg[i:i + vals[1]])))
+    i = i + vals[1]
+
+  return mtype, code, mid, token, options, b""
+
+
+def _get_uint(value):
+
+  n = 0
+
+  for b in value:
+    n = (n << 8) | b
+
+  return n
+
+
+# content type string to content format number, or -1 if there isn't one
+
+def _format(ctype):
+
+  return _FORMATS.get(ctype.split(";", 1)[0].strip(), -1)
+
+
+class CoAPServer(object):
+
+  # max_observers: max number of observe registrations, oldest is dropped when full
+  # max_recv: max number of datagrams handled per serve() pass
+  # con_interval: max msecs between confirmable notifications to an observer;
+  #               one that doesn't ack one is dropped (RFC 7641 section 4.5)
+
+  def __init__(self, xt, port=_DEFAULT_PORT, max_observers=_DEFAULT_MAX_OBSERVERS, max_recv=_DEFAULT_MAX_RECV, con_interval=_DEFAULT_CON_INTERVAL):
+
+    self._xt = xt
+    self._port = port
+    self._max_observers = max_observers
+    self._max_recv = max_recv
+    self._con_interval = con_interval
+
+    self._reqmap = None
+    self._sock = None
+    self._poller = None
+    self._mid = 0
+    self._seq = 0
+
+    # observers: [ [addr, token, path, accept, mid of last notification,
+    #                time of last confirmable notification,
+    #                unacked confirmable notification or None,
+    #                retransmissions of it so far, time it was last sent], ... ]
+    # dirty: paths whose observers need to be notified
+
+    self._observers = []
+    self._dirty = set()
+
+    self.clear()
+
+
+  # same request map format as webserver.Webserver.set()
+
+  def set(self, reqmap):
+
+    self._reqmap.update(reqmap)
+
+    for path in reqmap:
+      self._dirty.add(path)
+
+
+  def clear(self):
+
+    self._reqmap = _DEFAULT_REQMAP.copy()
+
+
+  def start(self):
+
+    self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._sock.bind(socket.getaddrinfo("0", self._port, socket.AF_INET, socket.SOCK_DGRAM)[0][-1])
+    self._sock.setblocking(False)
+
+    self._poller = xpoll.XPoll()
+    self._poller.register(self._sock, xpoll.POLLIN)
+
+    self._mid = self._xt.time_ms() & 0xffff
+
+
+  def stop(self):
+
+    self._sock.close()
+    self._sock = None
+
+    self._poller.close()
+    self._poller = None
+
+    self._observers = []
+    self._dirty = set()
+
+
+  def _next_mid(self):
+
+    self._mid = (self._mid + 1) & 0xffff
+
+    return self._mid
+
+
+  def _sendto(self, msg, addr):
+
+    try:
+      self._sock.sendto(msg, addr)
+    except:
+      return False
+
+    return True
+
+
+  # resolve path to (code, content format, payload)
+
+  def _content(self, path, accept):
+
+    if path == _WELL_KNOWN_CORE:
+      return CODE_CONTENT, FORMAT_LINK, ",".join([ "<%s>;obs" % (x) for x in sorted(self._reqmap) ]).encode()
+
+    if path not in self._reqmap:
+      return CODE_NOT_FOUND, -1, b""
+
+    content = self._reqmap[path]
+    cformat = FORMAT_TEXT
+
+    # pick a variant; with no accept option, the first one
+
+    if isinstance(content, list):
+
+      tmp = content[0]
+
+      if accept >= 0:
+        tmp = None
+        for v in content:
+          if _format(v[0]) == accept:
+            tmp = v
+            break
+
+      if tmp == None:
+        return CODE_NOT_ACCEPTABLE, -1, b""
+
+      content = tmp
+
+    if isinstance(content, tuple):
+      cformat = _format(content[0])
+      content = content[1]
+    elif not isinstance(content, str):
+      cformat = FORMAT_BINARY
+
+    # file-backed content, e.g. webserver.File; small ones only
+
+    if hasattr(content, "size") and hasattr(content, "open"):
+
+      if content.size() < 0:
+        return CODE_NOT_FOUND, -1, b""
+
+      if content.size() > _MAX_DATAGRAM - 64:
+        return CODE_INTERNAL_SERVER_ERROR, -1, b""
+
+      try:
+        f = content.open()
+        content = f.read()
+        f.close()
+      except:
+        return CODE_INTERNAL_SERVER_ERROR, -1, b""
+
+    if not isinstance(content, (str, bytes, bytearray, memoryview)):
+      return CODE_INTERNAL_SERVER_ERROR, -1, b""
+
+    if accept >= 0 and cformat >= 0 and cformat != accept:
+      return CODE_NOT_ACCEPTABLE, -1, b""
+
+    if isinstance(content, str):
+      content = content.encode()
+
+    if len(content) > _MAX_DATAGRAM - 64:
+      return CODE_INTERNAL_SERVER_ERROR, -1, b""
+
+    return CODE_CONTENT, cformat, content
+
+
+  def _response(self, mtype, mid, token, code, cformat, payload, observe=-1):
+
+    options = []
+
+    if observe >= 0:
+      options.append((OPT_OBSERVE, _uint(observe)))
+
+    if cformat >= 0:
+      options.append((OPT_CONTENT_FORMAT, _uint(cformat)))
+
+    return encode(mtype, code, mid, token, options, payload)
+
+
+  def _observe(self, now, addr, token, path, accept):
+
+    # re-registration replaces the existing entry
+
+    self._forget(addr, token)
+
+    if self._max_observers <= 0:
+      return False
+
+    if len(self._observers) >= self._max_observers:
+      self._observers.pop(0)
+
+    self._observers.append([ addr, token, path, accept, -1, now, None, 0, 0 ])
+
+    return True
+
+
+  def _forget(self, addr, token):
+
+    for o in list(self._observers):
+      if o[0] == addr and o[1] == token:
+        self._observers.remove(o)
+
+
+  def _handle(self, now, msg, addr):
+
+    m = decode(msg)
+
+    # malformed; reject if it at least has a message id
+
+    if m == None:
+      if len(msg) >= 4:
+        self._sendto(encode(TYPE_RST, 0, (msg[2] << 8) | msg[3], b"", []), addr)
+      return
+
+    mtype, code, mid, token, options, payload = m
+
+    # a reset in reply to a notification cancels the observation
+
+    if mtype == TYPE_RST:
+      for o in list(self._observers):
+        if o[0] == addr and o[4] == mid:
+          self._observers.remove(o)
+      return
+
+    # an ack to a confirmable notification
+
+    if mtype == TYPE_ACK:
+      for o in self._observers:
+        if o[0] == addr and o[4] == mid:
+          o[6] = None
+      return
+
+    # empty confirmable message, i.e. a ping, gets a reset
+
+    if code == 0:
+      if mtype == TYPE_CON:
+        self._sendto(encode(TYPE_RST, 0, mid, b"", []), addr)
+      return
+
+    # ignore responses
+
+    if code >> 5 != 0:
+      return
+
+    rtype = TYPE_ACK if mtype == TYPE_CON else TYPE_NON
+    rmid = mid if mtype == TYPE_CON else self._next_mid()
+
+    # collect what we need from the options
+
+    segments = []
+    accept = -1
+    observe = -1
+
+    for number, value in options:
+
+      if number == OPT_URI_PATH:
+        try:
+          segments.append(value.decode())
+        except:
+          self._sendto(self._response(rtype, rmid, token, CODE_BAD_REQUEST, -1, b""), addr)
+          return
+      elif number == OPT_ACCEPT:
+        accept = _get_uint(value)
+      elif number == OPT_OBSERVE:
+        observe = _get_uint(value)
+      elif number & 0x01 and number not in _KNOWN_CRITICAL:
+        self._sendto(self._response(rtype, rmid, token, CODE_BAD_OPTION, -1, b""), addr)
+        return
+
+    if code != CODE_GET:
+      self._sendto(self._response(rtype, rmid, token, CODE_METHOD_NOT_ALLOWED, -1, b""), addr)
+      return
+
+    path = "/" + "/".join(segments)
+    code, cformat, payload = self._content(path, accept)
+
+    # observe: 0 registers, 1 deregisters
+
+    seq = -1
+
+    if observe == 0 and code == CODE_CONTENT and path != _WELL_KNOWN_CORE:
+      if self._observe(now, addr, token, path, accept):
+        seq = self._seq
+    elif observe == 1:
+      self._forget(addr, token)
+
+    self._sendto(self._response(rtype, rmid, token, code, cformat, payload, seq), addr)
+
+
+  def _notify(self, now):
+
+    if len(self._dirty) == 0:
+      return
+
+    dirty = self._dirty
+    self._dirty = set()
+
+    if len(self._observers) == 0:
+      return
+
+    self._seq = (self._seq + 1) & 0xffffff
+
+    for o in list(self._observers):
+
+      if o[2] not in dirty:
+        continue
+
+      code, cformat, payload = self._content(o[2], o[3])
+
+      # resource gone or no longer acceptable; final response without observe
+
+      seq = self._seq if code == CODE_CONTENT else -1
+
+      o[4] = self._next_mid()
+
+      # confirmable every con_interval, or if the last one is still unacked,
+      # in which case this one takes its place, retransmission count and all
+
+      if seq >= 0 and (o[6] != None or now - o[5] >= self._con_interval or now < o[5]):
+
+        if o[6] == None:
+          o[5] = now
+          o[7] = 0
+          o[8] = now
+
+        o[6] = self._response(TYPE_CON, o[4], o[1], code, cformat, payload, seq)
+        self._sendto(o[6], o[0])
+
+        continue
+
+      if not self._sendto(self._response(TYPE_NON, o[4], o[1], code, cformat, payload, seq), o[0]) or seq < 0:
+        self._observers.remove(o)
+
+
+  # retransmit unacked confirmable notifications, with exponential back-off
+  # an observer that never acks is assumed to have gone away
+
+  def _retransmit(self, now):
+
+    for o in list(self._observers):
+
+      if o[6] == None:
+        continue
+
+      if now - o[8] < (_ACK_TIMEOUT << o[7]) and now >= o[8]:
+        continue
+
+      if o[7] >= _MAX_RETRANSMIT:
+        self._observers.remove(o)
+        continue
+
+      o[7] = o[7] + 1
+      o[8] = now
+
+      self._sendto(o[6], o[0])
+
+
+  # now is assumed to be an int representing the millisecs since epoch, or None
+
+  def serve(self, now=None):
+
+    if self._sock == None:
+      return
+
+    if now == None:
+      now = self._xt.time_ms()
+
+    # changes made before this pass go to the observers registered before it
+
+    self._notify(now)
+
+    for i in range(0, self._max_recv):
+
+      if self._poller.events(0) & xpoll.POLLIN == 0:
+        break
+
+      try:
+        msg, addr = self._sock.recvfrom(_MAX_DATAGRAM)
+      except:
+        break
+
+      # whatever is wrong with one datagram is no reason to stop serving
+
+      try:
+        self._handle(now, msg, addr)
+      except:
+        pass
+
+    self._retransmit(now)
@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2022 Vino Fernando Crescini <vfcrescini@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# 2026-10-19 discovery.py
+
+# quick-and-dirty tick-based node discovery over UDP broadcast or multicast
+# nodes announce "<name> <port>" periodically and answer queries for their name,
+# so others can find them without hardcoded addresses or DHCP reservations
+#
+# datagrams are single lines of ascii text:
+#   announcement or answer : "CSD1 A <name> <port> <ttl secs>"
+#   query                  : "CSD1 Q <name>", where name "*" matches every node
+
+
+import socket
+
+import xpoll
+
+
+_DEFAULT_PORT = 7665
+_DEFAULT_TTL = 300
+_DEFAULT_MAX_NODES = 8
+_DEFAULT_MAX_RECV = 4
+_DEFAULT_QUERY_INTERVAL = 5000
+
+_BROADCAST = "255.255.255.255"
+
+_MAX_DATAGRAM = 128
+
+_MAGIC = "CSD1"
+
+
+def _inet_aton(addr):
+
+  return bytes([ int(x) for x in addr.split(".") ])
+
+
+# names are printable ascii, without spaces
+
+def _valid(name):
+
+  for c in name:
+    if c <= " " or c > "~":
+      return False
+
+  return True
+
+
+class Discovery(object):
+
+  # name: this node's name; empty means resolve only, never announce or answer
+  # port: udp port all nodes use for discovery
+  # service_port: port this node's service is on, given out with its name
+  # group: multicast group to use; None means broadcast
+  # ttl: secs other nodes should keep this node in their tables
+  # max_nodes: size of the node table; soonest to expire is evicted when full
+
+  def __init__(self, xt, name="", port=_DEFAULT_PORT, service_port=80, group=None, ttl=_DEFAULT_TTL, max_nodes=_DEFAULT_MAX_NODES, max_recv=_DEFAULT_MAX_RECV):
+
+    self._xt = xt
+    self._name = name
+    self._port = port
+    self._service_port = service_port
+    self._group = group
+    self._ttl = ttl
+    self._max_nodes = max_nodes
+    self._max_recv = max_recv
+
+    self._sock = None
+    self._poller = None
+
+    # node name: [host, port, expiry ms, ttl secs]
+
+    self._nodes = {}
+
+    # node name: time ms of last query sent
+
+    self._queries = {}
+
+    # pre-encode what we send the most
+
+    self._announcement = ("%s A %s %d %d\n" % (_MAGIC, name, service_port, ttl)).encode()
+
+
+  def start(self):
+
+    self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    # not every port has SO_BROADCAST; lwip lets broadcasts through without it
+
+    if hasattr(socket, "SO_BROADCAST"):
+      try:
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+      except:
+        pass
+
+    self._sock.bind(socket.getaddrinfo("0", self._port, socket.AF_INET, socket.SOCK_DGRAM)[0][-1])
+
+    # join multicast group; without membership we can still send to it, but
+    # will only hear answers to our own queries
+
+    if self._group != None and hasattr(socket, "IP_ADD_MEMBERSHIP"):
+      try:
+        self._sock.setsockopt(getattr(socket, "IPPROTO_IP", 0), socket.IP_ADD_MEMBERSHIP, _inet_aton(self._group) + bytes(4))
+      except:
+        pass
+
+    self._sock.setblocking(False)
+
+    self._poller = xpoll.XPoll()
+    self._poller.register(self._sock, xpoll.POLLIN)
+
+
+  def stop(self):
+
+    self._sock.close()
+    self._sock = None
+
+    self._poller.close()
+    self._poller = None
+
+
+  def _sendto(self, msg, host):
+
+    if self._sock == None:
+      return False
+
+    try:
+      self._sock.sendto(msg, (host, self._port))
+    except:
+      return False
+
+    return True
+
+
+  # tell every node about us
+
+  def announce(self):
+
+    if len(self._name) == 0:
+      return False
+
+    return self._sendto(self._announcement, _BROADCAST if self._group == None else self._group)
+
+
+  # ask for a node by name; "*" asks every node to announce itself
+
+  def query(self, name, now=None):
+
+    if now == None:
+      now = self._xt.time_ms()
+
+    self._queries[name] = now
+
+    return self._sendto(("%s Q %s\n" % (_MAGIC, name)).encode(), _BROADCAST if self._group == None else self._group)
+
+
+  def _learn(self, name, host, port, ttl, now):
+
+    if name == self._name:
+      return
+
+    # table full; evict whichever expires first
+
+    if name not in self._nodes and len(self._nodes) >= self._max_nodes:
+
+      oldest = None
+
+      for n in self._nodes:
+        if oldest == None or self._nodes[n][2] - self._nodes[oldest][2] < 0:
+          oldest = n
+
+      del self._nodes[oldest]
+
+    self._nodes[name] = [ host, port, now + ttl * 1000, ttl ]
+
+    if name in self._queries:
+      del self._queries[name]
+
+
+  def _handle(self, msg, addr, now):
+
+    # anything that fills the buffer may have been cut short
+
+    if len(msg) >= _MAX_DATAGRAM:
+      return
+
+    try:
+      t = msg.decode().split()
+    except:
+      return
+
+    if len(t) < 3 or t[0] != _MAGIC or not _valid(t[2]):
+      return
+
+    if t[1] == "A" and len(t) == 5:
+
+      try:
+        port = int(t[3])
+        ttl = int(t[4])
+      except:
+        return
+
+      if port > 0 and port < 0xffff and ttl > 0:
+        self._learn(t[2], addr[0], port, ttl, now)
+
+    elif t[1] == "Q" and len(t) == 3:
+
+      # answer straight to whoever asked
+
+      if len(self._name) > 0 and (t[2] == self._name or t[2] == "*"):
+        self._sendto(self._announcement, addr[0])
+
+
+  # look up a node in the table
+  #   return (host, port), or None if unknown or expired
+  # a missing or expired node is queried for, and so is one past half its ttl,
+  # so a live node is normally refreshed before it expires
+  # queries for the same name are sent no more than once every few secs
+
+  def resolve(self, name, now=None):
+
+    if now == None:
+      now = self._xt.time_ms()
+
+    node = self._nodes.get(name)
+
+    if node == None or node[2] - now <= node[3] * 500:
+      if name not in self._queries or now - self._queries[name] >= _DEFAULT_QUERY_INTERVAL:
+        self.query(name, now)
+
+    if node == None or node[2] - now <= 0:
+      return None
+
+    return node[0], node[1]
+
+
+  # return a copy of the node table: { name: (host, port, expiry ms, ttl secs), ... }
+
+  def nodes(self):
+
+    return dict([ (n, tuple(v)) for n, v in self._nodes.items() ])
+
+
+  # process pending datagrams; call this every tick
+
+  def serve(self, now=None):
+
+    if self._sock == None:
+      return
+
+    if now == None:
+      now = self._xt.time_ms()
+
+    for i in range(0, self._max_recv):
+
+      if self._poller.events(0) & xpoll.POLLIN == 0:
+        break
+
+      try:
+        msg, addr = self._sock.recvfrom(_MAX_DATAGRAM)
+      except:
+        break
+
+      self._handle(msg, addr, now)
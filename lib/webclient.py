@@ -9,225 +9,1383 @@
 
 import errno
 import socket
-import select
+import random
+import time
+import xpoll
 import re
 
 
 _DEFAULT_PORT = 80
+_DEFAULT_TLS_PORT = 443
 _DEFAULT_METHOD = "GET"
+_DEFAULT_BODY_TYPE = "application/octet-stream"
 
-_RECV_BLOCKSIZE = 32
+_METHODS = [ "GET", "POST", "PUT" ]
+
+_RECV_BLOCKSIZE = 512
+
+# chunked body decoding states; >= 0 is bytes left in the current chunk
+
+_CHUNK_SIZE = -1
+_CHUNK_END = -2
+_CHUNK_TRAILER = -3
+
+_CONNECT_TIMEOUT = 5000
+_RESPONSE_TIMEOUT = 10000
+_TOTAL_TIMEOUT = 30000
+
+_BACKOFF_BASE = 1000
+_BACKOFF_MAX = 300000
+
+_CACHE_SIZE = 4
+_CACHE_BODY_MAX = 1024
+
+_TLS_SESSIONS = 4
+
+_DNS_TTL = 300
+_DNS_RETRY_MIN = 2
+_DNS_RETRY_MAX = 300
+_DNS_SIZE = 8
 
 
-_re_line = re.compile("\r?\n")
 _re_status = re.compile("HTTP/([0-9]+\.[0-9]+) +([0-9][0-9][0-9]) +([^\r\n]*)")
 _re_header = re.compile("([A-Za-z][A-Za-z-]*): +([^\r\n]*)")
+_re_max_age = re.compile("max-age *= *([0-9]+)")
+
+
+# not every port has bytearray.find()
+
+_HAS_FIND = hasattr(bytearray, "find")
+
+
+# return index of the first "\n" in buf[start:end], or -1 if there isn't one
+
+def _find_nl(buf, start, end):
+
+  if _HAS_FIND:
+    return buf.find(b"\n", start, end)
+
+  for i in range(start, end):
+    if buf[i] == 10:
+      return i
+
+  return -1
+
+
+# tls module, only imported once someone wants tls, as it's big, and not every
+# port has it; and the exceptions it raises when a non-blocking socket isn't
+# ready, if it has any
+
+_ssl = None
+_ssl_again = ()
+
+
+def _tls():
+
+  global _ssl
+  global _ssl_again
+
+  if _ssl == None:
+
+    try:
+      _ssl = __import__("ssl")
+    except:
+      _ssl = __import__("ussl")
+
+    if hasattr(_ssl, "SSLWantReadError"):
+      _ssl_again = (_ssl.SSLWantReadError, _ssl.SSLWantWriteError)
+
+  return _ssl
+
+
+# is the exception only telling us that a non-blocking socket isn't ready?
+
+def _again(e):
+
+  if isinstance(e, _ssl_again):
+    return True
+
+  return hasattr(e, "errno") and e.errno == errno.EAGAIN
+
+
+# caches resolved addresses, so requests don't block on getaddrinfo()
+# an entry past its ttl is stale, but is still handed out until refresh()
+# manages to resolve it again; lookups never resolve anything themselves, and
+# failed attempts are retried with exponential backoff, so an unreachable dns
+# server costs at most one blocking lookup per host every so often, in
+# refresh(), instead of one per request
+# times are in secs
+
+class Resolver(object):
+
+  def __init__(self, ttl=_DNS_TTL, retry_min=_DNS_RETRY_MIN, retry_max=_DNS_RETRY_MAX, size=_DNS_SIZE):
+
+    self._ttl = ttl
+    self._retry_min = retry_min
+    self._retry_max = retry_max
+    self._size = size
+
+    # (host, port): [address, expiry, next attempt, retry delay]
+
+    self._cache = {}
+
+
+  # resolve and update entry
+  #   return True on success
+
+  def _resolve(self, key, entry, now):
+
+    addr = None
+
+    try:
+      addr = socket.getaddrinfo(key[0], key[1])[0][-1]
+    except:
+      pass
+
+    if addr == None:
+      entry[3] = min(max(entry[3] * 2, self._retry_min), self._retry_max)
+      entry[2] = now + entry[3]
+      return False
+
+    entry[0] = addr
+    entry[1] = now + self._ttl
+    entry[2] = entry[1]
+    entry[3] = 0
+
+    return True
+
+
+  # get the entry of a host, adding one if we haven't seen it
+
+  def _entry(self, key):
+
+    entry = self._cache.get(key)
+
+    if entry != None:
+      return entry
+
+    # cache full; evict whichever entry expired first
+
+    if len(self._cache) >= self._size:
+
+      oldest = None
+
+      for k in self._cache:
+        if oldest == None or self._cache[k][1] < self._cache[oldest][1]:
+          oldest = k
+
+      del self._cache[oldest]
+
+    entry = [ None, 0, 0, 0 ]
+    self._cache[key] = entry
+
+    return entry
+
+
+  # return cached address, fresh or stale, or None if we don't have one
+  # this never blocks; a host we haven't seen is only added, and resolved by
+  # the next refresh(), or by resolve()
+
+  def lookup(self, host, port):
+
+    return self._entry((host, port))[0]
+
+
+  # resolve a host now, unless we're still backing off after failing to
+  # resolve it; this blocks, so do it at setup, not in the middle of a request
+  #   return address, or None
+
+  def resolve(self, host, port, now=None):
+
+    if now == None:
+      now = time.time()
+
+    key = (host, port)
+    entry = self._entry(key)
+
+    if entry[0] == None and now >= entry[2]:
+      self._resolve(key, entry, now)
+
+    return entry[0]
+
+
+  # re-resolve up to count entries that are stale and due for another attempt
+  # call this between requests, not in the middle of one
+  #   return number of entries attempted
+
+  def refresh(self, now=None, count=1):
+
+    if now == None:
+      now = time.time()
+
+    n = 0
+
+    for key in self._cache:
+
+      if n >= count:
+        break
+
+      entry = self._cache[key]
+
+      if now < entry[2]:
+        continue
+
+      self._resolve(key, entry, now)
+      n = n + 1
+
+    return n
+
+
+  def clear(self):
+
+    self._cache = {}
+
+
+# exponential backoff with jitter, for retrying something that keeps failing
+# each failure doubles the delay before the next attempt, up to max_delay; the
+# delay is randomised between half and all of that, so peers that failed
+# together don't all retry together
+# times are in msecs
+
+class Backoff(object):
+
+  def __init__(self, xt, base=_BACKOFF_BASE, max_delay=_BACKOFF_MAX):
+
+    self._xt = xt
+    self._base = base
+    self._max = max_delay
+
+    self._delay = 0
+    self._last = 0
+    self._failures = 0
+
+
+  # may we try again?
+
+  def ready(self):
+
+    if self._delay == 0:
+      return True
+
+    return self._xt.tp_diff(self._xt.tp_now(), self._last) >= self._delay
+
+
+  def failure(self):
+
+    d = min(self._base << min(self._failures, 16), self._max)
+
+    self._failures = self._failures + 1
+    self._delay = (d >> 1) + (random.getrandbits(16) * (d >> 1) >> 16)
+    self._last = self._xt.tp_now()
+
+
+  def success(self):
+
+    self._failures = 0
+    self._delay = 0
+
+
+  def failures(self):
+
+    return self._failures
+
+
+# caches responses that have validators or a max-age, so they can be
+# revalidated with a conditional request, or not requested at all while fresh
+# only small bodies are kept, as each one is a copy
+# times are in secs
+
+class Cache(object):
+
+  def __init__(self, size=_CACHE_SIZE, body_max=_CACHE_BODY_MAX):
+
+    self._size = size
+    self._body_max = body_max
+
+    # (host, path): [etag, last-modified, expiry, status, headers, body]
+
+    self._entries = {}
+
+
+  def _max_age(self, headers):
+
+    cc = headers.get("cache-control", "").lower()
+
+    if cc.find("no-cache") >= 0:
+      return 0
+
+    m = _re_max_age.search(cc)
+
+    return int(m.group(1)) if m != None else 0
+
+
+  # return entry, or None
+
+  def get(self, key):
+
+    return self._entries.get(key)
+
+
+  def fresh(self, entry, now=None):
+
+    if now == None:
+      now = time.time()
+
+    return now < entry[2]
+
+
+  # keep a 200 response, if we can
+  #   return entry, or None if not kept
+
+  def put(self, key, status, headers, body, now=None):
+
+    if now == None:
+      now = time.time()
+
+    if key in self._entries:
+      del self._entries[key]
+
+    etag = headers.get("etag")
+    lmod = headers.get("last-modified")
+    age = self._max_age(headers)
+
+    if headers.get("cache-control", "").lower().find("no-store") >= 0 or len(body) > self._body_max:
+      return None
+
+    # varies by request headers, which aren't part of the key
+
+    if "vary" in headers:
+      return None
+
+    if etag == None and lmod == None and age <= 0:
+      return None
+
+    if self._size <= 0:
+      return None
+
+    # cache full; evict whichever expires first
+
+    if len(self._entries) >= self._size:
+
+      oldest = None
+
+      for k in self._entries:
+        if oldest == None or self._entries[k][2] < self._entries[oldest][2]:
+          oldest = k
+
+      del self._entries[oldest]
+
+    entry = [ etag, lmod, now + age, status, headers, bytes(body) ]
+    self._entries[key] = entry
+
+    return entry
+
+
+  # update entry from the headers of a 304 response
+  #   return entry, or None if we don't have it anymore
+
+  def revalidate(self, key, headers, now=None):
+
+    if now == None:
+      now = time.time()
+
+    entry = self._entries.get(key)
+
+    if entry == None:
+      return None
+
+    for k in headers:
+      if k != "content-length" and k != "transfer-encoding":
+        entry[4][k] = headers[k]
+
+    entry[0] = entry[4].get("etag")
+    entry[1] = entry[4].get("last-modified")
+    entry[2] = now + self._max_age(entry[4])
+
+    return entry
+
+
+  def clear(self):
+
+    self._entries = {}
+
+
+# tls sessions of recent connections, by host and port, so that a new
+# connection to the same server can resume one instead of doing a full
+# handshake
+# only cpython's ssl gives us sessions; micropython's always does a full
+# handshake, so keeping connections alive matters more there
+
+class Sessions(object):
+
+  def __init__(self, size=_TLS_SESSIONS):
+
+    self._size = size
+
+    # (host, port): session
+
+    self._sessions = {}
+
+
+  # return session, or None
+
+  def get(self, key):
+
+    return self._sessions.get(key)
+
+
+  def put(self, key, session):
+
+    if session == None or self._size <= 0:
+      return
+
+    # full; evict any other
+
+    if key not in self._sessions and len(self._sessions) >= self._size:
+      for k in self._sessions:
+        del self._sessions[k]
+        break
+
+    self._sessions[key] = session
+
+
+  def remove(self, key):
+
+    if key in self._sessions:
+      del self._sessions[key]
+
+
+  def clear(self):
+
+    self._sessions = {}
+
+
+# shared by every HTTPRequest, unless given their own
+
+_resolver = Resolver()
+_cache = Cache()
+_sessions = Sessions()
+
+
+def refresh(now=None, count=1):
+
+  return _resolver.refresh(now, count)
+
+
+class HTTPRequest(object):
+
+  STATE_NULL = 0
+  STATE_INIT = 1
+  STATE_CONN = 2
+  STATE_SEND = 3
+  STATE_RCV1 = 4
+  STATE_RCV2 = 5
+  STATE_RCV3 = 6
+  STATE_DONE = 10
+  STATE_ERROR = 100
+
+  # keepalive: ask the server to keep the connection open, and reuse it for
+  # the next request if it does
+  # resolver: Resolver to use, instead of the shared one
+  # blocksize: most bytes to ask for per recv(), unless we know how many to
+  # expect and the body isn't going to a sink; this is also the initial size
+  # of the receive buffer
+  # cache: Cache to use, or True for the shared one, or None for none
+  # xt: XTime, for deadlines; none are enforced without it
+  # connect_timeout: msecs to connect
+  # response_timeout: msecs from sending the request to the first response byte
+  # total_timeout: msecs for the whole request
+  # a timeout of 0 is no timeout
+  # tls: None for plain http; True for https with the default context, or an
+  # ssl context to use, to verify the server some other way
+  # sessions: Sessions to resume tls sessions from, or True for the shared
+  # one, or None to always do a full handshake
+
+  def __init__(self, keepalive=True, resolver=None, blocksize=_RECV_BLOCKSIZE, cache=True, xt=None, connect_timeout=_CONNECT_TIMEOUT, response_timeout=_RESPONSE_TIMEOUT, total_timeout=_TOTAL_TIMEOUT, tls=None, sessions=True):
+
+    self._xt = xt
+    self._timeouts = (connect_timeout, response_timeout, total_timeout)
+
+    # when the request started, and when it was sent; None if not yet
+
+    self._t_start = None
+    self._t_sent = None
+
+    self._resolver = resolver if resolver != None else _resolver
+    self._cache = _cache if cache == True else (cache if cache != False else None)
+
+    # tls context, if any, and whether the socket has been wrapped in it; poll
+    # events the handshake is waiting for
+
+    self._tls = None
+    self._sessions = None
+    self._wrapped = False
+    self._want = 0
+
+    if tls != None and tls != False:
+
+      m = _tls()
+
+      if tls != True:
+        self._tls = tls
+      elif hasattr(m, "create_default_context"):
+        self._tls = m.create_default_context()
+      else:
+        self._tls = m.SSLContext(m.PROTOCOL_TLS_CLIENT)
+
+      self._sessions = _sessions if sessions == True else (sessions if sessions != False else None)
+
+    # request has started; cache entry we sent validators from; cache entry
+    # the response comes from
+
+    self._started = False
+    self._validated = None
+    self._hit = None
+    self._addr = None
+    self._name = None
+    self._port = _DEFAULT_PORT
+    self._host = None
+    self._path = None
+    self._method = _DEFAULT_METHOD
+    self._keepalive = keepalive
+    self._blocksize = blocksize
+
+    # send buffer, and receive buffer, which holds rlen bytes
+    # bytes before rpos have been consumed; bytes before scan have been
+    # searched for line ends; once the headers are in, the body is decoded
+    # into bpos to bend, which is never past rpos
+
+    self._sbuf = b""
+    self._rbuf = bytearray(blocksize)
+    self._rlen = 0
+    self._rpos = 0
+    self._scan = 0
+    self._bpos = -1
+    self._bend = 0
+
+    # body bytes so far, including those given to the sink; seen EOF
+
+    self._bcount = 0
+    self._eof = False
+
+    # where body bytes go as they arrive, instead of the buffer
+    # either fn(memoryview), or something with a write(memoryview)
+
+    self._sink = None
+
+    # request body, its type and length, or -1 if it's to be sent chunked
+    # body_pulled: producer has been called for this request
+    # body_end: the whole body is in the send buffer
+
+    self._body = None
+    self._body_type = _DEFAULT_BODY_TYPE
+    self._body_len = 0
+    self._body_pulled = False
+    self._body_end = False
+
+    # body is chunked; state of chunk decoding
+
+    self._chunked = False
+    self._chunk = _CHUNK_SIZE
+
+    self._state = HTTPRequest.STATE_NULL
+    self._socket = None
+    self._poller = None
+
+    # reusable: connection can be reused after this response
+    # reused: this request went out on a reused connection
+    # received: got at least one byte of the response
+
+    self._reusable = False
+    self._reused = False
+    self._received = False
+
+    # content type to ask for, if any
+
+    self._accept = None
+
+    # poll events given to request(), or None if we poll for ourselves
+
+    self._events = None
+
+    self._rsp_status = (0, "")
+    self._rsp_version = ""
+    self._rsp_headers = {}
+
+
+  # send stuff that are in the buffer
+  #  return  0,     _ : success, done
+  #  return  1,     _ : success, not done yet
+  #  return -1, errno : socket error
+
+  def _send(self):
+
+    if len(self._sbuf) == 0:
+      return 0, 0
+
+    n = 0
+
+    try:
+      n = self._socket.send(self._sbuf)
+    except Exception as e:
+      if _again(e):
+        return 1, 0
+      if hasattr(e, "errno"):
+        return -1, e.errno
+      return -1, 0
+
+    # micropython's tls sockets give None instead of raising EAGAIN
+
+    if n == None:
+      return 1, 0
+
+    # this should never happen, but check anyway
+
+    if n == 0:
+      return -1, 0
+
+    # remove from buffer what we've just sent
+
+    self._sbuf = self._sbuf[n:]
+
+    return 0, 0
+
+
+  # make room in the receive buffer for size bytes past rlen
+  # consumed bytes, other than the body, are dropped first, and the buffer
+  # only grows if that's not enough
+
+  def _reserve(self, size):
+
+    if self._rlen + size <= len(self._rbuf):
+      return
+
+    keep = self._rpos if self._bpos < 0 else self._bpos
+
+    if keep > 0:
+      n = self._rlen - keep
+      self._rbuf[0:n] = self._rbuf[keep:self._rlen]
+      self._rlen = n
+      self._rpos = self._rpos - keep
+      self._scan = self._scan - keep
+
+      if self._bpos >= 0:
+        self._bpos = self._bpos - keep
+        self._bend = self._bend - keep
+
+    if self._rlen + size <= len(self._rbuf):
+      return
+
+    buf = bytearray(max(self._rlen + size, len(self._rbuf) * 2))
+    buf[0:self._rlen] = self._rbuf[0:self._rlen]
+
+    self._rbuf = buf
+
+
+  # receive stuff straight into the buffer
+  #   size: bytes we expect; <= 0 means we don't know, so read a block
+  #  return  0,   EOF : success
+  #  return  1,     _ : success, not done yet
+  #  return -1, errno : socket error
+
+  def _recv(self, size=0):
+
+    # we were told what's ready, so don't bother unless it's something to read
+    # and only read once, as we don't know if there's more
+    # tls may already have bytes decrypted that the socket won't tell us about
+
+    if self._events != None:
+
+      if self._events & (xpoll.POLLIN | xpoll.POLLERR | xpoll.POLLHUP) == 0 and not self.pending():
+        return 1, 0
+
+      self._events = 0
+
+    if size <= 0:
+      size = self._blocksize
+
+    self._reserve(size)
+
+    n = 0
+    mv = memoryview(self._rbuf)[self._rlen:self._rlen + size]
+
+    try:
+      if hasattr(self._socket, "recv_into"):
+        n = self._socket.recv_into(mv)
+      else:
+        n = self._socket.readinto(mv)
+    except Exception as e:
+      if _again(e):
+        return 1, 0
+      if hasattr(e, "errno"):
+        return -1, e.errno
+      return -1, 0
+
+    # micropython's readinto() gives None instead of raising EAGAIN
+
+    if n == None:
+      return 1, 0
+
+    if n > 0:
+      self._rlen = self._rlen + n
+      self._received = True
+
+    return 0, n == 0
+
+
+  # consume a line from the buffer, only searching bytes not searched before
+  #   return line, without the line end, or None if we don't have one yet
+
+  def _line(self):
+
+    i = _find_nl(self._rbuf, max(self._scan, self._rpos), self._rlen)
+
+    if i < 0:
+      self._scan = self._rlen
+      return None
+
+    line = str(self._rbuf[self._rpos:i], "utf-8")
+
+    self._rpos = i + 1
+    self._scan = i + 1
+
+    return line[:-1] if line.endswith("\r") else line
+
+
+  # consume chunked body from buffer, moving chunk data down to the end of
+  # the body decoded so far, over the chunk sizes and line ends before it
+  #   return  0 : success, done
+  #   return  1 : need more bytes
+  #   return -1 : error
+
+  def _consume_chunks(self):
+
+    while True:
+
+      # in a chunk; take whatever we have of it
+
+      if self._chunk > 0:
+
+        n = min(self._chunk, self._rlen - self._rpos)
+
+        if n == 0:
+          return 1
+
+        if self._bend != self._rpos:
+          self._rbuf[self._bend:self._bend + n] = self._rbuf[self._rpos:self._rpos + n]
+
+        self._bend = self._bend + n
+        self._bcount = self._bcount + n
+        self._rpos = self._rpos + n
+        self._chunk = self._chunk - n
+
+        if self._chunk == 0:
+          self._chunk = _CHUNK_END
+
+        continue
+
+      # everything else is a line
+
+      t = self._line()
+
+      if t == None:
+        return 1
+
+      if self._chunk == _CHUNK_SIZE:
+
+        # chunk size, in hex, maybe followed by extensions we don't care about
+
+        try:
+          n = int(t.split(";", 1)[0].strip(), 16)
+        except:
+          return -1
+
+        self._chunk = n if n > 0 else _CHUNK_TRAILER
+
+      elif self._chunk == _CHUNK_END:
+
+        # chunk data is followed by an empty line
+
+        if len(t) > 0:
+          return -1
+
+        self._chunk = _CHUNK_SIZE
+
+      elif len(t) == 0:
+
+        # trailers, if any, end with an empty line
+
+        return 0
+
+
+  # hand the body decoded so far to the sink, if we have one, and drop it
+  #   return False if the sink failed
+
+  def _flush(self):
+
+    if self._sink == None or self._bend == self._bpos:
+      return True
+
+    mv = memoryview(self._rbuf)[self._bpos:self._bend]
+
+    try:
+      if hasattr(self._sink, "write"):
+        self._sink.write(mv)
+      else:
+        self._sink(mv)
+    except:
+      return False
+
+    # everything up to rpos is now consumed
+
+    self._bpos = self._rpos
+    self._bend = self._rpos
+
+    return True
+
+
+  # consume status line from buffer
+  #   return  0 : success
+  #   return  1 : we don't have a full line yet
+  #   return -1 : error
+
+  def _consume_status(self):
+
+    t = self._line()
+
+    if t == None:
+      return 1
+
+    # is it a valid status line?
+
+    t = _re_status.match(t)
+
+    if t == None:
+      return -1
+
+    self._rsp_status = (int(t.group(2)), t.group(3))
+    self._rsp_version = t.group(1)
+
+    return 0
+
+
+  # consume status line from buffer
+  #   return  0 : success
+  #   return  1 : we don't have a full line yet
+  #   return -1 : error
+
+  def _consume_headers(self):
+
+    while True:
+
+      t = self._line()
+
+      if t == None:
+        return 1
+
+      # are we at the end of the header section?
+
+      if len(t) == 0:
+        break;
+      
+      # is it a valid header line?
+      
+      t = _re_header.match(t)
+      
+      if t == None:
+        return -1
+      
+      self._rsp_headers[t.group(1).lower()] = t.group(2)
+      
+    return 0
+
+
+  # port: None for the default, 80 or 443 for tls
+
+  def set(self, host, path, port=None, method=_DEFAULT_METHOD):
+
+    self._state = HTTPRequest.STATE_NULL
+
+    # we only support these; and only GET without a body
+
+    if method not in _METHODS:
+      return 1
+
+    # everything else
+
+    dport = _DEFAULT_PORT if self._tls == None else _DEFAULT_TLS_PORT
+
+    if port == None:
+      port = dport
+
+    self._method = method
+    self._name = host
+    self._port = port
+    self._host = host if port == dport else "%s:%d" % (host, port)
+    self._path = path
+
+    # new destination, so never reuse the old connection
+
+    self._reusable = False
+    self._state = HTTPRequest.STATE_INIT
+
+    self.reset()
+
+    # not resolved yet; request() fails until resolve() or refresh() does
+
+    if self._resolver.lookup(host, port) == None:
+      return 2
+
+    return 0
+
+
+  # resolve the host of the request now, so request() doesn't have to
+  # this blocks; call it at setup, after set()
+  #   return 0 on success, 1 if not set, 2 if host can't be resolved
+
+  def resolve(self):
+
+    if self._state == HTTPRequest.STATE_NULL:
+      return 1
+
+    if self._resolver.resolve(self._name, self._port) == None:
+      return 2
+
+    return 0
+
+
+  # is the connection we have idle and still open?
+  # an idle connection should have nothing to read; anything readable is
+  # either EOF, because the server has closed it, or garbage
+
+  def _idle(self):
+
+    if not self._reusable or self._socket == None:
+      return False
+
+    return self._poller.events(0) & (xpoll.POLLIN | xpoll.POLLERR | xpoll.POLLHUP) == 0
+
+
+  # may the connection be reused after this response?
+  # only if the server agreed to keep it open, and we know where the body ended;
+  # 204 and 304 never have one
+
+  def _keep(self):
+
+    if not self._keepalive:
+      return False
+
+    if not self._chunked and "content-length" not in self._rsp_headers and self._rsp_status[0] not in (204, 304):
+      return False
+
+    conn = self._rsp_headers.get("connection", "").lower()
+
+    if self._rsp_version == "1.0":
+      return conn == "keep-alive"
+
+    return conn != "close"
+
+
+  # close the socket and the poller each on their own, so that one failing,
+  # or not being there, doesn't leave the other open
+
+  def _disconnect(self):
+
+    try:
+      self._socket.close()
+    except:
+      pass
+
+    try:
+      self._poller.close()
+    except:
+      pass
+
+
+  def _connect(self):
+
+    self._disconnect()
+
+    self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._poller = xpoll.XPoll()
+
+    self._socket.setblocking(0)
+    self._poller.register(self._socket, xpoll.POLLIN | xpoll.POLLOUT)
+
+    self._reused = False
+    self._wrapped = False
+    self._want = 0
+    self._state = HTTPRequest.STATE_INIT
+
+    # events we were given were for the old socket
+
+    if self._events != None:
+      self._events = 0
+
+
+  # wrap the connected socket in tls, resuming the last session with the
+  # server if we have one, and get on with the handshake
+  # micropython's tls sockets don't have do_handshake(); theirs happens as the
+  # request is sent, which copes with the socket not being ready
+  #  return  0,     _ : success, done
+  #  return  1,     _ : success, not done yet
+  #  return -1, error : failed
+
+  def _handshake(self):
+
+    if not self._wrapped:
+
+      kwargs = { "server_hostname": self._name, "do_handshake_on_connect": False }
+
+      session = self._sessions.get((self._name, self._port)) if self._sessions != None else None
+
+      if session != None:
+        kwargs["session"] = session
+
+      try:
+        sock = self._tls.wrap_socket(self._socket, **kwargs)
+      except Exception as e:
+        return -1, e
+
+      self._poller.unregister(self._socket)
+      self._socket = sock
+      self._poller.register(self._socket, xpoll.POLLIN | xpoll.POLLOUT)
+      self._wrapped = True
+
+    if not hasattr(self._socket, "do_handshake"):
+      return 0, None
+
+    try:
+      self._socket.do_handshake()
+    except Exception as e:
+
+      if isinstance(e, _ssl_again):
+        self._want = xpoll.POLLIN if isinstance(e, _ssl.SSLWantReadError) else xpoll.POLLOUT
+        return 1, None
+
+      # whatever it was, the session won't help next time
+
+      if self._sessions != None:
+        self._sessions.remove((self._name, self._port))
+
+      return -1, e
+
+    self._want = 0
+
+    return 0, None
+
+
+  # a reused connection that fails before any of the response arrives was most
+  # likely closed by the server while idle, so quietly start over on a new one
+  #   return True if we did
+
+  def _reconnect(self):
+
+    if not self._reused or self._received:
+      return False
+
+    # can't send what a producer has already given us again
+
+    if self._body_pulled:
+      return False
+
+    self._body_end = False
+    self._sbuf = self._request()
+    self._t_sent = None
+    self._connect()
+
+    return True
+
+
+  def _request(self):
+
+    cond = ""
+
+    if self._validated != None:
+      if self._validated[0] != None:
+        cond = cond + "If-None-Match: %s\r\n" % (self._validated[0])
+      if self._validated[1] != None:
+        cond = cond + "If-Modified-Since: %s\r\n" % (self._validated[1])
+
+    if self._accept != None:
+      cond = cond + "Accept: %s\r\n" % (self._accept)
+
+    if self._method != "GET":
+      cond = cond + "Content-Type: %s\r\n" % (self._body_type)
+      if self._body_len >= 0:
+        cond = cond + "Content-Length: %d\r\n" % (self._body_len)
+      else:
+        cond = cond + "Transfer-Encoding: chunked\r\n"
+
+    return ("%s %s HTTP/1.1\r\nHost: %s\r\nConnection: %s\r\n%s\r\n" % (self._method, self._path, self._host, "keep-alive" if self._keepalive else "close", cond)).encode()
+
+
+  # put the next piece of the request body in the send buffer
+  #   return False if there isn't any more
+
+  def _next_body(self):
+
+    if self._body == None or self._body_end:
+      return False
+
+    # bytes go out as they are
+
+    if not callable(self._body):
+      self._sbuf = self._body
+      self._body_end = True
+      return True
+
+    # producers are called until they run out
+
+    self._body_pulled = True
+
+    t = self._body()
+
+    if t == None or len(t) == 0:
+
+      self._body_end = True
+
+      if self._body_len >= 0:
+        return False
+
+      self._sbuf = b"0\r\n\r\n"
+      return True
+
+    if self._body_len >= 0:
+      self._sbuf = t
+    else:
+      self._sbuf = ("%x\r\n" % (len(t))).encode() + bytes(t) + b"\r\n"
+
+    return True
+
+
+  # consult the cache as the request starts, as it may have been a while since
+  # reset()
+  #   return True if the cached response is fresh
 
+  def _fresh(self):
 
-class HTTPRequest(object):
+    if self._cache == None or self._sink != None or self._method != "GET":
+      return False
 
-  STATE_NULL = 0
-  STATE_INIT = 1
-  STATE_CONN = 2
-  STATE_SEND = 3
-  STATE_RCV1 = 4
-  STATE_RCV2 = 5
-  STATE_RCV3 = 6
-  STATE_DONE = 10
-  STATE_ERROR = 100
+    entry = self._cache.get((self._host, self._path))
 
-  def __init__(self):
+    if entry == None:
+      return False
 
-    self._addr = None
-    self._path = None
-    self._method = _DEFAULT_METHOD
+    if self._cache.fresh(entry):
+      self._hit = entry
+      self._reusable = self._reused
+      self._state = HTTPRequest.STATE_DONE
+      return True
 
-    self._buf = ""
-    self._state = HTTPRequest.STATE_NULL
-    self._socket = None
-    self._poller = None
+    # stale, so ask if it's changed
 
-    self._rsp_status = (0, "")
-    self._rsp_headers = {}
+    self._validated = entry
+    self._sbuf = self._request()
 
+    return False
 
-  # send stuff that are in the buffer
-  #  return  0,     _ : success, done
-  #  return  1,     _ : success, not done yet
-  #  return -1, errno : socket error
 
-  def _send(self):
+  # start the request; a connection is only made now, and only if the
+  # response isn't to come from the cache
+  #   return True if it does, and we're done
 
-    if len(self._buf) == 0:
-      return 0, 0
+  def _start(self):
 
-    n = 0
+    self._started = True
 
-    try:
-      n = self._socket.send(self._buf)
-    except Exception as e:
-      if hasattr(e, "errno"):
-        if e.errno == errno.EAGAIN:
-          return 1, 0
-        return -1, e.errno
-      return -1, 0
+    if self._fresh():
+      return True
 
-    # this should never happen, but check anyway
+    if self._state == HTTPRequest.STATE_INIT:
+      self._connect()
 
-    if n == 0:
-      return -1, 0
+    return False
 
-    # remove from buffer what we've just sent
 
-    self._buf = self._buf[n:]
+  # response is complete; keep it in the cache, or take it from there if it
+  # hasn't changed
 
-    return 0, 0
+  def _finish(self, reusable):
 
+    self._reusable = reusable
+    self._state = HTTPRequest.STATE_DONE
 
-  # receive stuff into the buffer
-  #  return  0,   EOF : success
-  #  return  1,     _ : success, not done yet
-  #  return -1, errno : socket error
+    # keep the tls session for the next connection; it's only now, with the
+    # response in, that we're sure to have any session tickets
 
-  def _recv(self, blocksize=0):
+    if self._wrapped and self._sessions != None and hasattr(self._socket, "session"):
+      self._sessions.put((self._name, self._port), self._socket.session)
 
-    if blocksize <= 0 or blocksize > _RECV_BLOCKSIZE:
-      blocksize=_RECV_BLOCKSIZE
+    if self._cache == None or self._sink != None or self._method != "GET":
+      return
 
-    t = ""
-  
-    try:
-      t = self._socket.recv(blocksize)
-    except Exception as e:
-      if hasattr(e, "errno"):
-        if e.errno == errno.EAGAIN:
-          return 1, 0
-        return -1, e.errno
-      return -1, 0
-  
-    # put on buffer what we've just received
+    key = (self._host, self._path)
 
-    if len(t) > 0:
-      self._buf = self._buf + t.decode("utf-8")
+    if self._rsp_status[0] == 304 and self._validated != None:
+      self._hit = self._cache.revalidate(key, self._rsp_headers)
+    elif self._rsp_status[0] == 200:
+      self._cache.put(key, self._rsp_status, self._rsp_headers, memoryview(self._rbuf)[self._bpos:self._bend])
 
-    return 0, len(t) == 0
 
+  def reset(self):
 
-  # consume status line from buffer
-  #   return  0 : success
-  #   return  1 : we don't have a full line yet
-  #   return -1 : error
+    if self._state <= HTTPRequest.STATE_NULL:
+      return 1
 
-  def _consume_status(self):
+    self._rsp_status = (0, "")
+    self._rsp_version = ""
+    self._rsp_headers = {}
 
-    t = _re_line.split(self._buf, 1)
+    self._started = False
+    self._validated = None
+    self._hit = None
+
+    self._body_pulled = False
+    self._body_end = False
+
+    self._sbuf = self._request()
+    self._rlen = 0
+    self._rpos = 0
+    self._scan = 0
+    self._bpos = -1
+    self._bend = 0
+    self._bcount = 0
+    self._eof = False
+    self._chunked = False
+    self._chunk = _CHUNK_SIZE
+    self._received = False
+    self._t_start = None
+    self._t_sent = None
+
+    # reuse the connection if the last response allowed it; else it's closed,
+    # and request() connects anew, if it has to
+
+    if self._idle():
+      self._reused = True
+      self._state = HTTPRequest.STATE_SEND
+    else:
+      self.close()
+      self._reused = False
+      self._state = HTTPRequest.STATE_INIT
+
+    self._reusable = False
 
-    if len(t) == 1:
-      return 1
+    return 0
 
-    # we got a full line; remove from buffer
 
-    self._buf = t[1]
+  # send body bytes to sink as they arrive, instead of keeping them for
+  # get_response(); sink is either fn(memoryview), or something with a
+  # write(memoryview), like a file; memoryviews are only valid during the call
+  # None to go back to keeping them
 
-    # is it a valid status line?
+  def set_sink(self, sink):
 
-    t = _re_status.match(t[0])
+    self._sink = sink
 
-    if t == None:
-      return -1
 
-    self._rsp_status = (int(t.group(2)), t.group(3))
+  # body of POST and PUT requests, sent from the next request on
+  #   body: bytes-like, or a producer fn() returning the next piece of the
+  #     body each time, and None or empty once there's no more; a producer is
+  #     only called through once, so has to be set again for every request
+  #   ctype: content type
+  #   length: body length, for a producer; if -1, the body is sent chunked
 
-    return 0
+  def set_body(self, body, ctype=_DEFAULT_BODY_TYPE, length=-1):
 
+    self._body = body if body == None or callable(body) else memoryview(body)
+    self._body_type = ctype
+    self._body_len = length if callable(body) else (len(body) if body != None else 0)
 
-  # consume status line from buffer
-  #   return  0 : success
-  #   return  1 : we don't have a full line yet
-  #   return -1 : error
+    # request line and headers depend on this
 
-  def _consume_headers(self):
+    if self._state > HTTPRequest.STATE_NULL and not self._started:
+      self._sbuf = self._request()
 
-    while True:
 
-      t = _re_line.split(self._buf, 1)
-      
-      if len(t) == 1:
-        return 1
-      
-      # we got a full line; remove from buffer
-      
-      self._buf = t[1]
+  # content type to ask for in an Accept header, from the next request on;
+  # None to not ask for any
 
-      # are we at the end of the header section?
+  def set_accept(self, ctype):
 
-      if len(t[0]) == 0:
-        break;
-      
-      # is it a valid header line?
-      
-      t = _re_header.match(t[0])
-      
-      if t == None:
-        return -1
-      
-      self._rsp_headers[t.group(1).lower()] = t.group(2)
-      
-    return 0
+    self._accept = ctype
 
+    if self._state > HTTPRequest.STATE_NULL and not self._started:
+      self._sbuf = self._request()
 
-  def set(self, host, path, port=_DEFAULT_PORT, method=_DEFAULT_METHOD):
 
-    self._state = HTTPRequest.STATE_NULL
+  def state(self):
 
-    # we only support GET for now
+    return self._state
 
-    if method != "GET":
-      return 1
 
-    # did we get valid host and port?
+  # check deadlines of the request in progress
+  #   return rv, error-message, as returned by request(), or None if within
+  #   every deadline
 
-    addr = None
+  def _overdue(self):
 
-    try:
-      addr = socket.getaddrinfo(host, port)[0][-1]
-    except:
-      return 2
+    if self._xt == None or self._t_start == None or self._state >= HTTPRequest.STATE_DONE:
+      return None
 
-    # everything else
+    now = self._xt.tp_now()
 
-    self._addr = addr
-    self._path = path
+    if self._timeouts[2] > 0 and self._xt.tp_diff(now, self._t_start) > self._timeouts[2]:
+      return -16, "Request timed out"
 
-    self._state = HTTPRequest.STATE_INIT
+    if self._timeouts[0] > 0 and self._state <= HTTPRequest.STATE_CONN and self._xt.tp_diff(now, self._t_start) > self._timeouts[0]:
+      return -14, "connect() timed out"
 
-    self.reset()
+    if self._timeouts[1] > 0 and self._t_sent != None and not self._received and self._xt.tp_diff(now, self._t_sent) > self._timeouts[1]:
+      return -15, "Timed out waiting for response"
 
-    return 0
+    return None
 
 
-  def reset(self):
+  # is the request in progress past any of its deadlines?
 
-    if self._state <= HTTPRequest.STATE_NULL:
-      return 1
+  def expired(self):
 
-    try:
-      self._socket.close()
-    except:
-      pass
+    return self._overdue() != None
 
-    self._rsp_status = (0, "")
-    self._rsp_headers = {}
 
-    self._buf = ("%s %s HTTP/1.0\r\n\r\n" % (self._method, self._path)).encode()
-    self._state = HTTPRequest.STATE_INIT
-    self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    self._poller = select.poll()
+  def socket(self):
 
-    self._socket.setblocking(0)
-    self._poller.register(self._socket, select.POLLIN | select.POLLOUT)
+    return self._socket
 
-    return 0
+
+  # poll events the request is waiting for: writable while connecting and
+  # sending, readable otherwise, or whichever the tls handshake wants
+
+  def wants(self):
+
+    if self._state == HTTPRequest.STATE_CONN and self._want != 0:
+      return self._want
+
+    if self._state == HTTPRequest.STATE_CONN or self._state == HTTPRequest.STATE_SEND:
+      return xpoll.POLLOUT
+
+    return xpoll.POLLIN
+
+
+  # has tls decrypted bytes we haven't read yet? if so, the socket may not be
+  # readable, even though there's something to read
+
+  def pending(self):
+
+    return self._wrapped and hasattr(self._socket, "pending") and self._socket.pending() > 0
+
+
+  # close the connection, if any; the next request will connect anew
+
+  def close(self):
+
+    self._disconnect()
+
+    self._socket = None
+    self._poller = None
+    self._reusable = False
 
 
   # connect, send request, receive response
@@ -240,8 +1398,30 @@ class HTTPRequest(object):
   #      %d
   #    error-message:
   #      %s
+  # events: if given, poll events for our socket, so we don't have to poll
+  # for ourselves, and don't try to read unless there's something to read
+
+  def request(self, events=None):
+
+    self._events = events
+
+    # a fresh cached response means we don't have to do anything at all
+
+    if not self._started and self._state > HTTPRequest.STATE_NULL and self._state < HTTPRequest.STATE_DONE and self._start():
+      return 0, self._state, ""
+
+    # start the clock, or see if it's run out
 
-  def request(self):
+    if self._xt != None:
+
+      if self._t_start == None and self._state > HTTPRequest.STATE_NULL and self._state < HTTPRequest.STATE_DONE:
+        self._t_start = self._xt.tp_now()
+
+      t = self._overdue()
+
+      if t != None:
+        self._state = HTTPRequest.STATE_ERROR
+        return t[0], self._state, t[1]
 
     while True:
 
@@ -251,6 +1431,14 @@ class HTTPRequest(object):
 
       elif self._state == HTTPRequest.STATE_INIT:
 
+        # get address; this never blocks, so a host that hasn't been resolved
+        # yet fails until it is
+
+        self._addr = self._resolver.lookup(self._name, self._port)
+
+        if self._addr == None:
+          return 3, self._state, "Failed to resolve %s" % (self._name)
+
         # initiate connection
 
         try:
@@ -263,22 +1451,35 @@ class HTTPRequest(object):
           self._state = HTTPRequest.STATE_ERROR
           return -1, self._state, "connect() failed: %s" % (e)
 
-        self._state = HTTPRequest.STATE_SEND
+        self._state = HTTPRequest.STATE_SEND if self._tls == None else HTTPRequest.STATE_CONN
 
       elif self._state == HTTPRequest.STATE_CONN:
 
         # connection has been initiated; make sure it goes through
 
-        pe = ([ x[1] for x in list(self._poller.poll(0)) ] + [ 0 ])[0]
+        if not self._wrapped:
 
-        if pe & select.POLLERR > 0 or pe & select.POLLHUP > 0:
-          self._state = HTTPRequest.STATE_ERROR
-          return -2, self._state, "connect() failed"
+          pe = self._poller.events(0) if self._events == None else self._events
 
-        if pe & select.POLLOUT == 0:
-          return 0, self._state, ""
+          if pe & xpoll.POLLERR > 0 or pe & xpoll.POLLHUP > 0:
+            self._state = HTTPRequest.STATE_ERROR
+            return -2, self._state, "connect() failed"
+
+          if pe & xpoll.POLLOUT == 0:
+            return 0, self._state, ""
+
+        # connected! over tls, there's a handshake first
+
+        if self._tls != None:
+
+          rv, e = self._handshake()
 
-        # connected! proceed to the next step
+          if rv < 0:
+            self._state = HTTPRequest.STATE_ERROR
+            return -17, self._state, "TLS handshake failed: %s" % (e)
+
+          if rv > 0:
+            return 0, self._state, ""
 
         self._state = HTTPRequest.STATE_SEND
 
@@ -288,6 +1489,9 @@ class HTTPRequest(object):
 
         rv, e = self._send()
 
+        if rv < 0 and self._reconnect():
+          continue
+
         if rv < 0:
           self._state = HTTPRequest.STATE_ERROR
           return -3, self._state, ":send() %s" % (errno.errorcode[e] if e in errno.errorcode else "unknown")
@@ -295,10 +1499,17 @@ class HTTPRequest(object):
         if rv > 0:
           return 0, self._state, ""
 
+        # anything left to send?
+
+        if len(self._sbuf) > 0 or self._next_body():
+          continue
+
         # request sent
 
+        if self._xt != None:
+          self._t_sent = self._xt.tp_now()
+
         self._state = HTTPRequest.STATE_RCV1
-        self._buf = ""
 
       elif self._state == HTTPRequest.STATE_RCV1:
 
@@ -317,6 +1528,9 @@ class HTTPRequest(object):
         if rv > 0:
           rv, e = self._recv()
 
+          if rv < 0 and self._reconnect():
+            continue
+
           if rv < 0:
             self._state = HTTPRequest.STATE_ERROR
             return -5, self._state, "recv() failed: %s" % (errno.errorcode[e] if e in errno.errorcode else "unknown")
@@ -324,6 +1538,9 @@ class HTTPRequest(object):
           if rv > 0:
             return 0, self._state, ""
 
+          if rv == 0 and e and self._reconnect():
+            continue
+
           if rv == 0 and e:
             self._state = HTTPRequest.STATE_ERROR
             return -6, self._state, "recv() failed: premature EOF"
@@ -366,15 +1583,35 @@ class HTTPRequest(object):
 
         # headers received; proceed to body
 
+        self._bpos = self._rpos
+        self._bend = self._rpos
+        self._chunked = self._rsp_headers.get("transfer-encoding", "").lower().find("chunked") >= 0 and self._rsp_status[0] not in (204, 304)
+        self._chunk = _CHUNK_SIZE
+
         self._state = HTTPRequest.STATE_RCV3
 
-      elif self._state == HTTPRequest.STATE_RCV3:
+      elif self._state == HTTPRequest.STATE_RCV3 and self._chunked:
 
-        # were we given content-length?
+        # decode what we have
 
-        blen = int(self._rsp_headers["content-length"]) if "content-length" in self._rsp_headers else 0
+        rv = self._consume_chunks()
 
-        rv, e = self._recv(blen)
+        if rv < 0:
+          self._state = HTTPRequest.STATE_ERROR
+          return -12, self._state, "Failed to decode chunked body"
+
+        if not self._flush():
+          self._state = HTTPRequest.STATE_ERROR
+          return -13, self._state, "Failed to write body to sink"
+
+        if rv == 0:
+          self._finish(self._keep())
+          return 0, self._state, ""
+
+        # need more bytes; we know how many if we're in a chunk, but a sink
+        # gets them a block at a time
+
+        rv, e = self._recv(self._blocksize if self._sink != None else max(self._chunk, self._blocksize))
 
         if rv < 0:
           self._state = HTTPRequest.STATE_ERROR
@@ -383,26 +1620,62 @@ class HTTPRequest(object):
         if rv > 0:
           return 0, self._state, ""
 
+        if e:
+          self._state = HTTPRequest.STATE_ERROR
+          return -11, self._state, "Failed to read response body"
+
+      elif self._state == HTTPRequest.STATE_RCV3:
+
+        # whatever's past the headers is body
+
+        self._bend = self._bend + self._rlen - self._rpos
+        self._bcount = self._bcount + self._rlen - self._rpos
+        self._rpos = self._rlen
+
+        if not self._flush():
+          self._state = HTTPRequest.STATE_ERROR
+          return -13, self._state, "Failed to write body to sink"
+
+        # were we given content-length?
+
+        clen = "content-length" in self._rsp_headers
+        blen = int(self._rsp_headers["content-length"]) if clen else 0
+
         # are we done?
-        # we are, if response had content-length and we've read at least as much
-        # or, response didn't, and we've seen EOF
+        # we are, if response had content-length and we've read at least as
+        # much, or it never has a body, or response had no content-length and
+        # we've seen EOF
+        # an empty body has to be caught before reading, since a kept-alive
+        # connection won't give us an EOF
 
-        if (blen > 0 and len(self._buf) >= blen) or (blen == 0 and e):
+        if (clen and self._bcount >= blen) or self._rsp_status[0] in (204, 304) or (not clen and self._eof):
 
-          self._state = HTTPRequest.STATE_DONE
+          self._finish(self._keep() and not self._eof)
           return 0, self._state, ""
 
-        # not done yet if response had content-length and we haven't read as
-        # much and we haven't seen EOF, or response had no content-length and
-        # we haven't seen EOF
+        # EOF before content-length
 
-        if (blen > 0 and len(self._buf) < blen and not e) or (blen == 0 and not e):
-          continue
+        if self._eof:
+          self._state = HTTPRequest.STATE_ERROR
+          return -11, self._state, "Failed to read response body"
 
-        # all other cases are error conditions
+        # read the rest; a sink gets it a block at a time
 
-        self._state = HTTPRequest.STATE_ERROR
-        return -11, self._state, "Failed to read response body"
+        n = blen - self._bcount if clen else 0
+
+        if self._sink != None and n > self._blocksize:
+          n = self._blocksize
+
+        rv, e = self._recv(n)
+
+        if rv < 0:
+          self._state = HTTPRequest.STATE_ERROR
+          return -10, self._state, "recv() failed: %s" % (errno.errorcode[e] if e in errno.errorcode else "unknown")
+
+        if rv > 0:
+          return 0, self._state, ""
+
+        self._eof = e
 
       else:
 
@@ -419,11 +1692,173 @@ class HTTPRequest(object):
   #   headers:
   #     { %s: %s, ... }
   #   body:
-  #     %s
+  #     %s, or if raw, a memoryview of the body bytes, only valid until reset()
+  #     empty if body went to a sink
+  # a response that hasn't changed, or was fresh in the cache, is returned as
+  # it was cached
 
-  def get_response(self):
+  def get_response(self, raw=False):
 
     if self._state != HTTPRequest.STATE_DONE:
-      return (0, ""), {}, ""
+      return (0, ""), {}, memoryview(b"") if raw else ""
+
+    if self._hit != None:
+      return self._hit[3], self._hit[4], memoryview(self._hit[5]) if raw else str(self._hit[5], "utf-8")
+
+    if raw:
+      return self._rsp_status, self._rsp_headers, memoryview(self._rbuf)[self._bpos:self._bend]
+
+    return self._rsp_status, self._rsp_headers, str(self._rbuf[self._bpos:self._bend], "utf-8")
+
+
+# drives many requests at once, over one poller
+# requests are submitted, then driven by serve(), which polls once and only
+# calls request() on those whose sockets are ready
+
+class HTTPPool(object):
+
+  def __init__(self):
+
+    self._poller = xpoll.XPoll()
+
+    # [request, callback, registered socket, registered event mask]
+
+    self._entries = []
+
+    # socket: entry
+
+    self._sockets = {}
+
+
+  def __len__(self):
+
+    return len(self._entries)
+
+
+  # start driving a request that has been set() or reset()
+  # fn(request, rv) is called once it's done or has failed, with the return
+  # value of its last request() call
+  #   return False if it's already in the pool
+
+  def submit(self, req, fn=None):
+
+    for entry in self._entries:
+      if entry[0] == req:
+        return False
+
+    self._entries.append([ req, fn, None, 0 ])
+
+    return True
+
+
+  def _unregister(self, entry):
+
+    if entry[2] == None:
+      return
+
+    self._poller.unregister(entry[2])
+
+    if entry[2] in self._sockets:
+      del self._sockets[entry[2]]
+
+    entry[2] = None
+    entry[3] = 0
+
+
+  def remove(self, req):
+
+    for entry in self._entries:
+      if entry[0] == req:
+        self._unregister(entry)
+        self._entries.remove(entry)
+        return True
+
+    return False
+
+
+  # keep the registration in step with the request's socket, which changes on
+  # reconnects and tls wrapping, and with what it's waiting for
+
+  def _sync(self, entry):
+
+    sock = entry[0].socket()
+    mask = entry[0].wants()
+
+    if sock != entry[2]:
+      self._unregister(entry)
+
+      if sock == None:
+        return
+
+      self._poller.register(sock, mask)
+      self._sockets[sock] = entry
+
+    elif mask != entry[3]:
+      self._poller.modify(sock, mask)
+
+    entry[2] = sock
+    entry[3] = mask
+
+
+  # drive the request, and see if it's done
+  #   return True if it is
+
+  def _drive(self, entry, events, done):
+
+    rv = entry[0].request(events)
+
+    if rv[0] == 0 and rv[1] != HTTPRequest.STATE_DONE:
+      self._sync(entry)
+      return False
+
+    self._unregister(entry)
+    self._entries.remove(entry)
+
+    if entry[1] != None:
+      entry[1](entry[0], rv)
+
+    done.append((entry[0], rv))
+
+    return True
+
+
+  # poll once, and drive whichever requests are ready
+  #   timeout: msecs to wait for something to be ready
+  #   return [ (request, rv), ... ] of requests that are done or have failed
+
+  def serve(self, timeout=0):
+
+    done = []
+
+    # requests that haven't started yet don't have anything to wait for
+
+    for entry in self._entries[:]:
+      if entry[2] == None:
+        self._drive(entry, None, done)
+
+    # collect first, as we can't touch registrations while iterating; the
+    # tuples ipoll() gives may also be reused
+
+    ready = []
+
+    for x in self._poller.ipoll(timeout):
+      if x[0] in self._sockets:
+        ready.append((self._sockets[x[0]], x[1]))
+
+    for entry, events in ready:
+      if entry in self._entries:
+        self._drive(entry, events, done)
+
+    # tls may have decrypted bytes left over that no poll will tell us about
+
+    for entry in self._entries[:]:
+      if entry[0].pending():
+        self._drive(entry, xpoll.POLLIN, done)
+
+    # requests that are past a deadline won't ever be ready, so fail them
+
+    for entry in self._entries[:]:
+      if entry[0].expired():
+        self._drive(entry, 0, done)
 
-    return self._rsp_status, self._rsp_headers, self._buf
+    return done
@@ -8,21 +8,290 @@
 # quick-and-dirty tick-based webserver
 
 
+import os
 import socket
-import select
+import struct
 import re
 
+import xpoll
+import xtime
+
 
 _DEFAULT_PORT = 80
 _DEFAULT_BACKLOG = 2
 _DEFAULT_TIMEOUT = 30000
-_DEFAULT_TEMPLATE = "HTTP/1.0 %STATUS%\r\nContent-Type: text/plain; charset=iso-8859-1\r\nContent-Length: %LENGTH%\r\n\r\n%CONTENT%"
+_DEFAULT_MAX_CLIENTS = 4
+_DEFAULT_MAX_ACCEPT = 2
+_DEFAULT_RATE_LIMIT = 0
+_DEFAULT_RATE_BURST = 5
+_DEFAULT_RATE_PEERS = 8
+_DEFAULT_LOG_SIZE = 0
+_DEFAULT_TEMPLATE = "HTTP/1.0 %STATUS%\r\nContent-Type: %TYPE%\r\nContent-Length: %LENGTH%\r\n%HEADERS%\r\n%CONTENT%"
 _DEFAULT_REQMAP = {"/" : ""}
+_DEFAULT_TYPE_TEXT = "text/plain; charset=iso-8859-1"
+_DEFAULT_TYPE_BINARY = "application/octet-stream"
+_DEFAULT_WORKERS = 2
+_DEFAULT_INTERVAL = 10
+_DEFAULT_PIPE_MAX = 65536
 
 _RECV_BLOCKSIZE = 32
+_SEND_BLOCKSIZE = 256
 
 
 _re_header = re.compile("^([A-Za-z]+) +(\S+) +(HTTP\/[0-9]+\.[0-9]+)\r\n.*")
+_re_accept = re.compile("\r\n[Aa][Cc][Cc][Ee][Pp][Tt]: *([^\r]*)\r\n")
+_re_range = re.compile("\r\n[Rr][Aa][Nn][Gg][Ee]: *bytes=([0-9]*)-([0-9]*)\r\n")
+
+
+# make sure the template has somewhere to put extra header lines
+# templates without %HEADERS% get them right before the end of the header section
+
+def _prepare(template):
+
+  if template.find("%HEADERS%") >= 0:
+    return template
+
+  i = template.find("\r\n\r\n")
+
+  if i < 0:
+    return template
+
+  return template[:i + 2] + "%HEADERS%" + template[i + 2:]
+
+
+# fill in the given template with the given status and content
+
+def _response(template, status, content, headers=""):
+
+  return template.replace("%STATUS%", status).replace("%TYPE%", _DEFAULT_TYPE_TEXT).replace("%LENGTH%", str(len(content))).replace("%HEADERS%", headers).replace("%CONTENT%", content).encode()
+
+
+# file-backed request map content
+# the file is streamed from storage on each request instead of being held in memory
+
+class File(object):
+
+  def __init__(self, path):
+
+    self._path = path
+
+
+  def path(self):
+
+    return self._path
+
+
+  # returns the file size, or -1 if the file is missing
+
+  def size(self):
+
+    try:
+      return os.stat(self._path)[6]
+    except:
+      return -1
+
+
+  def open(self):
+
+    return open(self._path, "rb")
+
+
+# get a hashable peer identifier from the address returned by accept()
+# some micropython ports return a raw sockaddr instead of an (ip, port) tuple
+
+def _peer(caddr):
+
+  if isinstance(caddr, tuple):
+    return caddr[0]
+
+  return bytes(caddr[4:8])
+
+
+# fixed size table of per-peer token buckets
+# the least recently seen peer is evicted when the table is full
+# slots are kept in a doubly linked list in most to least recently seen order,
+# so both lookup and eviction are O(1)
+# tokens are scaled so that one request costs 60000 and a bucket gains rate
+# tokens per msec, which keeps the arithmetic in ints
+
+class _RateLimiter(object):
+
+  _COST = 60000
+
+  # rate: requests per minute
+  # burst: max requests allowed back-to-back
+  # size: number of peers tracked
+
+  def __init__(self, rate, burst, size):
+
+    self._rate = rate
+    self._cap = burst * _RateLimiter._COST
+
+    self._index = {}
+    self._keys = [ None ] * size
+    self._tokens = [ 0 ] * size
+    self._stamps = [ 0 ] * size
+    self._prev = [ i - 1 for i in range(0, size) ]
+    self._next = [ i + 1 for i in range(0, size) ]
+    self._next[size - 1] = -1
+    self._head = 0
+    self._tail = size - 1
+
+
+  # move slot i to the head of the list
+
+  def _touch(self, i):
+
+    if i == self._head:
+      return
+
+    # unlink
+
+    p = self._prev[i]
+    n = self._next[i]
+
+    self._next[p] = n
+
+    if n >= 0:
+      self._prev[n] = p
+    else:
+      self._tail = p
+
+    # relink at head
+
+    self._prev[i] = -1
+    self._next[i] = self._head
+    self._prev[self._head] = i
+    self._head = i
+
+
+  # returns True if peer may proceed, False if it is over the limit
+
+  def allow(self, peer, now):
+
+    i = self._index.get(peer, -1)
+
+    if i < 0:
+
+      # new peer; take over the least recently seen slot
+
+      i = self._tail
+
+      if self._keys[i] != None:
+        del self._index[self._keys[i]]
+
+      self._keys[i] = peer
+      self._index[peer] = i
+      self._tokens[i] = self._cap
+
+    else:
+
+      # known peer; refill its bucket, ignoring time going backwards
+
+      elapsed = now - self._stamps[i]
+
+      if elapsed > 0:
+        self._tokens[i] = min(self._cap, self._tokens[i] + elapsed * self._rate)
+
+    self._stamps[i] = now
+    self._touch(i)
+
+    if self._tokens[i] < _RateLimiter._COST:
+      return False
+
+    self._tokens[i] = self._tokens[i] - _RateLimiter._COST
+
+    return True
+
+
+# ipv4 address as 4 bytes, or zeros if it isn't one
+
+def _peer_bytes(peer):
+
+  if isinstance(peer, bytes):
+    return peer
+
+  try:
+    return bytes([ int(x) for x in peer.split(".") ])
+  except:
+    return b"\x00\x00\x00\x00"
+
+
+# fixed size ring buffer of access log entries, preallocated at construction
+# the last size entries are kept; entries not yet flushed when they are
+# overwritten are counted as dropped
+#   entry format: <secs since unix epoch:4> <ipv4 peer:4> <path index:2> <status:2> <bytes sent:4> <latency msecs:2>
+
+class AccessLog(object):
+
+  NO_PATH = 0xffff
+
+  _FMT = "<I4sHHIH"
+  _LEN = struct.calcsize(_FMT)
+
+  # paths: list of paths, indexed by the path index of each entry
+
+  def __init__(self, size, paths):
+
+    self._size = size
+    self._paths = paths
+    self._buf = bytearray(size * AccessLog._LEN)
+    self._total = 0
+    self._flushed = 0
+    self._dropped = 0
+
+
+  # entry n as a line of text
+  #   line format: <secs since unix epoch> <peer> <path> <status> <bytes sent> <latency msecs>
+
+  def _line(self, n):
+
+    e = struct.unpack_from(AccessLog._FMT, self._buf, (n % self._size) * AccessLog._LEN)
+
+    return "%d %d.%d.%d.%d %s %d %d %d\n" % (e[0], e[1][0], e[1][1], e[1][2], e[1][3], self._paths[e[2]] if e[2] < len(self._paths) else "-", e[3], e[4], e[5])
+
+
+  def record(self, ssecs, peer, pidx, status, nbytes, latency):
+
+    # about to overwrite an entry that was never flushed?
+
+    if self._total - self._flushed >= self._size:
+      self._flushed = self._flushed + 1
+      self._dropped = self._dropped + 1
+
+    struct.pack_into(AccessLog._FMT, self._buf, (self._total % self._size) * AccessLog._LEN, ssecs & 0xffffffff, peer, pidx, status, nbytes & 0xffffffff, max(0, min(latency, 0xffff)))
+
+    self._total = self._total + 1
+
+
+  def dropped(self):
+
+    return self._dropped
+
+
+  # calls fn(line) for up to count of the oldest unflushed entries, or all of
+  # them if count is 0
+  # returns the number of entries flushed
+
+  def flush(self, fn, count=0):
+
+    n = self._total - self._flushed
+
+    if count > 0:
+      n = min(n, count)
+
+    for i in range(0, n):
+      fn(self._line(self._flushed))
+      self._flushed = self._flushed + 1
+
+    return n
+
+
+  # renders every entry in the buffer as text, oldest first
+
+  def render(self):
+
+    return "".join([ self._line(i) for i in range(max(0, self._total - self._size), self._total) ])
 
 
 class Client(object):
@@ -33,16 +302,39 @@ class Client(object):
   STATE_XX = 3
 
 
-  def __init__(self, xt, sock, expiry=0):
+  # peer, start and tp are only used for access logging
+  #   start: secs since the unix epoch the connection was accepted
+  #   tp: xt.tp_now() when the connection was accepted, to time it with
+
+  def __init__(self, xt, sock, expiry=0, peer=None, start=0, tp=None):
 
     self._xt = xt
     self._sock = sock
-    self._poller = select.poll()
+    self._poller = xpoll.XPoll()
     self._buf = ""
     self._state = Client.STATE_RD
     self._expiry = expiry
 
-    self._poller.register(self._sock, select.POLLIN | select.POLLOUT)
+    self._peer = peer
+    self._start = start
+    self._tp = tp
+    self._latency = 0
+    self._path = None
+    self._status = 0
+    self._sent = 0
+
+    # response chunks waiting to be sent; None marks where the file content goes
+
+    self._out = []
+    self._file = None
+    self._left = 0
+    self._blk = None
+
+    # generation of the reqmap the response came from
+
+    self._gen = 0
+
+    self._poller.register(self._sock, xpoll.POLLIN | xpoll.POLLOUT)
 
 
   def state(self):
@@ -50,6 +342,18 @@ class Client(object):
     return self._state
 
 
+  def generation(self):
+
+    return self._gen
+
+
+  # returns peer, start, path, status, bytes sent, msecs from accept to close
+
+  def stats(self):
+
+    return self._peer, self._start, self._path, self._status, self._sent, self._latency
+
+
   def expired(self, now=None):
 
     if self._expiry == 0:
@@ -65,12 +369,150 @@ class Client(object):
 
   def close(self):
 
+    if self._tp != None:
+      self._latency = self._xt.tp_diff(self._xt.tp_now(), self._tp)
+
     self._sock.close()
+    self._poller.close()
+
+    if self._file != None:
+      self._file.close()
+      self._file = None
 
     self._buf = ""
+    self._out = []
     self._state = Client.STATE_XX
 
 
+  # parse the range header, if any, against content of the given size
+  #   return  None : no range requested, or range ignored
+  #   return  (-1, -1) : range not satisfiable
+  #   return  (start, end) : inclusive byte range
+
+  def _range(self, size):
+
+    m = _re_range.search(self._buf)
+
+    if m == None:
+      return None
+
+    a = m.group(1)
+    b = m.group(2)
+
+    if len(a) == 0 and len(b) == 0:
+      return None
+
+    # suffix range: last b bytes
+
+    if len(a) == 0:
+      if int(b) == 0:
+        return -1, -1
+      return max(0, size - int(b)), size - 1
+
+    start = int(a)
+    end = size - 1
+
+    if len(b) > 0:
+      end = min(end, int(b))
+
+    if start >= size or end < start:
+      return -1, -1
+
+    return start, end
+
+
+  # pick the variant whose content type the accept header gives the highest
+  # q-value, if it lists any; otherwise, the first one it doesn't refuse with
+  # q=0, or the first one if it refuses them all
+  # wildcards don't pick or refuse anything
+  #   variants: [ (content-type, content), ... ]
+
+  def _negotiate(self, variants):
+
+    m = _re_accept.search(self._buf)
+
+    if m == None:
+      return variants[0]
+
+    # content-type: q-value
+
+    qs = {}
+
+    for r in m.group(1).split(","):
+
+      r = r.split(";")
+      q = 1.0
+
+      for p in r[1:]:
+        p = p.strip()
+        if p.startswith("q="):
+          try:
+            q = float(p[2:])
+          except:
+            q = 0.0
+
+      qs[r[0].strip().lower()] = q
+
+    best = None
+    first = None
+
+    for v in variants:
+
+      q = qs.get(v[0].split(";", 1)[0].lower())
+
+      if q == None:
+        if first == None:
+          first = v
+      elif q > 0.0 and (best == None or q > best[0]):
+        best = (q, v)
+
+    if best != None:
+      return best[1]
+
+    return first if first != None else variants[0]
+
+
+  # get the next chunk of the response to be sent into self._buf
+  #   return True : there is something to send
+  #   return False : response fully sent
+
+  def _next(self):
+
+    while len(self._out) > 0:
+
+      chunk = self._out[0]
+
+      if chunk != None:
+        self._out.pop(0)
+        if len(chunk) > 0:
+          self._buf = chunk
+          return True
+        continue
+
+      # stream the next block of the file
+
+      n = 0
+
+      if self._left > 0:
+        n = self._file.readinto(memoryview(self._blk)[:min(self._left, len(self._blk))])
+
+      if n != None and n > 0:
+        self._left = self._left - n
+        self._buf = memoryview(self._blk)[:n]
+        return True
+
+      self._file.close()
+      self._file = None
+      self._out.pop(0)
+
+      # file got shorter under us; all we can do is cut the response short
+
+      if self._left > 0:
+        self._out = []
+
+    return False
+
+
   def read(self):
 
     if self._state != Client.STATE_RD:
@@ -80,13 +522,13 @@ class Client(object):
 
     while(True):
 
-      pe = ([ x[1] for x in list(self._poller.poll(0)) ] + [ 0 ])[0]
+      pe = self._poller.events(0)
 
-      if pe & select.POLLERR or pe & select.POLLHUP:
+      if pe & xpoll.POLLERR or pe & xpoll.POLLHUP:
         self.close()
         return False
 
-      if pe & select.POLLIN == 0:
+      if pe & xpoll.POLLIN == 0:
         break
 
       tmp = ""
@@ -111,37 +553,124 @@ class Client(object):
     return True
 
 
-  def process(self, template, reqmap):
+  # gen: generation of reqmap, see Webserver.generation()
+
+  def process(self, template, reqmap, gen=0):
 
     if self._state != Client.STATE_PR:
       return False
 
-    # strip out everything after the first line
-
-    i = self._buf.find("\r\n")
-
-    if i > 0:
-      self._buf = self._buf[:i + 2]
+    self._gen = gen
 
     status = ""
-    content = ""
+    headers = ""
+    ctype = _DEFAULT_TYPE_TEXT
+    content = None
+    head = False
+    start = 0
+    end = -1
 
     m = _re_header.match(self._buf)
 
+    if m != None:
+      head = m.group(1) == "HEAD"
+      self._path = m.group(2)
+
     if m == None:
       status = "400 Bad Request"
-      content = status + "\n"
-    elif m.group(1) != "GET":
+    elif m.group(1) != "GET" and not head:
       status = "405 Method Not Allowed"
-      content = status + "\n"
+      headers = "Allow: GET, HEAD\r\n"
     elif m.group(2) not in reqmap:
       status = "404 Not Found"
-      content = status + "\n"
     else:
-      status = "200 OK"
+
       content = reqmap[m.group(2)]
+      size = 0
+
+      if isinstance(content, list):
+        content = self._negotiate(content)
+
+      if isinstance(content, tuple):
+        ctype, content = content
+      elif not isinstance(content, str) and not isinstance(content, AccessLog):
+        ctype = _DEFAULT_TYPE_BINARY
+
+      if isinstance(content, AccessLog):
+        content = content.render()
+
+      if isinstance(content, File):
+        size = content.size()
+      else:
+        if isinstance(content, str):
+          content = content.encode()
+        size = len(content)
+
+      r = self._range(size) if size >= 0 else None
+
+      if size < 0:
+        status = "404 Not Found"
+        content = None
+      elif r == None:
+        status = "200 OK"
+        headers = "Accept-Ranges: bytes\r\n"
+
+        if isinstance(reqmap[m.group(2)], list):
+          headers = headers + "Vary: Accept\r\n"
+        end = size - 1
+      elif r[0] < 0:
+        status = "416 Range Not Satisfiable"
+        headers = "Content-Range: bytes */%d\r\n" % (size)
+        content = None
+      else:
+        status = "206 Partial Content"
+        headers = "Accept-Ranges: bytes\r\nContent-Range: bytes %d-%d/%d\r\n" % (r[0], r[1], size)
+        start = r[0]
+        end = r[1]
+
+    # errors get the status line as content
+
+    if content == None:
+      ctype = _DEFAULT_TYPE_TEXT
+      content = (status + "\n").encode()
+      end = len(content) - 1
+
+    # split template into the parts before and after the content
+
+    i = template.find("%CONTENT%")
+    tail = ""
+
+    if i >= 0:
+      tail = template[i + 9:]
+      template = template[:i]
+
+    length = str(end - start + 1)
+
+    self._status = int(status[:3])
+
+    self._buf = ""
+    self._out = [ template.replace("%STATUS%", status).replace("%TYPE%", ctype).replace("%LENGTH%", length).replace("%HEADERS%", headers).encode() ]
+
+    if not head:
+
+      if isinstance(content, File):
+
+        try:
+          self._file = content.open()
+          self._file.seek(start)
+        except:
+          self.close()
+          return False
+
+        self._left = end - start + 1
+        self._blk = bytearray(_SEND_BLOCKSIZE)
+        self._out.append(None)
+
+      else:
+        self._out.append(memoryview(content)[start:end + 1])
+
+      self._out.append(tail.replace("%STATUS%", status).replace("%TYPE%", ctype).replace("%LENGTH%", length).replace("%HEADERS%", headers).encode())
 
-    self._buf = template.replace("%STATUS%", status).replace("%LENGTH%", str(len(content))).replace("%CONTENT%", content).encode()
     self._state = Client.STATE_WR
 
     return True
@@ -158,17 +687,17 @@ class Client(object):
 
       # are we done yet?
 
-      if len(self._buf) == 0:
+      if len(self._buf) == 0 and not self._next():
         self.close()
         return True
 
-      pe = ([ x[1] for x in list(self._poller.poll(0)) ] + [ 0 ])[0]
+      pe = self._poller.events(0)
 
-      if pe & select.POLLERR or pe & select.POLLHUP:
+      if pe & xpoll.POLLERR or pe & xpoll.POLLHUP:
         self.close()
         return False
 
-      if pe & select.POLLOUT == 0:
+      if pe & xpoll.POLLOUT == 0:
         break
 
       n = 0
@@ -184,6 +713,7 @@ class Client(object):
         return False
 
       self._buf = self._buf[n:]
+      self._sent = self._sent + n
 
     # there is still data to be written, but the peer is not ready to receive yet
 
@@ -192,15 +722,49 @@ class Client(object):
 
 class Webserver(object):
 
-  def __init__(self, xt, port=_DEFAULT_PORT, backlog=_DEFAULT_BACKLOG, timeout=_DEFAULT_TIMEOUT, template=_DEFAULT_TEMPLATE):
+  # max_clients: max number of live clients, 0 for no limit
+  # max_accept: max number of connections accepted per serve() pass, 0 for no limit
+  # reject: if True, connections over max_clients are accepted then sent a 503,
+  #         otherwise they are left in the listen backlog until a slot frees up
+  # rate_limit: max requests per minute per peer address, 0 for no limit
+  # rate_burst: max back-to-back requests per peer address
+  # rate_peers: number of peer addresses tracked by the rate limiter
+  # log_size: number of entries kept in the access log, 0 for no access log
+  # log_path: if given, the path on which the access log is served
+
+  def __init__(self, xt, port=_DEFAULT_PORT, backlog=_DEFAULT_BACKLOG, timeout=_DEFAULT_TIMEOUT, template=_DEFAULT_TEMPLATE, max_clients=_DEFAULT_MAX_CLIENTS, max_accept=_DEFAULT_MAX_ACCEPT, reject=False, rate_limit=_DEFAULT_RATE_LIMIT, rate_burst=_DEFAULT_RATE_BURST, rate_peers=_DEFAULT_RATE_PEERS, log_size=_DEFAULT_LOG_SIZE, log_path=None):
 
     self._xt = xt
     self._port = port
     self._backlog = backlog
     self._timeout = timeout
-    self._template = template
+    self._template = _prepare(template)
+    self._max_clients = max_clients
+    self._max_accept = max_accept
+    self._reject = reject
+
+    self._limiter = None
+
+    if rate_limit > 0 and rate_peers > 0:
+      self._limiter = _RateLimiter(rate_limit, rate_burst, rate_peers)
+
+    # pre-encode the overload responses so we don't have to build them under load
+
+    self._rsp_503 = _response(self._template, "503 Service Unavailable", "503 Service Unavailable\n")
+    self._rsp_429 = _response(self._template, "429 Too Many Requests", "429 Too Many Requests\n")
+
+    # access log entries refer to paths by their index in self._paths
+
+    self._log = None
+    self._log_path = log_path
+    self._paths = []
+    self._pindex = {}
+
+    if log_size > 0:
+      self._log = AccessLog(log_size, self._paths)
 
     self._reqmap = None 
+    self._gen = 0
     self._ssock = None
     self._poller = None
     self._clients = []
@@ -208,25 +772,86 @@ class Webserver(object):
     self.clear()
 
 
+  # reqmap: { path: content, ... }
+  #   content is one of:
+  #     str: text/plain
+  #     bytes, bytearray, memoryview: application/octet-stream
+  #     File: streamed from storage as application/octet-stream
+  #     (content-type, content): content served as the given content type
+  #     [ (content-type, content), ... ]: picked according to the accept header
+
   def set(self, reqmap):
 
     self._reqmap.update(reqmap)
+    self._gen = self._gen + 1
+
+    if self._log != None:
+      for path in reqmap:
+        if path not in self._pindex and len(self._paths) < AccessLog.NO_PATH:
+          self._pindex[path] = len(self._paths)
+          self._paths.append(path)
 
 
   def clear(self):
 
     self._reqmap = _DEFAULT_REQMAP.copy()
+    self._gen = self._gen + 1
 
+    if self._log != None and self._log_path != None:
+      self.set({ self._log_path: self._log })
 
-  def start(self):
+
+  # each set() or clear() starts a new generation of the reqmap
+  # content that is updated in place, rather than replaced, must not be
+  # touched while oldest() is still older than the generation it was
+  # replaced in, as clients may still be sending from it
+
+  def generation(self):
+
+    return self._gen
+
+
+  # the oldest generation any client is still sending a response from, or
+  # the current one if none are
+
+  def oldest(self):
+
+    gen = self._gen
+
+    for client in self._clients:
+      if client.state() == Client.STATE_WR:
+        gen = min(gen, client.generation())
+
+    return gen
+
+
+  # hand the oldest unflushed access log entries to fn(); see AccessLog.flush()
+  # meant to be called outside of serve(), when there is time to spare
+
+  def flush_log(self, fn, count=0):
+
+    if self._log == None:
+      return 0
+
+    return self._log.flush(fn, count)
+
+
+  # reuseport: if True, allow other processes to bind to the same port, and
+  #            let the kernel distribute connections between them
+
+  def start(self, reuseport=False):
 
     self._ssock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     self._ssock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    if reuseport:
+      self._ssock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
     self._ssock.bind(socket.getaddrinfo("0", self._port, socket.AF_INET, socket.SOCK_STREAM)[0][-1])
     self._ssock.listen(self._backlog)
 
-    self._poller = select.poll()
-    self._poller.register(self._ssock, select.POLLIN)
+    self._poller = xpoll.XPoll()
+    self._poller.register(self._ssock, xpoll.POLLIN)
 
 
   def stop(self):
@@ -234,6 +859,9 @@ class Webserver(object):
     self._ssock.close()
     self._ssock = None
 
+    self._poller.close()
+    self._poller = None
+
     for client in filter(lambda x: x.state() != Client.STATE_XX, self._clients):
       client.close()
 
@@ -241,6 +869,32 @@ class Webserver(object):
       self._clients.remove(client)
 
 
+  # send a pre-encoded response to a connection we are not going to serve, then drop it
+
+  def _refuse(self, csock, rsp):
+
+    try:
+      csock.setblocking(False)
+      csock.send(rsp)
+    except:
+      pass
+
+    # drain whatever request bytes have already arrived so that close() does
+    # not reset the connection before the peer reads the response
+
+    try:
+      for i in range(0, 8):
+        if len(csock.recv(_RECV_BLOCKSIZE)) == 0:
+          break
+    except:
+      pass
+
+    try:
+      csock.close()
+    except:
+      pass
+
+
   # now is assumed to be an int representing the millisecs since epoch, or None
 
   def serve(self, now=None):
@@ -249,27 +903,56 @@ class Webserver(object):
       return
 
     if now == None:
-      if self._timeout > 0:
+      if self._timeout > 0 or self._limiter != None or self._log != None:
         now = self._xt.time_ms()
       else:
         now = 0
 
-    # accept all pending connections
+    # access log timestamps are on the unix epoch, like the readings
 
-    while True:
- 
-      pe = ([ x[1] for x in list(self._poller.poll(0)) ] + [ 0 ])[0]
+    ssecs = (now // 1000) + xtime.EPOCH_OFFSET
+
+    # accept pending connections, up to max_accept per pass
+
+    accepted = 0
+
+    while self._max_accept <= 0 or accepted < self._max_accept:
+
+      # at capacity? unless we're rejecting, leave the rest in the backlog
+
+      full = self._max_clients > 0 and len(self._clients) >= self._max_clients
 
-      if pe & select.POLLIN == 0:
+      if full and not self._reject:
+        break
+
+      pe = self._poller.events(0)
+
+      if pe & xpoll.POLLIN == 0:
         break
 
       csock, caddr = self._ssock.accept()
+      accepted = accepted + 1
+
+      peer = _peer(caddr)
+
+      if full:
+        self._refuse(csock, self._rsp_503)
+        if self._log != None:
+          self._log.record(ssecs, _peer_bytes(peer), AccessLog.NO_PATH, 503, len(self._rsp_503), 0)
+        continue
+
+      if self._limiter != None and not self._limiter.allow(peer, now):
+        self._refuse(csock, self._rsp_429)
+        if self._log != None:
+          self._log.record(ssecs, _peer_bytes(peer), AccessLog.NO_PATH, 429, len(self._rsp_429), 0)
+        continue
+
       expiry = 0
 
       if self._timeout > 0:
         expiry = now + self._timeout
 
-      self._clients.append(Client(self._xt, csock, expiry))
+      self._clients.append(Client(self._xt, csock, expiry, peer, ssecs, self._xt.tp_now() if self._log != None else None))
 
     # read
 
@@ -279,7 +962,7 @@ class Webserver(object):
     # process
 
     for client in filter(lambda x: x.state() == Client.STATE_PR, self._clients):
-      client.process(self._template, self._reqmap)
+      client.process(self._template, self._reqmap, self._gen)
 
     # write
 
@@ -294,5 +977,421 @@ class Webserver(object):
 
     # clean
 
-    for client in filter(lambda x: x.state() == Client.STATE_XX, self._clients):
+    for client in list(filter(lambda x: x.state() == Client.STATE_XX, self._clients)):
+
+      if self._log != None:
+        peer, start, path, status, sent, latency = client.stats()
+        self._log.record(start, _peer_bytes(peer), self._pindex.get(path, AccessLog.NO_PATH), status, sent, latency)
+
       self._clients.remove(client)
+
+
+# cpython only: forks a number of worker processes, each running its own
+# Webserver on the same port with SO_REUSEPORT
+# request map updates are forwarded to the workers over a pipe per worker
+#   pipe message format: <op:1> <path length:4> <content length:4> <path> <content>
+#   the low bits of op say what it is; the high bits are flags:
+#     _OP_F_TYPED: content is <content type> 0x00 <content>
+#     _OP_F_LIST: content is one of a list of variants, and _OP_F_MORE says
+#       there are more to come; the list is only set once it's complete
+# the pipes are non-blocking; what a worker hasn't read yet is queued, and a
+# worker that falls more than pipe_max bytes behind is killed and replaced
+# access log lines come back from the workers over a second pipe per worker,
+# when asked for with _OP_FLUSH_LOG
+
+class ForkingWebserver(object):
+
+  _OP_SET = 0
+  _OP_CLEAR = 1
+  _OP_SET_BYTES = 2
+  _OP_SET_FILE = 3
+  _OP_FLUSH_LOG = 4
+
+  _OP_MASK = 0x0f
+  _OP_F_MORE = 0x20
+  _OP_F_TYPED = 0x40
+  _OP_F_LIST = 0x80
+
+  _HDR_FMT = "!BII"
+  _HDR_LEN = struct.calcsize(_HDR_FMT)
+
+  # workers: number of worker processes
+  # interval: max msecs a worker waits for activity between serve() passes
+  # pipe_max: max bytes queued for a worker before it is replaced
+  # everything else is passed on to each worker's Webserver
+
+  def __init__(self, xt, workers=_DEFAULT_WORKERS, interval=_DEFAULT_INTERVAL, pipe_max=_DEFAULT_PIPE_MAX, **kwargs):
+
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+      raise NotImplementedError
+
+    self._xt = xt
+    self._workers = workers
+    self._interval = interval
+    self._pipe_max = pipe_max
+    self._kwargs = kwargs
+
+    self._reqmap = None
+    self._gen = 0
+
+    # pid: [ request pipe fd, queued bytes, log pipe fd, partial log line ]
+
+    self._pids = {}
+    self._lines = []
+
+    self.clear()
+
+
+  # encode content as op and bytes; None if it can't be forwarded
+
+  def _encode(self, content):
+
+    ctype = None
+
+    if isinstance(content, tuple):
+      ctype, content = content
+
+    if isinstance(content, str):
+      op, content = ForkingWebserver._OP_SET, content.encode()
+    elif isinstance(content, File):
+      op, content = ForkingWebserver._OP_SET_FILE, content.path().encode()
+    elif isinstance(content, (bytes, bytearray, memoryview)):
+      op, content = ForkingWebserver._OP_SET_BYTES, bytes(content)
+    else:
+      return None
+
+    if ctype != None:
+      op, content = op | ForkingWebserver._OP_F_TYPED, ctype.encode() + b"\x00" + content
+
+    return op, content
+
+
+  def _decode(self, op, content):
+
+    ctype = None
+
+    if op & ForkingWebserver._OP_F_TYPED:
+      i = content.index(b"\x00")
+      ctype, content = content[:i].decode(), content[i + 1:]
+
+    op = op & ForkingWebserver._OP_MASK
+
+    if op == ForkingWebserver._OP_SET:
+      content = content.decode()
+    elif op == ForkingWebserver._OP_SET_FILE:
+      content = File(content.decode())
+
+    return content if ctype == None else (ctype, content)
+
+
+  def _send(self, op, path, content):
+
+    path = path.encode()
+
+    msg = struct.pack(ForkingWebserver._HDR_FMT, op, len(path), len(content)) + path + content
+
+    for pid in list(self._pids):
+      self._pids[pid][1] = self._pids[pid][1] + msg
+      self._flush(pid)
+
+
+  # write as much of what is queued for a worker as its pipe will take
+
+  def _flush(self, pid):
+
+    w = self._pids[pid]
+
+    if len(w[1]) == 0:
+      return
+
+    try:
+      n = os.write(w[0], w[1])
+    except BlockingIOError:
+      n = 0
+    except:
+      self._replace(pid)
+      return
+
+    w[1] = w[1][n:]
+
+    # too far behind; a new one gets the whole request map when it forks
+
+    if len(w[1]) > self._pipe_max:
+      self._replace(pid)
+
+
+  # read whatever access log lines the workers have sent back
+
+  def _recv(self):
+
+    for pid in list(self._pids):
+
+      w = self._pids[pid]
+
+      while True:
+
+        try:
+          tmp = os.read(w[2], 4096)
+        except:
+          break
+
+        if len(tmp) == 0:
+          break
+
+        tmp = (w[3] + tmp).split(b"\n")
+        w[3] = tmp.pop()
+
+        for line in tmp:
+          self._lines.append(line.decode() + "\n")
+
+
+  # apply all complete messages in buf to ws, return what is left over
+  # variants: { path: [ variant, ... ] } of lists still being received
+  # lines: access log lines to send back, if asked for
+
+  def _apply(self, ws, buf, variants, lines):
+
+    while len(buf) >= ForkingWebserver._HDR_LEN:
+
+      op, plen, clen = struct.unpack(ForkingWebserver._HDR_FMT, buf[:ForkingWebserver._HDR_LEN])
+      mlen = ForkingWebserver._HDR_LEN + plen + clen
+
+      if len(buf) < mlen:
+        break
+
+      path = buf[ForkingWebserver._HDR_LEN:ForkingWebserver._HDR_LEN + plen].decode()
+      content = buf[ForkingWebserver._HDR_LEN + plen:mlen]
+
+      buf = buf[mlen:]
+
+      if op & ForkingWebserver._OP_MASK == ForkingWebserver._OP_CLEAR:
+        ws.clear()
+        continue
+
+      if op & ForkingWebserver._OP_MASK == ForkingWebserver._OP_FLUSH_LOG:
+        ws.flush_log(lambda x: lines.append(x.encode()), struct.unpack("!I", content)[0])
+        continue
+
+      content = self._decode(op, content)
+
+      if op & ForkingWebserver._OP_F_LIST:
+        variants.setdefault(path, []).append(content)
+        if op & ForkingWebserver._OP_F_MORE == 0:
+          ws.set({ path: variants.pop(path) })
+      else:
+        ws.set({ path: content })
+
+    return buf
+
+
+  # worker process main loop; never returns
+  # fd: request pipe to read from, lfd: log pipe to write to
+
+  def _work(self, fd, lfd):
+
+    rv = 1
+
+    try:
+
+      ws = Webserver(self._xt, **self._kwargs)
+      ws.set(self._reqmap)
+      ws.start(reuseport=True)
+
+      poller = xpoll.XPoll()
+      poller.register(fd, xpoll.POLLIN)
+      poller.register(ws._ssock, xpoll.POLLIN)
+
+      buf = b""
+      variants = {}
+      lines = []
+      out = b""
+
+      while True:
+
+        for x in poller.ipoll(self._interval):
+
+          if x[0] != fd:
+            continue
+
+          # EOF on the pipe means the parent has stopped us
+
+          tmp = os.read(fd, 4096)
+
+          if len(tmp) == 0:
+            ws.stop()
+            rv = 0
+            return
+
+          buf = self._apply(ws, buf + tmp, variants, lines)
+
+        ws.serve()
+
+        # the parent reads the log pipe at its own pace; don't wait for it
+
+        if len(lines) > 0:
+          out = out + b"".join(lines)
+          lines = []
+
+        if len(out) > 0:
+          try:
+            out = out[os.write(lfd, out):]
+          except BlockingIOError:
+            pass
+
+    finally:
+      os._exit(rv)
+
+
+  def _spawn(self):
+
+    rfd, wfd = os.pipe()
+    lrfd, lwfd = os.pipe()
+
+    pid = os.fork()
+
+    if pid == 0:
+
+      # child
+
+      os.close(wfd)
+      os.close(lrfd)
+
+      for w in self._pids.values():
+        os.close(w[0])
+        os.close(w[2])
+
+      os.set_blocking(lwfd, False)
+
+      self._work(rfd, lwfd)
+
+    # parent
+
+    os.close(rfd)
+    os.close(lwfd)
+
+    os.set_blocking(wfd, False)
+    os.set_blocking(lrfd, False)
+
+    self._pids[pid] = [ wfd, b"", lrfd, b"" ]
+
+
+  # kill: if True, kill the worker instead of waiting for it to exit
+
+  def _reap(self, pid, kill=False):
+
+    w = self._pids.pop(pid)
+
+    for fd in [ w[0], w[2] ]:
+      try:
+        os.close(fd)
+      except:
+        pass
+
+    try:
+      if kill:
+        os.kill(pid, 9)
+      os.waitpid(pid, 0)
+    except:
+      pass
+
+
+  def _replace(self, pid):
+
+    self._reap(pid, True)
+    self._spawn()
+
+
+  def set(self, reqmap):
+
+    self._reqmap.update(reqmap)
+    self._gen = self._gen + 1
+
+    for path in reqmap:
+
+      content = reqmap[path]
+
+      if not isinstance(content, list):
+        msg = self._encode(content)
+        if msg != None:
+          self._send(msg[0], path, msg[1])
+        continue
+
+      msgs = [ x for x in [ self._encode(v) for v in content ] if x != None ]
+
+      for i in range(0, len(msgs)):
+        self._send(msgs[i][0] | ForkingWebserver._OP_F_LIST | (ForkingWebserver._OP_F_MORE if i < len(msgs) - 1 else 0), path, msgs[i][1])
+
+
+  def clear(self):
+
+    self._reqmap = _DEFAULT_REQMAP.copy()
+    self._gen = self._gen + 1
+    self._send(ForkingWebserver._OP_CLEAR, "", b"")
+
+
+  # content is copied into the pipes by set(), so can always be reused; see
+  # Webserver.generation()
+
+  def generation(self):
+
+    return self._gen
+
+
+  def oldest(self):
+
+    return self._gen
+
+
+  # hand the oldest access log lines the workers have sent back to fn(), and
+  # ask them for more; lines only come back with the next call
+
+  def flush_log(self, fn, count=0):
+
+    self._recv()
+
+    n = len(self._lines) if count <= 0 else min(count, len(self._lines))
+
+    for line in self._lines[:n]:
+      fn(line)
+
+    self._lines = self._lines[n:]
+
+    if len(self._lines) == 0:
+      self._send(ForkingWebserver._OP_FLUSH_LOG, "", struct.pack("!I", count))
+
+    return n
+
+
+  def start(self):
+
+    for i in range(0, self._workers):
+      self._spawn()
+
+
+  def stop(self):
+
+    # closing the pipes tells the workers to exit
+
+    for pid in list(self._pids):
+      self._reap(pid)
+
+
+  # workers do the actual serving; here we just replace any that have died,
+  # and keep the pipes moving
+
+  def serve(self, now=None):
+
+    for pid in list(self._pids):
+
+      try:
+        rpid, status = os.waitpid(pid, os.WNOHANG)
+      except:
+        rpid = pid
+
+      if rpid == pid:
+        self._reap(pid)
+        self._spawn()
+      else:
+        self._flush(pid)
+
+    self._recv()
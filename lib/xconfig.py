@@ -6,19 +6,80 @@
 # 2022-01-14 xconfig.py
 
 # very simple name-value configuration parser
+# until load() is called, params are read from the file as they are asked for;
+# the file is scanned once for where each param is, and scanned again only if
+# its size or mtime changes
+# a module compiled from the file by confgen.py is imported instead, if there
+# is one, and it was compiled from the file as it is now; its params are
+# constants, which need no parsing, and can be frozen into flash
+# params can also be declared with a type, a default, and a range, then
+# validated and converted all at once; from then on, they're read as they are,
+# and bad values are reported up front, instead of quietly becoming defaults
+
+
+import os
 
 
 class XConfig:
 
+  # types of declared params
+
+  STR = 0
+  INT = 1
+  BOOL = 2
+
   # path: path to config file
+  # module: name of the module compiled from it, if any
 
-  def __init__(self, path="config.conf"):
+  def __init__(self, path="config.conf", module=None):
 
     self._path = path
     self._config = None
+    self._module = None
+
+    if module != None:
+      try:
+        self._module = __import__(module)
+      except:
+        pass
+
+    # compiled from some other version of the file; the file wins
+
+    if self._module != None and not self._compiled(self._module):
+      self._module = None
+
+    # { name: byte offset of its line }, and the file's (size, mtime) when
+    # it was built
+
+    self._index = None
+    self._stamp = None
+
+    # declared params not yet validated, and validated ones: { name: value }
+
+    self._schema = []
+    self._typed = {}
+
+
+  # split a line into name and value
+  #   return (name, value), or None if there isn't one
+
+  def _split(self, line):
+
+    line = line.split("#", 1)[0].strip()
+
+    if len(line) == 0 or "=" not in line:
+      return None
 
+    name, value = map(lambda x: x.strip(), line.split('=', 1))
 
-  # parses self._path, calls fn(name, value, param) for each parsed n-v pair.
+    if len(name) == 0:
+      return None
+
+    return name, value
+
+
+  # parses self._path, calls fn(name, value, offset, param) for each parsed
+  # n-v pair, where offset is where its line starts in the file
   # stops at EOF, or when fn() returns False
 
   def _parse(self, fn, param):
@@ -26,23 +87,23 @@ class XConfig:
     f = None
 
     try:
-      f = open(self._path, "r")
+      f = open(self._path, "rb")
     except Exception as e:
       return False
 
-    for line in f:
+    offset = 0
 
-      line = line.split("#", 1)[0].strip()
+    for line in f:
 
-      if len(line) == 0:
-        continue
+      start = offset
+      offset = offset + len(line)
 
-      name, value = map(lambda x: x.strip(), line.split('=', 1))
+      nv = self._split(str(line, "utf-8"))
 
-      if len(name) == 0:
+      if nv == None:
         continue
 
-      if not fn(name, value, param):
+      if not fn(nv[0], nv[1], start, param):
         break
 
     f.close()
@@ -50,16 +111,164 @@ class XConfig:
     return True
 
 
-  def _get(self, name):
+  # every n-v pair in the file, in order; only the first of each name counts
+  #   returns: [ (name, value), ... ], or None if the file can't be read
+
+  def items(self):
+
+    def _fn_collect(name, value, offset, param):
+      if name not in param[1]:
+        param[0].append((name, value))
+        param[1][name] = True
+      return True
+
+    param = ([], {})
+
+    if not self._parse(_fn_collect, param):
+      return None
+
+    return param[0]
+
+
+  # crc32 of the file
+  #   returns: crc32, or None if this port has no crc32
+
+  def _crc(self):
+
+    try:
+      crc32 = __import__("binascii").crc32
+    except:
+      return None
+
+    crc = 0
+
+    f = open(self._path, "rb")
+
+    try:
+      while True:
+        b = f.read(256)
+        if len(b) == 0:
+          break
+        crc = crc32(b, crc)
+    finally:
+      f.close()
+
+    return crc & 0xffffffff
+
+
+  # size, mtime and crc32 of the file, which is what a compiled module records
+  # as _CONF_STAMP
+  #   returns: (size, mtime, crc32), or None if the file can't be read
+
+  def stamp(self):
+
+    st = self._stat()
+
+    if st == None:
+      return None
+
+    try:
+      return st[0], st[1], self._crc()
+    except:
+      return None
 
-    # param: name, [result]
 
-    def _fn_find(name, value, param):
-      if name != param[0]:
-        return True
-      param[1][0] = value
+  # was module compiled from the file as it is now? it was if there is no
+  # file, as then the module is all there is
+  # the size and mtime usually tell; only if the size is the same, but the
+  # mtime isn't, as copying the file to a board does, is the file read for
+  # its crc32; if there's no crc32 to check, the module is trusted
+
+  def _compiled(self, module):
+
+    st = self._stat()
+
+    if st == None:
+      return True
+
+    stamp = getattr(module, "_CONF_STAMP", None)
+
+    if not isinstance(stamp, tuple) or len(stamp) != 3 or stamp[0] != st[0]:
+      return False
+
+    if stamp[1] == st[1]:
+      return True
+
+    try:
+      crc = self._crc()
+    except:
       return False
 
+    if crc == None:
+      print("[config] no crc32 to check %s against; using %s" % (self._path, module.__name__))
+      return True
+
+    return crc == stamp[2]
+
+
+  # size and mtime of the file, or None if we can't stat it
+
+  def _stat(self):
+
+    try:
+      st = os.stat(self._path)
+    except:
+      return None
+
+    return st[6], st[8]
+
+
+  # read a param from the file, by where the index says it is
+  #   return value, or None if it's not there
+
+  def _lookup(self, name):
+
+    # param: { name: offset }; only the first of each name counts
+
+    def _fn_index(name, value, offset, param):
+      if name not in param:
+        param[name] = offset
+      return True
+
+    stamp = self._stat()
+
+    if stamp == None:
+      self._index = None
+      return None
+
+    # (re)build the index if it's not there, or the file has changed
+
+    if self._index == None or stamp != self._stamp:
+      self._index = {}
+      self._stamp = stamp
+      self._parse(_fn_index, self._index)
+
+    offset = self._index.get(name)
+
+    if offset == None:
+      return None
+
+    nv = None
+
+    try:
+      f = open(self._path, "rb")
+      f.seek(offset)
+      nv = self._split(str(f.readline(), "utf-8"))
+      f.close()
+    except:
+      pass
+
+    # changed under us, without changing size or mtime; forget the index
+
+    if nv == None or nv[0] != name:
+      self._index = None
+      return None
+
+    return nv[1]
+
+
+  def _get(self, name):
+
     # we have a loaded dict
 
     if self._config != None:
@@ -69,12 +278,14 @@ class XConfig:
 
       return self._config[name]
 
-    # need to parse
+    # compiled; an int or bool if it was one, else a string
+
+    if self._module != None:
+      return getattr(self._module, name, None)
 
-    res = [ None ]
-    self._parse(_fn_find, (name, res))
+    # need to look it up in the file
 
-    return res[0]
+    return self._lookup(name)
 
 
   # parses given config file
@@ -83,7 +294,7 @@ class XConfig:
 
   def load(self, preload=None):
 
-    def _fn_store(name, value, param):
+    def _fn_store(name, value, offset, param):
       param[name] = value
       return True
 
@@ -93,15 +304,93 @@ class XConfig:
     if preload != None and isinstance(preload, dict):
       self._config.update(preload)
 
+    if self._module != None:
+
+      for name in dir(self._module):
+        if not name.startswith("_"):
+          self._config[name] = getattr(self._module, name)
+
+      return True
+
     return self._parse(_fn_store, self._config)
 
 
+  # declare params, to be validated and converted by validate()
+  #   schema: [ (name, type, default, base, min, max), ... ]
+  #     type: one of STR, INT or BOOL
+  #     base, min, max: only for INT; min and max may be None
+
+  def declare(self, schema):
+
+    self._schema = self._schema + list(schema)
+
+
+  # validate and convert every param declared so far, and keep them typed
+  # a missing or empty param gets its default, and so does an invalid one,
+  # which is also reported
+  # the getters then return them as they are, ignoring their own base and
+  # default
+  #   returns: [ message, ... ] for every invalid param
+
+  def validate(self):
+
+    errors = []
+
+    for name, t, default, base, vmin, vmax in self._schema:
+
+      raw = self._get(name)
+      value = default
+
+      if raw == None or raw == "":
+        pass
+
+      elif t == XConfig.INT:
+
+        try:
+          v = raw if type(raw) == int and base == 10 else int(str(raw), base)
+        except:
+          v = None
+
+        if v == None:
+          errors.append("%s: %s is not a base %d int" % (name, raw, base))
+        elif (vmin != None and v < vmin) or (vmax != None and v > vmax):
+          errors.append("%s: %s is not between %s and %s" % (name, raw, vmin, vmax))
+        else:
+          value = v
+
+      elif t == XConfig.BOOL:
+
+        v = raw if isinstance(raw, bool) else str(raw).lower()
+
+        if v in [ True, "true", "yes", "y" ]:
+          value = True
+        elif v in [ False, "false", "no", "n" ]:
+          value = False
+        else:
+          errors.append("%s: %s is not a bool" % (name, raw))
+
+      else:
+
+        value = str(raw)
+
+      self._typed[name] = value
+
+    self._schema = []
+
+    return errors
+
+
   # attempt to retrieve a string config param
   #   name: the name of the config param
   #   default: the string to return if param is not in dict
 
   def get_str(self, name, default=""):
 
+    value = self._typed.get(name)
+
+    if isinstance(value, str):
+      return value
+
     value = self._get(name)
 
     if value == None:
@@ -117,10 +406,18 @@ class XConfig:
 
   def get_int(self, name, base=10, default=0):
 
+    value = self._typed.get(name)
+
+    if type(value) == int:
+      return value
+
     value = default
 
+    # compiled ints were decimal
+
     try:
-      value = int(self._get(name), base)
+      v = self._get(name)
+      value = v if type(v) == int and base == 10 else int(str(v), base)
     except:
       pass
 
@@ -133,10 +430,17 @@ class XConfig:
 
   def get_bool(self, name, default=False):
 
+    value = self._typed.get(name)
+
+    if isinstance(value, bool):
+      return value
+
     value = default
 
     try:
-      value = self._get(name).lower() in ["true", "yes", "y"]
+      v = self._get(name)
+      if v != None:
+        value = v if isinstance(v, bool) else str(v).lower() in ["true", "yes", "y"]
     except:
       pass
 
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2022 Vino Fernando Crescini <vfcrescini@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# 2026-10-19 xpoll.py
+
+# convenience library to provide a unified poll API on both micropython and cpython
+# micropython uses the allocation-free ipoll(), cpython uses epoll where available
+# timeouts are in msecs; a negative timeout blocks until something is ready
+
+
+import sys as _sys
+import select as _select
+
+
+POLLIN = _select.POLLIN
+POLLOUT = _select.POLLOUT
+POLLERR = _select.POLLERR
+POLLHUP = _select.POLLHUP
+
+
+class XPoll(object):
+
+  def __new__(cls, *args, **kwargs):
+
+    xp = None
+
+    if cls == XPoll:
+
+      # we're instantiating XPoll, so return an instance of one of the subclasses instead
+
+      if hasattr(_sys, "implementation") and _sys.implementation.name == "micropython":
+        xp = _XPollMicroPython(*args, **kwargs)
+      else:
+        xp = _XPollCPython(*args, **kwargs)
+
+    else:
+
+      # we're instantiating one of the subclasses, so just do what __new__() normally does
+
+      xp = object.__new__(cls)
+
+    return xp
+
+
+  def __init__(self, *args, **kwargs):
+
+    pass
+
+
+class _XPollCPython(object):
+
+  def __init__(self):
+
+    self._objs = {}
+    self._epoll = hasattr(_select, "epoll")
+
+    if self._epoll:
+      self._poller = _select.epoll()
+    else:
+      self._poller = _select.poll()
+
+
+  def _fd(self, obj):
+
+    return obj if isinstance(obj, int) else obj.fileno()
+
+
+  def _poll(self, timeout):
+
+    if self._epoll:
+      return self._poller.poll(timeout / 1000.0 if timeout >= 0 else -1)
+
+    return self._poller.poll(timeout if timeout >= 0 else None)
+
+
+  def register(self, obj, eventmask=POLLIN | POLLOUT):
+
+    fd = self._fd(obj)
+
+    if fd in self._objs:
+      self._poller.modify(fd, eventmask)
+    else:
+      self._poller.register(fd, eventmask)
+
+    self._objs[fd] = obj
+
+
+  def modify(self, obj, eventmask):
+
+    self._poller.modify(self._fd(obj), eventmask)
+
+
+  def unregister(self, obj):
+
+    fd = self._fd(obj)
+
+    if fd not in self._objs:
+      return
+
+    del self._objs[fd]
+
+    try:
+      self._poller.unregister(fd)
+    except:
+      pass
+
+
+  def close(self):
+
+    self._objs = {}
+
+    if self._epoll:
+      self._poller.close()
+
+
+  # returns the event mask of the first ready object, or 0 if none are ready
+  # meant for pollers with a single registered object
+
+  def events(self, timeout=0):
+
+    for fd, ev in self._poll(timeout):
+      return ev
+
+    return 0
+
+
+  # iterate over (obj, event mask) of ready objects
+
+  def ipoll(self, timeout=0):
+
+    for fd, ev in self._poll(timeout):
+      if fd in self._objs:
+        yield self._objs[fd], ev
+
+
+class _XPollMicroPython(object):
+
+  def __init__(self):
+
+    self._poller = _select.poll()
+
+
+  def register(self, obj, eventmask=POLLIN | POLLOUT):
+
+    self._poller.register(obj, eventmask)
+
+
+  def modify(self, obj, eventmask):
+
+    self._poller.modify(obj, eventmask)
+
+
+  def unregister(self, obj):
+
+    try:
+      self._poller.unregister(obj)
+    except:
+      pass
+
+
+  def close(self):
+
+    pass
+
+
+  # returns the event mask of the first ready object, or 0 if none are ready
+  # meant for pollers with a single registered object
+  # ipoll() reuses the same tuple for every result, so this allocates nothing
+
+  def events(self, timeout=0):
+
+    for x in self._poller.ipoll(timeout):
+      return x[1]
+
+    return 0
+
+
+  # iterate over (obj, event mask) of ready objects
+  # some ports append extra items to each tuple, so index rather than unpack
+
+  def ipoll(self, timeout=0):
+
+    return self._poller.ipoll(timeout)
@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2022 Vino Fernando Crescini <vfcrescini@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# 2026-10-19 coapserver_test.py
+
+# test for CoAP server; runs the server and a minimal CoAP client locally
+
+
+import os
+import sys
+import getopt
+import socket
+
+sys.path.append(os.path.join("..", "lib"))
+
+import xtime
+import coapserver
+
+
+_failed = 0
+
+
+def _check(name, ok):
+
+  global _failed
+
+  if not ok:
+    _failed = _failed + 1
+
+  sys.stdout.write("%s %s\n" % ("PASS" if ok else "FAIL", name))
+
+
+# minimal client: send a GET, serve until something arrives, return decoded reply
+
+class _Client(object):
+
+  def __init__(self, ws, port):
+
+    self._ws = ws
+    self._addr = ("127.0.0.1", port)
+    self._mid = 0x1000
+    self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self._sock.settimeout(0.01)
+
+
+  def send(self, mtype, code, token, options):
+
+    self._mid = self._mid + 1
+    self._sock.sendto(coapserver.encode(mtype, code, self._mid, token, options), self._addr)
+
+    return self._mid
+
+
+  def get(self, path, token=b"\x01", mtype=coapserver.TYPE_CON, observe=-1, accept=-1):
+
+    options = []
+
+    if observe >= 0:
+      options.append((coapserver.OPT_OBSERVE, bytes([observe]) if observe > 0 else b""))
+
+    for segment in path.strip("/").split("/"):
+      if len(segment) > 0:
+        options.append((coapserver.OPT_URI_PATH, segment.encode()))
+
+    if accept >= 0:
+      options.append((coapserver.OPT_ACCEPT, bytes([accept]) if accept > 0 else b""))
+
+    self.send(mtype, coapserver.CODE_GET, token, options)
+
+    return self.recv()
+
+
+  def recv(self):
+
+    for i in range(0, 100):
+
+      self._ws.serve()
+
+      try:
+        msg, addr = self._sock.recvfrom(2048)
+      except socket.timeout:
+        continue
+
+      return coapserver.decode(msg)
+
+    return None
+
+
+  def rst(self, mid):
+
+    self._sock.sendto(coapserver.encode(coapserver.TYPE_RST, 0, mid, b"", []), self._addr)
+
+
+  def ack(self, mid):
+
+    self._sock.sendto(coapserver.encode(coapserver.TYPE_ACK, 0, mid, b"", []), self._addr)
+
+
+  def raw(self, msg):
+
+    self._sock.sendto(msg, self._addr)
+
+    return self.recv()
+
+
+def _option(m, number):
+
+  for n, v in m[4]:
+    if n == number:
+      return v
+
+  return None
+
+
+if __name__ == "__main__":
+
+  port = 5683
+
+  # parse options
+
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "hp:", ["help", "port="])
+  except Exception as e:
+    sys.stderr.write("Failed to parse arguments: %s\n" % (e))
+    sys.exit(1)
+
+  for o, a in opts:
+    if o == "-h" or o == "--help":
+      sys.stdout.write("Usage: %s [-h] [-p <port>]\n" % (sys.argv[0]))
+      sys.exit(0)
+    elif o == "-p" or o == "--port":
+      try:
+        port = int(a)
+      except Exception as e:
+        sys.stderr.write("Invalid port. Valid range 1 to 65535\n")
+        sys.exit(2)
+      if port < 1 or port > 65535:
+        sys.stderr.write("Invalid port. Valid range 1 to 65535\n")
+        sys.exit(3)
+
+  # start server
+
+  xt = xtime.XTime()
+  cs = coapserver.CoAPServer(xt, port=port)
+
+  cs.set({ "/weather": [ ("text/plain", "1 2 3\r\n"), ("application/json", '{"a":1}') ], "/raw": b"\x00\x01" })
+  cs.start()
+
+  c = _Client(cs, port)
+
+  # plain confirmable get gets a piggybacked ack
+
+  m = c.get("/weather")
+  _check("CON GET acked", m != None and m[0] == coapserver.TYPE_ACK and m[1] == coapserver.CODE_CONTENT)
+  _check("CON GET payload", m != None and m[5] == b"1 2 3\r\n")
+  _check("CON GET content format", m != None and _option(m, coapserver.OPT_CONTENT_FORMAT) == b"")
+
+  # non-confirmable get gets a non-confirmable response
+
+  m = c.get("/raw", mtype=coapserver.TYPE_NON)
+  _check("NON GET", m != None and m[0] == coapserver.TYPE_NON and m[5] == b"\x00\x01")
+
+  # accept picks the variant
+
+  m = c.get("/weather", accept=coapserver.FORMAT_JSON)
+  _check("Accept json", m != None and m[5] == b'{"a":1}' and _option(m, coapserver.OPT_CONTENT_FORMAT) == bytes([coapserver.FORMAT_JSON]))
+
+  m = c.get("/weather", accept=coapserver.FORMAT_BINARY)
+  _check("Accept not acceptable", m != None and m[1] == coapserver.CODE_NOT_ACCEPTABLE)
+
+  # errors
+
+  m = c.get("/nothing")
+  _check("Not found", m != None and m[1] == coapserver.CODE_NOT_FOUND)
+
+  c.send(coapserver.TYPE_CON, 0x02, b"\x02", [ (coapserver.OPT_URI_PATH, b"raw") ])
+  m = c.recv()
+  _check("POST not allowed", m != None and m[1] == coapserver.CODE_METHOD_NOT_ALLOWED)
+
+  c.send(coapserver.TYPE_CON, coapserver.CODE_GET, b"\x03", [ (coapserver.OPT_URI_PATH, b"raw"), (2049, b"") ])
+  m = c.recv()
+  _check("Unknown critical option", m != None and m[1] == coapserver.CODE_BAD_OPTION)
+
+  # malformed input gets an error or a reset, and doesn't stop the server
+
+  c.send(coapserver.TYPE_CON, coapserver.CODE_GET, b"\x04", [ (coapserver.OPT_URI_PATH, b"\xff\xfe") ])
+  m = c.recv()
+  _check("Invalid Uri-Path", m != None and m[1] == coapserver.CODE_BAD_REQUEST)
+
+  m = c.raw(coapserver.encode(coapserver.TYPE_CON, 0, 0x2345, b"", []))
+  _check("Empty CON gets RST", m != None and m[0] == coapserver.TYPE_RST and m[2] == 0x2345)
+
+  m = c.raw(bytes([0x49, coapserver.CODE_GET, 0x23, 0x46]) + b"\x00" * 9)
+  _check("Token length 9 gets RST", m != None and m[0] == coapserver.TYPE_RST and m[2] == 0x2346)
+
+  m = c.raw(bytes([0x40, coapserver.CODE_GET, 0x23, 0x47, 0xb5]) + b"ra")
+  _check("Truncated option gets RST", m != None and m[0] == coapserver.TYPE_RST and m[2] == 0x2347)
+
+  m = c.raw(bytes([0x40, coapserver.CODE_GET, 0x23, 0x48, 0xff]))
+  _check("Empty payload gets RST", m != None and m[0] == coapserver.TYPE_RST and m[2] == 0x2348)
+
+  m = c.raw(bytes([0x40]))
+  _check("Runt ignored", m == None)
+
+  m = c.get("/raw")
+  _check("Still serving", m != None and m[1] == coapserver.CODE_CONTENT)
+
+  # discovery
+
+  m = c.get("/.well-known/core")
+  _check("Discovery", m != None and m[5].find(b"</weather>") >= 0)
+
+  # observe
+
+  m = c.get("/weather", token=b"\xaa\xbb", observe=0)
+  _check("Observe register", m != None and m[3] == b"\xaa\xbb" and _option(m, coapserver.OPT_OBSERVE) != None)
+
+  cs.set({ "/weather": [ ("text/plain", "4 5 6\r\n") ] })
+  n1 = c.recv()
+  _check("Observe notification", n1 != None and n1[3] == b"\xaa\xbb" and n1[5] == b"4 5 6\r\n")
+
+  cs.set({ "/raw": b"\x02" })
+  n = c.recv()
+  _check("No notification for other paths", n == None)
+
+  cs.set({ "/weather": [ ("text/plain", "7 8 9\r\n") ] })
+  n2 = c.recv()
+  _check("Observe sequence increases", n1 != None and n2 != None and coapserver._get_uint(_option(n2, coapserver.OPT_OBSERVE)) > coapserver._get_uint(_option(n1, coapserver.OPT_OBSERVE)))
+
+  # reset to a notification cancels the observation
+
+  if n2 != None:
+    c.rst(n2[2])
+
+  for i in range(0, 10):
+    cs.serve()
+
+  cs.set({ "/weather": [ ("text/plain", "0 0 0\r\n") ] })
+  _check("Observe cancelled by RST", c.recv() == None)
+
+  # deregister with observe 1
+
+  c.get("/weather", token=b"\xcc", observe=0)
+  m = c.get("/weather", token=b"\xcc", observe=1)
+  _check("Observe deregister", m != None and _option(m, coapserver.OPT_OBSERVE) == None)
+
+  cs.set({ "/weather": [ ("text/plain", "1 1 1\r\n") ] })
+  _check("No notification after deregister", c.recv() == None)
+
+  cs.stop()
+
+  # confirmable notifications; every one of them, with con_interval 0
+
+  cs = coapserver.CoAPServer(xt, port=port, con_interval=0)
+  cs.set({ "/raw": b"\x00" })
+  cs.start()
+
+  c = _Client(cs, port)
+
+  c.get("/raw", token=b"\xdd", observe=0)
+  cs.set({ "/raw": b"\x01" })
+  n = c.recv()
+  _check("CON notification", n != None and n[0] == coapserver.TYPE_CON and n[5] == b"\x01")
+
+  # acked, so no retransmission
+
+  if n != None:
+    c.ack(n[2])
+
+  now = xt.time_ms()
+
+  for i in range(0, 10):
+    cs.serve(now)
+
+  cs.serve(now + 60000)
+  _check("Acked CON not retransmitted", c.recv() == None)
+
+  # never acked, so retransmitted, then the observer is dropped
+
+  cs.set({ "/raw": b"\x02" })
+  n = c.recv()
+
+  count = 0
+
+  for i in range(1, 8):
+    cs.serve(now + i * 60000)
+    tmp = c.recv()
+    if tmp != None and n != None and tmp[2] == n[2]:
+      count = count + 1
+
+  _check("Unacked CON retransmitted", count == 4)
+
+  cs.set({ "/raw": b"\x03" })
+  _check("Unacked observer dropped", c.recv() == None)
+
+  cs.stop()
+
+  sys.exit(1 if _failed > 0 else 0)
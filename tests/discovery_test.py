@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2022 Vino Fernando Crescini <vfcrescini@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# 2026-10-19 discovery_test.py
+
+# test for node discovery; runs an announcing node and a resolving node on the
+# same host, and feeds the resolving node raw datagrams
+# the resolving node is started last, so datagrams sent straight to the port
+# go to it
+
+
+import os
+import sys
+import time
+import getopt
+import socket
+
+sys.path.append(os.path.join("..", "lib"))
+
+import xtime
+import discovery
+
+
+_failed = 0
+
+
+def _check(name, ok):
+
+  global _failed
+
+  if not ok:
+    _failed = _failed + 1
+
+  sys.stdout.write("%s %s\n" % ("PASS" if ok else "FAIL", name))
+
+
+# serve both nodes for a while
+
+def _serve(nodes, count=20):
+
+  for i in range(0, count):
+    for n in nodes:
+      n.serve()
+    time.sleep(0.01)
+
+
+if __name__ == "__main__":
+
+  port = 7665
+
+  # parse options
+
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "hp:", ["help", "port="])
+  except Exception as e:
+    sys.stderr.write("Failed to parse arguments: %s\n" % (e))
+    sys.exit(1)
+
+  for o, a in opts:
+    if o == "-h" or o == "--help":
+      sys.stdout.write("Usage: %s [-h] [-p <port>]\n" % (sys.argv[0]))
+      sys.exit(0)
+    elif o == "-p" or o == "--port":
+      try:
+        port = int(a)
+      except Exception as e:
+        sys.stderr.write("Invalid port. Valid range 1 to 65535\n")
+        sys.exit(2)
+      if port < 1 or port > 65535:
+        sys.stderr.write("Invalid port. Valid range 1 to 65535\n")
+        sys.exit(3)
+
+  # start nodes
+
+  xt = xtime.XTime()
+
+  a = discovery.Discovery(xt, name="alpha", port=port, service_port=8080, ttl=60)
+  b = discovery.Discovery(xt, name="", port=port, max_nodes=2)
+
+  a.start()
+  b.start()
+
+  # query and answer
+
+  _check("Unknown node", b.resolve("alpha") == None)
+
+  _serve([ a, b ])
+
+  r = b.resolve("alpha")
+  _check("Query answered", r != None and r[1] == 8080)
+  _check("Node table", "alpha" in b.nodes() and b.nodes()["alpha"][3] == 60)
+
+  # a node without a name never answers, and never announces
+
+  _check("Nameless node doesn't announce", not b.announce())
+
+  b.query("beta")
+  _serve([ a, b ])
+  _check("Unknown name not answered", b.resolve("beta") == None)
+
+  # announcement
+
+  a.announce()
+  _serve([ a, b ])
+  _check("Announcement", b.resolve("alpha") != None)
+
+  _check("Own name not learned", "alpha" not in a.nodes())
+
+  # malformed datagrams are ignored
+
+  s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+  for msg in [ b"", b"\xff\xfe\xfd", b"CSD1", b"CSD1 A", b"CSD2 A gamma 80 60", b"CSD1 X gamma 80 60",
+               b"CSD1 A gamma 80", b"CSD1 A gamma 80 60 1", b"CSD1 A gamma x 60", b"CSD1 A gamma 80 x",
+               b"CSD1 A gamma 0 60", b"CSD1 A gamma 65535 60", b"CSD1 A gamma 80 0", b"CSD1 A gamma 80 -1",
+               b"CSD1 A gam\x00ma 80 60", b"CSD1 A gam\xc3\xa9ma 80 60", b"CSD1 A gamma 80 60" + b" " * 200 ]:
+    s.sendto(msg, ("127.0.0.1", port))
+
+  _serve([ b ], 40)
+  _check("Malformed datagrams ignored", list(b.nodes()) == [ "alpha" ])
+
+  # well-formed ones from anyone are not
+
+  s.sendto(b"CSD1 A gamma 81 30\n", ("127.0.0.1", port))
+  _serve([ b ])
+  _check("Raw announcement", b.resolve("gamma") == ("127.0.0.1", 81))
+
+  # table full; the one that expires first goes
+
+  s.sendto(b"CSD1 A delta 82 120\n", ("127.0.0.1", port))
+  _serve([ b ])
+
+  n = b.nodes()
+  _check("Eviction", len(n) == 2 and "delta" in n and "alpha" in n and "gamma" not in n)
+
+  # expiry
+
+  s.sendto(b"CSD1 A delta 82 1\n", ("127.0.0.1", port))
+  _serve([ b ])
+  _check("Expiry", b.resolve("delta", xt.time_ms() + 2000) == None)
+
+  s.close()
+
+  a.stop()
+  b.stop()
+
+  sys.exit(1 if _failed > 0 else 0)
@@ -0,0 +1,637 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2022 Vino Fernando Crescini <vfcrescini@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# 2026-10-19 webclient_test.py
+
+# test and benchmark for HTTP client; cpython only
+# drives HTTPRequest against a local server that answers each case with a
+# scripted response: pieces of bytes, with pauses in between
+# for each case, reports request() calls, socket and poll syscalls, latency,
+# and blocks and bytes allocated in webclient that are still live at the end
+# tls cases need a certificate for 127.0.0.1, and its key, e.g.:
+#   openssl req -x509 -newkey rsa:2048 -nodes -keyout key.pem -out cert.pem -days 30 -subj "/CN=127.0.0.1" -addext "subjectAltName=IP:127.0.0.1"
+# over tls, send and recv are counted per tls read and write
+
+
+import os
+import sys
+import time
+import getopt
+import select
+import ssl
+import socket
+import hashlib
+import threading
+import tracemalloc
+
+sys.path.append(os.path.join("..", "lib"))
+
+import xtime
+import xpoll
+import webclient
+
+
+_failed = 0
+
+
+def _check(name, ok, stats=None):
+
+  global _failed
+
+  if not ok:
+    _failed = _failed + 1
+
+  if stats == None:
+    sys.stdout.write("%s %s\n" % ("PASS" if ok else "FAIL", name))
+  else:
+    sys.stdout.write("%s %-32s %5d ticks  %4d connect %4d send %5d recv %5d poll  %8.2f ms  %5d blocks %8d B\n" % (("PASS" if ok else "FAIL", name) + stats))
+
+
+# count socket and poll syscalls made by the main thread, where the client is;
+# the server runs in other threads
+
+_calls = { "connect": 0, "send": 0, "recv": 0, "poll": 0, "getaddrinfo": 0 }
+
+_Socket = socket.socket
+_getaddrinfo = socket.getaddrinfo
+_poll = xpoll._XPollCPython._poll
+
+
+def _count(name):
+
+  if threading.current_thread() is threading.main_thread():
+    _calls[name] = _calls[name] + 1
+
+
+class _CountingSocket(_Socket):
+
+  def connect(self, *args):
+
+    _count("connect")
+
+    return _Socket.connect(self, *args)
+
+
+  def send(self, *args):
+
+    _count("send")
+
+    return _Socket.send(self, *args)
+
+
+  def recv_into(self, *args):
+
+    _count("recv")
+
+    return _Socket.recv_into(self, *args)
+
+
+class _CountingSSLSocket(ssl.SSLSocket):
+
+  def send(self, *args):
+
+    _count("send")
+
+    return ssl.SSLSocket.send(self, *args)
+
+
+  def recv_into(self, *args):
+
+    _count("recv")
+
+    return ssl.SSLSocket.recv_into(self, *args)
+
+
+def _counting_poll(self, timeout):
+
+  _count("poll")
+
+  return _poll(self, timeout)
+
+
+def _counting_getaddrinfo(*args):
+
+  _count("getaddrinfo")
+
+  return _getaddrinfo(*args)
+
+
+# server; each request is answered by calling script(conn, request head, request body, number of requests on this conn)
+# the connection is kept open if it returns True
+# tls: server ssl context, or None for plain http
+
+class _Server(object):
+
+  def __init__(self, port, tls=None):
+
+    self.script = None
+    self.tls = tls
+    self.conns = 0
+
+    self._sock = _Socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._sock.bind(("127.0.0.1", port))
+    self._sock.listen(8)
+
+    threading.Thread(target=self._accept, daemon=True).start()
+
+
+  def _accept(self):
+
+    while True:
+
+      c, a = self._sock.accept()
+      c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+      self.conns = self.conns + 1
+
+      threading.Thread(target=self._handle, args=(c,), daemon=True).start()
+
+
+  def _handle(self, c):
+
+    try:
+      if self.tls != None:
+        c = self.tls.wrap_socket(c, server_side=True)
+    except Exception as e:
+      c.close()
+      return
+
+    f = c.makefile("rb")
+    n = 0
+
+    try:
+
+      while True:
+
+        head = b""
+
+        while not head.endswith(b"\r\n\r\n"):
+          l = f.readline()
+          if len(l) == 0:
+            return
+          head = head + l
+
+        body = b""
+
+        for l in head.split(b"\r\n"):
+          if l.lower().startswith(b"content-length:"):
+            body = f.read(int(l.split(b":")[1]))
+
+        if head.lower().find(b"transfer-encoding: chunked") >= 0:
+          while True:
+            size = int(f.readline().split(b";")[0], 16)
+            body = body + f.read(size)
+            f.readline()
+            if size == 0:
+              break
+
+        n = n + 1
+
+        if not self.script(c, head, body, n):
+          return
+
+    except Exception as e:
+      pass
+
+    finally:
+      f.close()
+      c.close()
+
+
+# send pieces of bytes; a number is a pause of that many secs
+
+def _send(c, *pieces):
+
+  for p in pieces:
+    if isinstance(p, float):
+      time.sleep(p)
+    else:
+      c.sendall(p)
+
+
+# drive a request until it's done or fails
+#   return rv, number of request() calls
+
+def _run(req):
+
+  t = time.time()
+  n = 0
+
+  while time.time() - t < 10.0:
+
+    rv = req.request()
+    n = n + 1
+
+    if rv[0] != 0 or rv[1] == webclient.HTTPRequest.STATE_DONE:
+      return rv, n
+
+    # wait for the socket, like a main loop tick would, but not for long
+    # select(), so as not to be counted with the client's own polls
+
+    if req.socket() != None:
+      w = req.wants()
+      select.select([ req.socket() ] if w & xpoll.POLLIN else [], [ req.socket() ] if w & xpoll.POLLOUT else [], [], 0.001)
+
+  return (-1, 0, "Test timed out"), n
+
+
+# run a case once for its stats, then again under tracemalloc for allocations
+# the request is set up by setup(req), and judged by check(req, rv)
+
+def _case(srv, port, name, script, check, setup=None, kwargs={}, reqs=1):
+
+  for k in _calls:
+    _calls[k] = 0
+
+  srv.script = script
+  srv.conns = 0
+
+  results = []
+
+  for traced in [ False, True ]:
+
+    req = webclient.HTTPRequest(cache=None, **kwargs)
+    req.set("127.0.0.1", "/test", port)
+    req.resolve()
+
+    if traced:
+      tracemalloc.start()
+      before = tracemalloc.take_snapshot()
+
+    t = time.time()
+    ticks = 0
+    ok = True
+
+    for i in range(0, reqs):
+
+      if i > 0:
+        req.reset()
+
+      if setup != None:
+        setup(req)
+
+      rv, n = _run(req)
+      ticks = ticks + n
+      ok = ok and check(req, rv)
+
+    ms = (time.time() - t) * 1000.0
+
+    if traced:
+      stats = tracemalloc.take_snapshot().filter_traces([ tracemalloc.Filter(True, "*webclient.py") ]).compare_to(before.filter_traces([ tracemalloc.Filter(True, "*webclient.py") ]), "filename")
+      tracemalloc.stop()
+      results.append((sum([ s.count_diff for s in stats ]), sum([ s.size_diff for s in stats ])))
+    else:
+      conns = srv.conns
+      results.append((ticks, _calls["connect"], _calls["send"], _calls["recv"], _calls["poll"], ms))
+
+    req.close()
+
+    results.append(ok)
+
+  _check(name, results[1] and results[3], results[0] + results[2])
+
+  return conns
+
+
+def _body(req):
+
+  return req.get_response(raw=True)[2].tobytes()
+
+
+if __name__ == "__main__":
+
+  port = 18080
+  cert = None
+  key = None
+
+  # parse options
+
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "hp:c:k:", ["help", "port=", "cert=", "key="])
+  except Exception as e:
+    sys.stderr.write("Failed to parse arguments: %s\n" % (e))
+    sys.exit(1)
+
+  for o, a in opts:
+    if o == "-h" or o == "--help":
+      sys.stdout.write("Usage: %s [-h] [-p <port>] [-c <cert file> -k <key file>]\n" % (sys.argv[0]))
+      sys.exit(0)
+    elif o == "-p" or o == "--port":
+      try:
+        port = int(a)
+      except Exception as e:
+        sys.stderr.write("Invalid port. Valid range 1 to 65533\n")
+        sys.exit(2)
+      if port < 1 or port > 65533:
+        sys.stderr.write("Invalid port. Valid range 1 to 65533\n")
+        sys.exit(3)
+    elif o == "-c" or o == "--cert":
+      cert = a
+    elif o == "-k" or o == "--key":
+      key = a
+
+  srv = _Server(port)
+
+  socket.socket = _CountingSocket
+  socket.getaddrinfo = _counting_getaddrinfo
+  xpoll._XPollCPython._poll = _counting_poll
+
+  ok200 = lambda req, rv: rv[0] == 0 and req.get_response(raw=True)[0][0] == 200
+
+  # plain response, all at once
+
+  _case(srv, port, "Content-Length", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello"), lambda req, rv: ok200(req, rv) and _body(req) == b"hello")
+
+  # headers dribbling in
+
+  _case(srv, port, "Slow headers", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\n", 0.02, b"X-A: 1\r\n", 0.02, b"X-B:", 0.02, b" 2\r\nContent-Len", 0.02, b"gth: 2\r\n", 0.02, b"\r\n", 0.02, b"ok"), lambda req, rv: ok200(req, rv) and req.get_response()[1].get("x-b") == "2" and _body(req) == b"ok")
+
+  _case(srv, port, "Split status line", lambda c, h, b, n: _send(c, b"HTTP/1.1 2", 0.02, b"04 No Con", 0.02, b"tent\r", 0.02, b"\nContent-Length: 0\r\n\r\n"), lambda req, rv: rv[0] == 0 and req.get_response()[0] == (204, "No Content"))
+
+  _case(srv, port, "Byte at a time", lambda c, h, b, n: _send(c, *[ p for x in b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nabc" for p in (bytes([ x ]), 0.001) ]), lambda req, rv: ok200(req, rv) and _body(req) == b"abc")
+
+  # chunked, with chunk sizes, data and crlfs split across sends
+
+  _case(srv, port, "Chunked", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nhel", 0.02, b"lo\r", 0.02, b"\n1", 0.02, b"0;x=y\r\n0123456789abcdef\r\n0\r\nX-T: 1\r\n\r\n"), lambda req, rv: ok200(req, rv) and _body(req) == b"hello0123456789abcdef")
+
+  # body up to eof
+
+  _case(srv, port, "Close-delimited body", lambda c, h, b, n: _send(c, b"HTTP/1.0 200 OK\r\n\r\nuntil ", 0.02, b"eof"), lambda req, rv: ok200(req, rv) and _body(req) == b"until eof")
+
+  # keep-alive: several requests, one connection
+
+  conns = _case(srv, port, "Keep-alive x10", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\n%d" % (n % 10)) == None, ok200, reqs=10)
+  _check("Keep-alive one connection", conns == 1)
+
+  # server closes the kept-alive connection after each response
+
+  conns = _case(srv, port, "Keep-alive refused x3", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 1\r\n\r\nx"), ok200, reqs=3)
+  _check("Keep-alive refused reconnects", conns == 3)
+
+  # kept-alive requests are HTTP/1.1, so may get chunked responses, and the
+  # connection has to survive them; what RemoteSensor gets from most servers
+
+  def chunked11(c, h, b, n):
+    if not h.startswith(b"GET /test HTTP/1.1\r\n"):
+      return False
+    _send(c, b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\n%03d\r\n0\r\n\r\n" % (n))
+    return True
+
+  conns = _case(srv, port, "Keep-alive chunked x5", chunked11, lambda req, rv: ok200(req, rv) and len(_body(req)) == 3, reqs=5)
+  _check("Keep-alive chunked one connection", conns == 1)
+
+  # cache: a fresh response is served without a request, or even a socket;
+  # a stale one is revalidated by its etag, and when full, whichever expires
+  # first is evicted
+
+  def cached(c, h, b, n):
+    path = h.split(b" ")[1]
+    paths.append(path)
+    if h.find(b"If-None-Match: \"v1\"\r\n") >= 0:
+      _send(c, b"HTTP/1.1 304 Not Modified\r\nETag: \"v1\"\r\nCache-Control: max-age=120\r\n\r\n")
+    else:
+      _send(c, b"HTTP/1.1 200 OK\r\nETag: \"v1\"\r\nCache-Control: max-age=%s\r\n%sContent-Length: 5\r\n\r\nhello" % ({ b"/a": b"60", b"/b": b"0", b"/c": b"30", b"/v": b"60" }[path], b"Vary: Accept\r\n" if path == b"/v" else b""))
+    return True
+
+  def fetch(path):
+    req = webclient.HTTPRequest(cache=cache)
+    req.set("127.0.0.1", path, port)
+    req.resolve()
+    rv = _run(req)[0]
+    ok = ok200(req, rv) and _body(req) == b"hello" and req.socket() == None
+    req.close()
+    return ok
+
+  srv.script = cached
+  cache = webclient.Cache(size=2)
+  paths = []
+
+  rv = [ fetch("/a"), fetch("/a") ]
+  _check("Cache max-age hit", rv == [ False, True ] and paths == [ b"/a" ])
+
+  rv = [ fetch("/b"), fetch("/b"), fetch("/b") ]
+  _check("Cache etag revalidated", rv == [ False, False, True ] and paths == [ b"/a", b"/b", b"/b" ])
+
+  # what's kept is by host and path, so not a response that varies by the
+  # rest of the request
+
+  rv = [ fetch("/v"), fetch("/v") ]
+  _check("Cache skips Vary", rv == [ False, False ] and paths[-2:] == [ b"/v", b"/v" ])
+
+  host = "127.0.0.1:%d" % (port)
+
+  fetch("/c")
+  _check("Cache eviction", cache.get((host, "/a")) == None and cache.get((host, "/b")) != None and cache.get((host, "/c")) != None)
+
+  # a host that failed to resolve isn't tried again by request(), nor by
+  # resolve() until its retry is due, so it doesn't hold up the next request;
+  # one that was never resolved is, by refresh()
+
+  srv.script = lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+
+  res = webclient.Resolver()
+  bad = webclient.HTTPRequest(cache=None, resolver=res)
+  good = webclient.HTTPRequest(cache=None, resolver=res)
+
+  _calls["getaddrinfo"] = 0
+
+  bad.set("nonexistent.invalid", "/test", port)
+  rv = [ bad.resolve(), bad.request()[0] ]
+  bad.reset()
+  rv.append(bad.resolve())
+
+  good.set("127.0.0.1", "/test", port)
+  rv.append(good.request()[0])
+  good.reset()
+  rv.append(res.refresh())
+
+  _check("Failed lookup not retried", rv == [ 2, 3, 2, 3, 1 ] and _calls["getaddrinfo"] == 2)
+  _check("Request after failed lookup", ok200(good, _run(good)[0]) and _body(good) == b"ok")
+
+  bad.close()
+  good.close()
+
+  # premature eof
+
+  fail = lambda req, rv: rv[0] != 0
+
+  _case(srv, port, "EOF before status", lambda c, h, b, n: None, fail)
+  _case(srv, port, "EOF in headers", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nContent-"), fail)
+  _case(srv, port, "EOF in body", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\nshort"), fail)
+  _case(srv, port, "EOF in chunk", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n10\r\nshort"), fail)
+
+  # no response at all
+
+  _case(srv, port, "Response timeout", lambda c, h, b, n: _send(c, 0.5), lambda req, rv: rv[0] == -15, kwargs={ "xt": xtime.XTime(), "response_timeout": 200 })
+
+  # a server that never accepts; its backlog is filled first, so our connect
+  # doesn't go through
+
+  lsock = _Socket(socket.AF_INET, socket.SOCK_STREAM)
+  lsock.bind(("127.0.0.1", port + 2))
+  lsock.listen(0)
+
+  backlog = [ _Socket(socket.AF_INET, socket.SOCK_STREAM) for i in range(0, 2) ]
+
+  for b in backlog:
+    b.setblocking(0)
+    b.connect_ex(("127.0.0.1", port + 2))
+
+  req = webclient.HTTPRequest(cache=None, xt=xtime.XTime(), connect_timeout=200)
+  req.set("127.0.0.1", "/test", port + 2)
+  req.resolve()
+
+  t = time.time()
+  rv = _run(req)[0]
+
+  _check("Connect timeout", rv[0] == -14 and time.time() - t < 1.0)
+
+  req.close()
+
+  for b in backlog:
+    b.close()
+
+  lsock.close()
+
+  # backoff doubles up to its cap, randomised between half and all of it, and
+  # starts over on success
+
+  b = webclient.Backoff(xtime.XTime(), base=100, max_delay=400)
+  delays = []
+
+  for i in range(0, 5):
+    b.failure()
+    delays.append(b._delay)
+
+  _check("Backoff doubles", [ d >= l and d <= h for d, l, h in zip(delays, [ 50, 100, 200, 200, 200 ], [ 100, 200, 400, 400, 400 ]) ] == [ True ] * 5 and b.failures() == 5 and not b.ready())
+
+  time.sleep(0.45)
+  ready = b.ready()
+  b.success()
+
+  _check("Backoff reset", ready and b.ready() and b.failures() == 0)
+
+  # huge bodies; into the buffer, and streamed to a sink
+
+  huge = bytes(range(0, 256)) * 4096
+  digest = hashlib.md5(huge).digest()
+  md5 = [ None ]
+
+  def sink(req):
+    md5[0] = hashlib.md5()
+    req.set_sink(md5[0].update)
+
+  _case(srv, port, "Huge body, 1 MiB", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % (len(huge)), huge), lambda req, rv: ok200(req, rv) and _body(req) == huge)
+
+  _case(srv, port, "Huge body to sink, 1 MiB", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % (len(huge)), huge), lambda req, rv: ok200(req, rv) and md5[0].digest() == digest and len(req._rbuf) <= 1024, setup=sink)
+
+  _case(srv, port, "Huge chunked to sink, 1 MiB", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n", *[ b"%x\r\n%s\r\n" % (len(huge[i:i + 3000]), huge[i:i + 3000]) for i in range(0, len(huge), 3000) ] + [ b"0\r\n\r\n" ]), lambda req, rv: ok200(req, rv) and md5[0].digest() == digest and len(req._rbuf) <= 1024, setup=sink)
+
+  # request bodies, echoed back as their digest
+
+  echo = lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nContent-Length: 32\r\n\r\n" + hashlib.md5(b).hexdigest().encode()) == None
+
+  def post(req):
+    req.set("127.0.0.1", "/test", port, "POST")
+    req.resolve()
+    req.set_body(huge)
+
+  _case(srv, port, "POST 1 MiB", echo, lambda req, rv: ok200(req, rv) and _body(req) == hashlib.md5(huge).hexdigest().encode(), setup=post)
+
+  def chunked_post(req):
+    pieces = [ huge[i:i + 1000] for i in range(0, 100000, 1000) ]
+    req.set("127.0.0.1", "/test", port, "POST")
+    req.resolve()
+    req.set_body(lambda: pieces.pop(0) if len(pieces) > 0 else None)
+
+  _case(srv, port, "Chunked POST 100 KB", echo, lambda req, rv: ok200(req, rv) and _body(req) == hashlib.md5(huge[:100000]).hexdigest().encode(), setup=chunked_post)
+
+  # many at once, in a pool; each response takes a while, so done one after
+  # the other, they would take much longer
+
+  srv.script = lambda c, h, b, n: _send(c, 0.2, b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(h.split(b" ")[1]), h.split(b" ")[1])) == None
+  srv.conns = 0
+
+  pool = webclient.HTTPPool()
+  reqs = [ webclient.HTTPRequest(cache=None) for i in range(0, 8) ]
+
+  for i in range(0, len(reqs)):
+    reqs[i].set("127.0.0.1", "/test%d" % (i), port)
+    reqs[i].resolve()
+    pool.submit(reqs[i])
+
+  t = time.time()
+  done = []
+
+  while len(pool) > 0 and time.time() - t < 10.0:
+    done = done + pool.serve(1)
+
+  _check("Pool x8", len(done) == 8 and len([ x for x in done if x[1][0] == 0 and _body(x[0]) == x[0]._path.encode() ]) == 8 and srv.conns == 8 and time.time() - t < 1.0)
+
+  for req in reqs:
+    req.close()
+
+  # tls, on the next port
+
+  if cert == None or key == None:
+    sys.stdout.write("SKIP TLS, no certificate given\n")
+    sys.exit(1 if _failed > 0 else 0)
+
+  sctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+  sctx.load_cert_chain(cert, key)
+
+  tsrv = _Server(port + 1, sctx)
+
+  cctx = ssl.create_default_context(cafile=cert)
+  cctx.sslsocket_class = _CountingSSLSocket
+
+  tls = { "tls": cctx }
+
+  _case(tsrv, port + 1, "TLS", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello") == None, lambda req, rv: ok200(req, rv) and _body(req) == b"hello", kwargs=tls)
+
+  conns = _case(tsrv, port + 1, "TLS keep-alive x10", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\nx") == None, ok200, kwargs=tls, reqs=10)
+  _check("TLS keep-alive one connection", conns == 1)
+
+  # new connections resume the session
+
+  resumed = []
+
+  webclient._sessions.clear()
+
+  conns = _case(tsrv, port + 1, "TLS resumed x5", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 1\r\n\r\nx"), lambda req, rv: ok200(req, rv) and resumed.append(req.socket().session_reused) == None, kwargs=tls, reqs=5)
+  _check("TLS all but the first resumed", conns == 5 and resumed.count(False) == 1)
+
+  _case(tsrv, port + 1, "TLS not resumed x5", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 1\r\n\r\nx"), lambda req, rv: ok200(req, rv) and not req.socket().session_reused, kwargs={ "tls": cctx, "sessions": None }, reqs=5)
+
+  # server we can't verify
+
+  _case(tsrv, port + 1, "TLS unverified", lambda c, h, b, n: None, lambda req, rv: rv[0] == -17, kwargs={ "tls": True })
+
+  # more than tls reads at a time, so some is left decrypted but unread
+
+  _case(tsrv, port + 1, "TLS huge body to sink, 1 MiB", lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % (len(huge)), huge), lambda req, rv: ok200(req, rv) and md5[0].digest() == digest, setup=sink, kwargs=tls)
+
+  # many at once, in a pool
+
+  tsrv.script = lambda c, h, b, n: _send(c, b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % (len(huge) // 16), huge[:len(huge) // 16]) == None
+
+  pool = webclient.HTTPPool()
+  reqs = [ webclient.HTTPRequest(cache=None, tls=cctx) for i in range(0, 8) ]
+
+  for req in reqs:
+    req.set("127.0.0.1", "/test", port + 1)
+    req.resolve()
+    pool.submit(req)
+
+  t = time.time()
+  done = []
+
+  while len(pool) > 0 and time.time() - t < 10.0:
+    done = done + pool.serve(1)
+
+  _check("TLS pool x8", len(done) == 8 and len([ x for x in done if x[1][0] == 0 and _body(x[0]) == huge[:len(huge) // 16] ]) == 8)
+
+  sys.exit(1 if _failed > 0 else 0)
@@ -23,19 +23,20 @@ if __name__ == "__main__":
 
   port = 8080
   interval = 1000
+  workers = 0
   reqmap = {}
 
   # parse options
 
   try:
-    opts, args = getopt.getopt(sys.argv[1:], "hp:i:m:", ["help", "port=", "interval=", "map="])
+    opts, args = getopt.getopt(sys.argv[1:], "hp:i:w:m:f:", ["help", "port=", "interval=", "workers=", "map=", "file="])
   except Exception as e:
     sys.stderr.write("Failed to parse arguments: %s\n" % (e))
     sys.exit(1)
 
   for o, a in opts:
     if o == "-h" or o == "--help":
-      sys.stdout.write("Usage: %s [-h] [-p <port>] [-i <interval>] [-m <path1>=<text1> [-m <path2>=<text2>]]\n" % (sys.argv[0]))
+      sys.stdout.write("Usage: %s [-h] [-p <port>] [-i <interval>] [-w <workers>] [-m <path1>=<text1> [-m <path2>=<text2>]] [-f <path3>=<file3> [-f <path4>=<file4>]]\n" % (sys.argv[0]))
       sys.exit(0)
     elif o == "-p" or o == "--port":
       try:
@@ -55,6 +56,15 @@ if __name__ == "__main__":
       if interval < 5 or interval > 30000:
         sys.stderr.write("Invalid interval. Valid range 5 msec to 30000 msec\n")
         sys.exit(4)
+    elif o == "-w" or o == "--workers":
+      try:
+        workers = int(a)
+      except Exception as e:
+        sys.stderr.write("Invalid number of workers. Valid range 0 to 64\n")
+        sys.exit(6)
+      if workers < 0 or workers > 64:
+        sys.stderr.write("Invalid number of workers. Valid range 0 to 64\n")
+        sys.exit(7)
     elif o == "-m" or o == "--map":
       if "=" not in a:
         sys.stderr.write("Invalid map.\n")
@@ -62,12 +72,24 @@ if __name__ == "__main__":
 
       n, v = a.split("=", 1)
       reqmap[n.strip()] = v.strip()
+    elif o == "-f" or o == "--file":
+      if "=" not in a:
+        sys.stderr.write("Invalid file map.\n")
+        sys.exit(8)
+
+      n, v = a.split("=", 1)
+      reqmap[n.strip()] = webserver.File(v.strip())
 
   # now do stuff
 
   xt = xtime.XTime()
-  ws = webserver.Webserver(xt, port=port)
 
+  if workers > 0:
+    ws = webserver.ForkingWebserver(xt, workers=workers, port=port)
+  else:
+    ws = webserver.Webserver(xt, port=port)
+
+  ws.set(reqmap)
   ws.start()
 
   while True:
@@ -76,6 +98,6 @@ if __name__ == "__main__":
 
     print("tick", now)
 
-    ws.serve(reqmap, now)
+    ws.serve(now)
 
     xt.sleep_ms(interval)
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2022 Vino Fernando Crescini <vfcrescini@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# 2026-10-19 xconfig_test.py
+
+# test for config files, modules compiled from them by confgen.py, and
+# validation of declared params
+# everything is written to a temporary directory, which is removed at the end
+
+
+import os
+import sys
+import getopt
+import shutil
+import tempfile
+import subprocess
+
+sys.path.append(os.path.join("..", "lib"))
+sys.path.append(os.path.join("..", "apps", "clock_sensor"))
+
+import xconfig
+import clock_sensor
+
+
+_failed = 0
+
+
+def _check(name, ok):
+
+  global _failed
+
+  if not ok:
+    _failed = _failed + 1
+
+  sys.stdout.write("%s %s\n" % ("PASS" if ok else "FAIL", name))
+
+
+def _write(path, text):
+
+  f = open(path, "w")
+  f.write(text)
+  f.close()
+
+
+# compile a config file into a module of the given name
+#   return confgen's exit status
+
+def _confgen(path, module):
+
+  return subprocess.call([ sys.executable, os.path.join("..", "utils", "confgen.py"), "-i", path, "-o", os.path.join(os.path.dirname(path), module + ".py") ], stderr=subprocess.DEVNULL)
+
+
+# a fresh import of the module, as on boot
+
+def _import(module):
+
+  if module in sys.modules:
+    del sys.modules[module]
+
+  return __import__(module)
+
+
+if __name__ == "__main__":
+
+  opts = None
+  args = None
+
+  # parse options
+
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "h", ["help"])
+  except Exception as e:
+    sys.stderr.write("Failed to parse arguments: %s\n" % (e))
+    sys.exit(1)
+
+  for o, a in opts:
+    if o == "-h" or o == "--help":
+      sys.stdout.write("Usage: %s [-h]\n" % (sys.argv[0]))
+      sys.exit(0)
+
+  tmp = tempfile.mkdtemp()
+  sys.path.insert(0, tmp)
+
+  try:
+
+    # compiled values are typed only if they read back as they were written
+
+    path = os.path.join(tmp, "a.conf")
+
+    _write(path, "# comment\nINT = 42\nNEG = -3\nPADDED = 007\nHEX = 0x10\nYES = True\nNO = False\nWORD = yes\nSTR = hello world # trailing\nEMPTY =\nINT = 43\n")
+
+    _check("Compiled", _confgen(path, "a_conf") == 0)
+
+    m = _import("a_conf")
+
+    _check("Compiled ints", m.INT == 42 and m.NEG == -3)
+    _check("Compiled strings", m.PADDED == "007" and m.HEX == "0x10" and m.WORD == "yes" and m.STR == "hello world" and m.EMPTY == "")
+    _check("Compiled bools", m.YES is True and m.NO is False)
+
+    # read the same, compiled or not
+
+    a = xconfig.XConfig(path=path)
+    b = xconfig.XConfig(path=path, module="a_conf")
+
+    _check("Module used", b._module != None)
+    _check("Module reads like file", [ (a.get_str(n), a.get_int(n, 10, -1), a.get_int(n, 16, -1), a.get_bool(n, None)) for n in [ "INT", "NEG", "PADDED", "HEX", "YES", "NO", "WORD", "STR", "EMPTY", "NOPE" ] ] == [ (b.get_str(n), b.get_int(n, 10, -1), b.get_int(n, 16, -1), b.get_bool(n, None)) for n in [ "INT", "NEG", "PADDED", "HEX", "YES", "NO", "WORD", "STR", "EMPTY", "NOPE" ] ])
+
+    # names that can't be module constants are rejected
+
+    for name in [ "class", "None", "_PRIVATE", "1ST", "A-B" ]:
+      p = os.path.join(tmp, "bad.conf")
+      _write(p, "OK = 1\n%s = 2\n" % (name))
+      _check("Rejected %s" % (name), _confgen(p, "bad_conf") != 0 and not os.path.exists(os.path.join(tmp, "bad_conf.py")))
+
+    # copied, so only the mtime has changed; the crc says it's the same
+
+    st = os.stat(path)
+    os.utime(path, (st.st_atime, st.st_mtime + 10))
+
+    _check("Copied file, module used", xconfig.XConfig(path=path, module="a_conf")._module != None)
+
+    # edited to the same size; the crc says it isn't the same
+
+    _write(path, open(path).read().replace("INT = 42", "INT = 24"))
+    os.utime(path, (st.st_atime, st.st_mtime + 20))
+
+    c = xconfig.XConfig(path=path, module="a_conf")
+    _check("Stale stamp, same size", c._module == None and c.get_int("INT") == 24)
+
+    # edited to some other size, and mtime as it was; no need for the crc
+
+    _write(path, open(path).read().replace("INT = 24", "INT = 2424"))
+    os.utime(path, (st.st_atime, st.st_mtime))
+
+    c = xconfig.XConfig(path=path, module="a_conf")
+    _check("Stale stamp, other size", c._module == None and c.get_int("INT") == 2424)
+
+    # no file; the module is all there is
+
+    os.remove(path)
+
+    c = xconfig.XConfig(path=path, module="a_conf")
+    _check("No file, module used", c._module != None and c.get_int("INT") == 42)
+
+    # not stamped at all
+
+    _write(path, "INT = 42\n")
+    _write(os.path.join(tmp, "u_conf.py"), "INT = 42\n")
+
+    c = xconfig.XConfig(path=path, module="u_conf")
+    _check("Unstamped module ignored", c._module == None)
+
+    # declared params; the ends of a range are in it, and 0 may well mean
+    # something, like no limit, rather than nothing
+
+    _write(path, "LO = 0\nHI = 64\nUNDER = -1\nOVER = 65\nHEX = 40\nNAN = x\nYES = y\nMAYBE = maybe\nEMPTY =\n")
+
+    c = xconfig.XConfig(path=path)
+    c.declare([ (n, c.INT, 4, 10, 0, 64) for n in [ "LO", "HI", "UNDER", "OVER", "NAN", "EMPTY", "NOPE" ] ] + [ ("HEX", c.INT, 4, 16, 0, 64), ("YES", c.BOOL, False, 10, None, None), ("MAYBE", c.BOOL, True, 10, None, None) ])
+
+    errors = c.validate()
+
+    _check("Validated in range", c.get_int("LO", 10, 4) == 0 and c.get_int("HI") == 64 and c.get_int("HEX") == 64 and c.get_bool("YES") is True)
+    _check("Validated defaults", c.get_int("EMPTY") == 4 and c.get_int("NOPE") == 4)
+    _check("Validated out of range", c.get_int("UNDER") == 4 and c.get_int("OVER") == 4 and c.get_int("NAN") == 4 and c.get_bool("MAYBE") is True)
+    _check("Validation errors", len(errors) == 4 and len([ e for e in errors if e.split(":")[0] in [ "UNDER", "OVER", "NAN", "MAYBE" ] ]) == 4)
+
+    # the webserver's limits, where 0 is no limit
+
+    _write(path, "WEBSRV_MAX_CLIENTS = 0\nWEBSRV_MAX_ACCEPT = 0\n")
+
+    c = xconfig.XConfig(path=path)
+    clock_sensor.declare(c, "WEBSRV", clock_sensor.WS.SCHEMA)
+
+    _check("Webserver limits of 0", c.validate() == [] and c.get_int("WEBSRV_MAX_CLIENTS", 10, 4) == 0 and c.get_int("WEBSRV_MAX_ACCEPT", 10, 2) == 0)
+
+  finally:
+    shutil.rmtree(tmp)
+
+  sys.exit(1 if _failed > 0 else 0)
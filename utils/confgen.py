@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2022 Vino Fernando Crescini <vfcrescini@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# 2026-10-19 confgen.py
+
+# compiles a configuration file for xconfig.py into a python module of
+# constants, one per param, for XConfig(module=...) to import instead
+# values that read back the same as they were written are typed: decimal ints
+# as ints, True and False as bools; everything else stays a string
+# the module records the size, mtime and crc32 of the file as _CONF_STAMP, so
+# that XConfig can tell when the file has been edited since, and parse it
+# instead
+# compile the module with mpy-cross, or freeze it into the firmware, to keep
+# its strings in flash
+
+
+import os
+import sys
+import getopt
+import keyword
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+import xconfig
+
+
+# the value as the constant it compiles to
+
+def _typed(value):
+
+  if value == "True":
+    return True
+
+  if value == "False":
+    return False
+
+  try:
+    i = int(value, 10)
+  except:
+    return value
+
+  return i if str(i) == value else value
+
+
+def _valid(name):
+
+  if len(name) == 0 or name.startswith("_") or not (name[0].isalpha()) or keyword.iskeyword(name):
+    return False
+
+  for c in name:
+    if not (c.isalnum() or c == "_"):
+      return False
+
+  return True
+
+
+if __name__ == "__main__":
+
+  opts = None
+  args = None
+
+  ipath = None
+  opath = None
+
+  # parse options
+
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "hi:o:", ["help", "input=", "output="])
+  except Exception as e:
+    sys.stderr.write("Failed to parse arguments: %s\n" % (e))
+    sys.exit(1)
+
+  for o, a in opts:
+    if o == "-h" or o == "--help":
+      sys.stdout.write("Usage: %s [-h] -i <conf file> [-o <module file>]\n" % (sys.argv[0]))
+      sys.exit(0)
+    elif o == "-i" or o == "--input":
+      ipath = a
+    elif o == "-o" or o == "--output":
+      opath = a
+
+  if ipath == None:
+    sys.stderr.write("No configuration file given\n")
+    sys.exit(2)
+
+  # parse the file, keeping the order of params, and the first of each, the
+  # way XConfig looks them up
+
+  xc = xconfig.XConfig(path=ipath)
+
+  params = xc.items()
+  stamp = xc.stamp()
+
+  if params == None or stamp == None or stamp[2] == None:
+    sys.stderr.write("Failed to read %s\n" % (ipath))
+    sys.exit(3)
+
+  for name, value in params:
+    if not _valid(name):
+      sys.stderr.write("Invalid param name %s\n" % (name))
+      sys.exit(4)
+
+  # write module
+
+  lines = [ "# generated by confgen.py from %s; do not edit" % (os.path.basename(ipath)), "", "_CONF_STAMP = %s" % (repr(stamp)), "" ]
+
+  for name, value in params:
+    lines.append("%s = %s" % (name, repr(_typed(value))))
+
+  try:
+    f = sys.stdout if opath == None else open(opath, "w")
+    f.write("\n".join(lines) + "\n")
+    if opath != None:
+      f.close()
+  except Exception as e:
+    sys.stderr.write("Failed to write %s: %s\n" % (opath, e))
+    sys.exit(5)
+
+  sys.exit(0)